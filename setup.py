@@ -28,6 +28,9 @@ setup(
     download_url="https://github.com/zbanks/shmooze/tarball/{}".format(VERSION),
     zip_safe=False,
     install_requires=required,
+    extras_require={
+        'msgpack': ['msgpack>=0.5.2'],
+    },
     scripts=[
         "bin/shmooze", 
         "bin/shmz", 
@@ -0,0 +1,135 @@
+import time
+
+import tornado.gen
+import toro
+
+# Admission control for the commands a service handles.
+#
+# Each client (see JSONCommandProcessor.client_of) gets a token bucket for all of its commands,
+# and one for each command that has its own limit. A command is only run if every bucket it draws from has a token;
+# otherwise it is rejected, with the number of seconds until it would be admitted ("retry_after").
+# Separately, the number of modules being spawned at once is capped (see SpawnLimit).
+#
+# Configured by "admission" in settings.json, e.g.
+#   {"per_client": {"rate": 20, "burst": 40}, "per_command": {"add": {"rate": 1, "burst": 5}}, "max_spawns": 4}
+# Rates are in commands per second; burst is how many may be sent at once after a quiet spell.
+# A command may cost more than one token (see JSONCommandProcessor.admission_cost), e.g. add_many costs one "add" per item.
+
+# Raised for a command that costs more tokens than its bucket can ever hold
+class TooLarge(Exception):
+    pass
+
+class TokenBucket(object):
+    def __init__(self, rate, burst, now):
+        if rate <= 0 or burst < 1:
+            raise ValueError("Admission limits need a rate above 0 and a burst of at least 1")
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    # Seconds until count tokens are available (0 if they are now)
+    def wait_time(self, now, count=1):
+        self.refill(now)
+        if self.tokens >= count:
+            return 0
+        return (count - self.tokens) / self.rate
+
+    def take(self, count=1):
+        self.tokens -= count
+
+    def full(self, now):
+        self.refill(now)
+        return self.tokens >= self.burst
+
+# Caps how many modules are spawned at once. Modules wait for a slot in Module.new.
+class SpawnLimit(object):
+    def __init__(self, max_spawns):
+        self.slots = toro.Semaphore(max_spawns)
+        self.active = 0
+        self.waiting = 0
+
+    @tornado.gen.coroutine
+    def acquire(self):
+        self.waiting += 1
+        try:
+            yield self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+
+    def release(self):
+        self.active -= 1
+        self.slots.release()
+
+class Admission(object):
+    # Forget the buckets of clients idle for this long (their buckets will have filled up)
+    idle_timeout = 600
+
+    def __init__(self, per_client=None, per_command=None, max_spawns=None):
+        self.per_client = per_client
+        self.per_command = per_command or {}
+        # Fail now, rather than on the first command
+        for limit in ([per_client] if per_client else []) + self.per_command.values():
+            TokenBucket(limit["rate"], limit["burst"], 0)
+        self.spawn_limit = SpawnLimit(max_spawns) if max_spawns else None
+        # (client, cmd) -> TokenBucket; cmd is None for the client's bucket for all commands
+        self.buckets = {}
+        self.last_pruned = time.time()
+        self.admitted = 0
+        # cmd -> number of times it was rejected
+        self.rejected = {}
+
+    def limits(self, cmd):
+        if self.per_client:
+            yield None, self.per_client
+        if cmd in self.per_command:
+            yield cmd, self.per_command[cmd]
+
+    # Returns None if the client may run cmd now, or the number of seconds to wait before trying again.
+    # Raises TooLarge if a command costing count tokens could never be admitted.
+    def admit(self, client, cmd, count=1):
+        now = time.time()
+        if now - self.last_pruned > self.idle_timeout:
+            self.prune(now)
+        buckets = []
+        for key, limit in self.limits(cmd):
+            if (client, key) not in self.buckets:
+                self.buckets[(client, key)] = TokenBucket(limit["rate"], limit["burst"], now)
+            buckets.append(self.buckets[(client, key)])
+        if any([count > b.burst for b in buckets]):
+            self.rejected[cmd] = self.rejected.get(cmd, 0) + 1
+            raise TooLarge("Too many at once; the limit is {0}".format(int(min([b.burst for b in buckets]))))
+        wait = max([b.wait_time(now, count) for b in buckets] or [0])
+        if wait > 0:
+            self.rejected[cmd] = self.rejected.get(cmd, 0) + 1
+            return wait
+        for b in buckets:
+            b.take(count)
+        self.admitted += 1
+        return None
+
+    def prune(self, now):
+        self.buckets = dict([(k, b) for k, b in self.buckets.items() if not b.full(now)])
+        self.last_pruned = now
+
+    def stats(self):
+        d = {
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "clients": len(set([client for client, key in self.buckets])),
+        }
+        if self.spawn_limit is not None:
+            d["spawns_active"] = self.spawn_limit.active
+            d["spawns_waiting"] = self.spawn_limit.waiting
+        return d
+
+# An Admission configured from settings, or None if admission control is off
+def from_settings(config):
+    if not config:
+        return None
+    return Admission(config.get("per_client"), config.get("per_command"), config.get("max_spawns"))
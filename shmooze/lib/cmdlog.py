@@ -1,11 +1,178 @@
+import datetime
 import json
+import os
+import threading
+import time
 
+# Logs commands to a file, one JSON object per line.
+# May be used as the logger of any JSONCommandProcessor, in place of a shmooze.lib.database.Database.
+#
+# The file is kept open, and lines are buffered in memory; a background thread writes them out every
+# flush_interval seconds, or as soon as buffer_size bytes are waiting.
+# fsync is one of:
+#  - "none": leave it to the OS to get written data onto disk
+#  - "periodic": fsync written data within fsync_interval seconds, but at most every fsync_interval seconds
+#  - "always": write and fsync every line before log() returns (slow; this blocks the caller)
+# The file is rotated once it reaches max_bytes (keeping backup_count old files, as filename.1, filename.2, ...),
+# and/or, with rotate_daily, at the first write of each (UTC) day (as filename.YYYY-MM-DD).
 class FileLogger(object):
-    def __init__(self,filename):
+    fsync_modes = ("none", "periodic", "always")
+
+    def __init__(self,filename,flush_interval=1.0,buffer_size=65536,fsync="none",fsync_interval=1.0,
+                 max_bytes=None,backup_count=5,rotate_daily=False):
+        if fsync not in self.fsync_modes:
+            raise Exception("Unknown fsync mode: {0}".format(fsync))
         self.filename=filename
+        self.flush_interval=flush_interval
+        self.buffer_size=buffer_size
+        self.fsync=fsync
+        self.fsync_interval=fsync_interval
+        self.max_bytes=max_bytes
+        self.backup_count=backup_count
+        self.rotate_daily=rotate_daily
+
+        self.buffer=[]
+        self.buffered=0
+        # Protects the buffer
+        self.lock=threading.Lock()
+        # Held while writing to (or rotating) the file
+        self.file_lock=threading.Lock()
+        self.wakeup=threading.Event()
+        self.stopping=False
+        self.last_fsync=0
+        # Whether anything has been written since the last fsync
+        self.unsynced=False
+
+        self.open()
+        self.thread=threading.Thread(target=self.run,name="FileLogger")
+        self.thread.daemon=True
+        self.thread.start()
+
+    def open(self):
+        self.f=open(self.filename,"a")
+        self.size=self.f.tell()
+        self.day=self.today()
+        if self.rotate_daily and self.size > 0:
+            self.day=datetime.datetime.utcfromtimestamp(os.path.getmtime(self.filename)).date()
+
+    def today(self):
+        return datetime.datetime.utcnow().date()
+
+    # Either log(msg), or log(uid, namespace, command, response, queue=None) as JSONCommandProcessor does
+    def log(self,*args,**kwargs):
+        if len(args) == 1:
+            msg=args[0]
+        else:
+            uid,namespace,command,response=args
+            msg={'timestamp':str(datetime.datetime.utcnow()),'uid':uid,'namespace':namespace,'sent':command,'received':response}
+            if kwargs.get('queue') is not None:
+                msg['queue']=kwargs['queue']
+        line=json.dumps(msg)+'\n'
+        if self.fsync == "always":
+            with self.file_lock:
+                self.write([line])
+            return
+        with self.lock:
+            self.buffer.append(line)
+            self.buffered+=len(line)
+            full=self.buffered >= self.buffer_size
+        if full:
+            self.wakeup.set()
+
+    def run(self):
+        while not self.stopping:
+            self.wakeup.wait(self.wait_time())
+            self.wakeup.clear()
+            self.flush()
+            # Written data still gets fsynced if nothing more is written (see write)
+            if self.fsync == "periodic":
+                with self.file_lock:
+                    try:
+                        if self.unsynced and time.time() - self.last_fsync >= self.fsync_interval:
+                            self.sync()
+                    except (IOError,OSError) as e:
+                        print "Error writing to command log {0}: {1}".format(self.filename,e)
+                        self.last_fsync=time.time()
+
+    # How long the writer thread should wait before it next looks for anything to do
+    def wait_time(self):
+        if self.fsync == "periodic" and self.unsynced:
+            return max(0,min(self.flush_interval,self.last_fsync+self.fsync_interval-time.time()))
+        return self.flush_interval
+
+    # Write out everything that's buffered
+    def flush(self):
+        with self.file_lock:
+            with self.lock:
+                lines=self.buffer
+                self.buffer=[]
+                self.buffered=0
+            if lines:
+                self.write(lines)
+
+    # file_lock should be held
+    def write(self,lines):
+        try:
+            # Write as few chunks as we can, while still rotating between lines
+            chunk=[]
+            chunk_size=0
+            for line in lines:
+                if self.should_rotate(chunk_size,len(line)):
+                    self.f.write(''.join(chunk))
+                    self.size+=chunk_size
+                    chunk=[]
+                    chunk_size=0
+                    self.rotate()
+                chunk.append(line)
+                chunk_size+=len(line)
+            self.f.write(''.join(chunk))
+            self.f.flush()
+            self.size+=chunk_size
+            self.unsynced=True
+            if self.fsync == "always" or (self.fsync == "periodic" and time.time() - self.last_fsync >= self.fsync_interval):
+                self.sync()
+        except (IOError,OSError) as e:
+            print "Error writing to command log {0}: {1}".format(self.filename,e)
+
+    # file_lock should be held
+    def sync(self):
+        os.fsync(self.f.fileno())
+        self.last_fsync=time.time()
+        self.unsynced=False
+
+    # Whether to rotate before writing a line of the given length, with pending bytes not yet written
+    # (A line longer than max_bytes still gets a file to itself)
+    def should_rotate(self,pending,length):
+        if self.size + pending == 0:
+            return False
+        if self.rotate_daily and self.today() != self.day:
+            return True
+        return self.max_bytes is not None and self.size + pending + length > self.max_bytes
+
+    # file_lock should be held
+    def rotate(self):
+        if self.fsync != "none" and self.unsynced:
+            self.sync()
+        self.f.close()
+        if self.rotate_daily and self.today() != self.day:
+            os.rename(self.filename,"{0}.{1}".format(self.filename,self.day.isoformat()))
+        elif self.backup_count > 0:
+            for i in range(self.backup_count-1,0,-1):
+                src="{0}.{1}".format(self.filename,i)
+                if os.path.exists(src):
+                    os.rename(src,"{0}.{1}".format(self.filename,i+1))
+            os.rename(self.filename,self.filename+".1")
+        else:
+            os.remove(self.filename)
+        self.open()
 
-    def log(self,msg):
-        f=open(self.filename,"a")
-        with f:
-            json.dump(msg,f)
-            f.write('\n')
+    # Write out everything that's buffered, and close the file
+    def close(self):
+        self.stopping=True
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+        with self.file_lock:
+            if self.fsync != "none" and self.unsynced:
+                self.sync()
+            self.f.close()
@@ -0,0 +1,119 @@
+import json
+import struct
+import shmooze.lib.packet as packet
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# A codec turns messages into bytes on the wire and back again.
+#
+# The receiving side works out which codec the sender is using from the first byte of a connection
+# (see detect), and answers in the same codec.
+# Line codecs end each message with a delimiter; framed codecs put a fixed-size header in front of each
+# message which says how long it is.
+
+# JSON, one message per line. This is the default, and what non-python modules are expected to speak.
+class JSONLinesCodec(object):
+    name = 'json'
+    framed = False
+    delimiter = '\n'
+
+    def encode(self, obj):
+        return self.dumps(obj) + self.delimiter
+
+    # Reuses the encoding of any packet.Cached responses, on their own or in a list
+    def dumps(self, obj):
+        if isinstance(obj, packet.Cached):
+            return obj.encoded(self.name, json.dumps)
+        if isinstance(obj, list) and any(isinstance(o, packet.Cached) for o in obj):
+            return '[' + ', '.join([self.dumps(o) for o in obj]) + ']'
+        return json.dumps(obj)
+
+    def decode(self, data):
+        return json.loads(data)
+
+    # Returns (message, rest of buffer), or (None, buffer) if the buffer doesn't hold a whole message yet
+    def decode_buffer(self, buf):
+        data, rest = self.split_buffer(buf)
+        if data is None:
+            return None, buf
+        return self.decode(data), rest
+
+    # Like decode_buffer, but returns the encoded message rather than decoding it
+    def split_buffer(self, buf):
+        a = buf.find(self.delimiter)
+        if a < 0:
+            return None, buf
+        return buf[0:a], buf[a+1:]
+
+# msgpack, in length-prefixed frames.
+# Each frame is a zero byte (which can never start a line of JSON),
+# the length of the payload as a 4-byte big-endian integer, and the payload.
+class MsgpackCodec(object):
+    name = 'msgpack'
+    framed = True
+    magic = '\x00'
+    header_size = 5
+
+    def __init__(self):
+        if msgpack is None:
+            raise Exception("The msgpack codec requires the msgpack package")
+
+    def encode(self, obj):
+        payload = self.pack(obj)
+        return self.magic + struct.pack('>I', len(payload)) + payload
+
+    # Reuses the encoding of any packet.Cached responses, on their own or in a list
+    def pack(self, obj):
+        if isinstance(obj, packet.Cached):
+            return obj.encoded(self.name, self.packb)
+        if isinstance(obj, list) and any(isinstance(o, packet.Cached) for o in obj):
+            header = msgpack.Packer(use_bin_type=False).pack_array_header(len(obj))
+            return header + ''.join([self.pack(o) for o in obj])
+        return self.packb(obj)
+
+    def packb(self, obj):
+        return msgpack.packb(obj, use_bin_type=False)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+    # Length of the payload that follows the given header
+    def frame_length(self, header):
+        if header[0] != self.magic:
+            raise Exception("Malformed frame header")
+        return struct.unpack('>I', header[1:self.header_size])[0]
+
+    def decode_buffer(self, buf):
+        data, rest = self.split_buffer(buf)
+        if data is None:
+            return None, buf
+        return self.decode(data), rest
+
+    def split_buffer(self, buf):
+        if len(buf) < self.header_size:
+            return None, buf
+        end = self.header_size + self.frame_length(buf[0:self.header_size])
+        if len(buf) < end:
+            return None, buf
+        return buf[self.header_size:end], buf[end:]
+
+codecs = {
+    'json': JSONLinesCodec,
+    'msgpack': MsgpackCodec,
+}
+
+def get(name=None):
+    if name is None:
+        name = 'json'
+    if name not in codecs:
+        raise Exception("Unknown codec: {0}".format(name))
+    return codecs[name]()
+
+# Work out the codec of a connection from the first byte received on it
+def detect(first):
+    if first == MsgpackCodec.magic:
+        return get('msgpack')
+    return get('json')
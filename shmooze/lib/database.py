@@ -1,25 +1,451 @@
+import gzip
 import json
+import os
+import Queue
 import sqlite3
+import threading
+import time
 import shmooze.settings as settings
 
 def row_dict(r):
     # Convert a sqlite3.Row object to a dictionary
     return {k: r[k] for k in r.keys()}
-        
+
+# Open a connection to the database, with the pragmas we want on every connection.
+# WAL lets the log writer, readers and maintenance work use the database at the same time.
+def connect(filename, **kwargs):
+    conn = sqlite3.connect(filename, cached_statements=256, **kwargs)
+    # Only takes effect on a new database; lets LogRetention give deleted pages back to the filesystem
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+    if filename != ":memory:":
+        conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA busy_timeout=5000;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    return conn
+
+def log_insert_sql(log_table):
+    return "INSERT INTO {} (uid, namespace, input_json, output_json, queue) VALUES (?, ?, ?, ?, ?);".format(log_table)
+
+# Schema of the log tables, as a list of versions.
+# Each version is a list of statements which upgrade a table from the previous version; "{table}" is the table name.
+log_migrations = [
+    [
+        """CREATE TABLE IF NOT EXISTS {table} (
+            pk INTEGER PRIMARY KEY,
+            uid TEXT,
+            namespace TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            input_json TEXT,
+            output_json TEXT
+        );""",
+    ],
+    [
+        "CREATE INDEX IF NOT EXISTS {table}_uid_timestamp ON {table} (uid, timestamp);",
+        "CREATE INDEX IF NOT EXISTS {table}_namespace_timestamp ON {table} (namespace, timestamp);",
+        "CREATE INDEX IF NOT EXISTS {table}_timestamp ON {table} (timestamp);",
+    ],
+    [
+        # Which queue of a multi-queue (see shmooze.multiqueue) the row is about, or NULL
+        "ALTER TABLE {table} ADD COLUMN queue TEXT;",
+        "CREATE INDEX IF NOT EXISTS {table}_queue_timestamp ON {table} (queue, timestamp);",
+    ],
+]
+
+# Changes on top of the tables made in create_top_schema, in the same format as log_migrations.
+top_migrations = [
+    [
+        "ALTER TABLE top_item ADD COLUMN play_count INTEGER DEFAULT 0;",
+        "ALTER TABLE top_item ADD COLUMN last_played DATETIME;",
+        "ALTER TABLE top_item_module ADD COLUMN played_timestamp DATETIME;",
+        """CREATE TABLE IF NOT EXISTS top_item_daily (
+            item_pk INTEGER,
+            category_pk INTEGER,
+            day DATE,
+            plays INTEGER DEFAULT 0,
+            PRIMARY KEY (item_pk, day)
+        );""",
+        "CREATE UNIQUE INDEX IF NOT EXISTS top_category_slug ON top_category (slug);",
+        "CREATE UNIQUE INDEX IF NOT EXISTS top_item_canonical ON top_item (category_pk, canonical_id);",
+        "CREATE INDEX IF NOT EXISTS top_item_leaderboard ON top_item (category_pk, play_count);",
+        "CREATE INDEX IF NOT EXISTS top_item_module_uuid ON top_item_module (module_uuid);",
+        "CREATE INDEX IF NOT EXISTS top_item_daily_category ON top_item_daily (category_pk, day);",
+    ],
+    [
+        # Which queue of a multi-queue the module was added to, so that each queue has its own top lists
+        "ALTER TABLE top_item_module ADD COLUMN queue TEXT;",
+        "CREATE INDEX IF NOT EXISTS top_item_module_queue ON top_item_module (queue, played_timestamp);",
+    ],
+]
+
+# Keeps the top_* tables up to date as commands are logged, so that "most played" lists
+# can be read straight out of them instead of by going back over the logs.
+#
+# An item is identified by its category (the module type) and a canonical id worked out from the
+# arguments it was added with. extractors maps module types to functions which take those arguments and
+# return (canonical_id, url, description), or None if the item shouldn't be counted.
+# An item is counted as played the first time one of its modules is sent "play".
+# Modules of a hosted queue are also counted towards that queue's own lists (see Database.top_items).
+class TopAggregator(object):
+    def __init__(self, extractors=None):
+        self.extractors = extractors or {}
+        # A module added to an empty queue is played before its "add" is logged;
+        # those plays are held here until the "add" comes along.
+        self.early_plays = set()
+
+    # Turn a logged command into an event for apply(), or None if it doesn't matter to us.
+    # This runs wherever log() is called from, so it only picks apart the command.
+    def extract(self, uid, namespace, command, response, queue=None):
+        if not isinstance(command, dict) or not isinstance(response, dict) or not response.get("success"):
+            return None
+        cmd = command.get("cmd")
+        if cmd == "add":
+            return self.extract_add(command.get("args", {}), response.get("result"), queue)
+        if cmd == "add_many":
+            # One "add" for each module that was added
+            items = command.get("args", {}).get("items", [])
+            results = response.get("result") or []
+            events = [self.extract_add(item, result, queue) for item, result in zip(items, results) if isinstance(item, dict)]
+            return ("many", [e for e in events if e is not None])
+        if cmd == "play" and namespace == "queue-module":
+            return ("play", uid)
+        return None
+
+    def extract_add(self, args, result, queue=None):
+        if not isinstance(result, dict) or "uid" not in result:
+            return None
+        item = self.identify(args.get("type"), args.get("args", {}))
+        if item is None:
+            return None
+        canonical_id, url, description = item
+        # Re-queueing the item is always a single add
+        requeue_command = json.dumps({"cmd": "add", "args": args})
+        return ("add", result["uid"], args.get("type"), canonical_id, url, description, requeue_command, queue)
+
+    def identify(self, module_type, args):
+        if module_type in self.extractors:
+            return self.extractors[module_type](args)
+        return (json.dumps(args, sort_keys=True), None, None)
+
+    # Update the top_* tables for an event from extract(). Does not commit.
+    def apply(self, conn, event):
+        if event[0] == "many":
+            for e in event[1]:
+                self.apply(conn, e)
+        elif event[0] == "add":
+            _, module_uuid, slug, canonical_id, url, description, requeue_command, queue = event
+            conn.execute("INSERT OR IGNORE INTO top_category (slug) VALUES (?);", (slug,))
+            category_pk = conn.execute("SELECT pk FROM top_category WHERE slug = ?;", (slug,)).fetchone()[0]
+            conn.execute("INSERT OR IGNORE INTO top_item (canonical_id, category_pk, play_count) VALUES (?, ?, 0);", (canonical_id, category_pk))
+            conn.execute("UPDATE top_item SET requeue_command = ?, url = ?, description = ? WHERE category_pk = ? AND canonical_id = ?;",
+                         (requeue_command, url, description, category_pk, canonical_id))
+            item_pk = conn.execute("SELECT pk FROM top_item WHERE category_pk = ? AND canonical_id = ?;", (category_pk, canonical_id)).fetchone()[0]
+            link_pk = conn.execute("INSERT INTO top_item_module (item_pk, module_uuid, queue) VALUES (?, ?, ?);", (item_pk, module_uuid, queue)).lastrowid
+            if module_uuid in self.early_plays:
+                self.early_plays.discard(module_uuid)
+                self.count_play(conn, link_pk, item_pk, category_pk)
+        elif event[0] == "play":
+            _, module_uuid = event
+            row = conn.execute("""SELECT m.pk, m.item_pk, i.category_pk, m.played_timestamp FROM top_item_module m JOIN top_item i ON i.pk = m.item_pk
+                                  WHERE m.module_uuid = ?;""", (module_uuid,)).fetchone()
+            if row is None:
+                if len(self.early_plays) > 1000:
+                    self.early_plays.clear()
+                self.early_plays.add(module_uuid)
+            elif row[3] is None:
+                self.count_play(conn, row[0], row[1], row[2])
+
+    def count_play(self, conn, link_pk, item_pk, category_pk):
+        conn.execute("UPDATE top_item_module SET played_timestamp = CURRENT_TIMESTAMP WHERE pk = ?;", (link_pk,))
+        conn.execute("UPDATE top_item SET play_count = play_count + 1, last_played = CURRENT_TIMESTAMP WHERE pk = ?;", (item_pk,))
+        conn.execute("INSERT OR IGNORE INTO top_item_daily (item_pk, category_pk, day, plays) VALUES (?, ?, date('now'), 0);", (item_pk, category_pk))
+        conn.execute("UPDATE top_item_daily SET plays = plays + 1 WHERE item_pk = ? AND day = date('now');", (item_pk,))
+
+# Writes log rows from a background thread, so that logging isn't on the IOLoop.
+# Rows are grouped into one transaction every flush_interval seconds, or every flush_rows rows.
+# If more than max_pending rows are waiting, when_full decides whether to "drop" new rows or "block" until there's room.
+class LogWriter(threading.Thread):
+    STOP = object()
+
+    def __init__(self, filename, log_table, flush_interval=0.1, flush_rows=500, max_pending=10000, when_full="drop", aggregator=None):
+        super(LogWriter, self).__init__(name="LogWriter-{}".format(log_table))
+        self.daemon = True
+        self.filename = filename
+        self.insert_sql = log_insert_sql(log_table)
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self.when_full = when_full
+        self.aggregator = aggregator
+        # (row, aggregator event) pairs
+        self.pending = Queue.Queue(max_pending)
+        self.written = 0
+        self.dropped = 0
+
+    def put(self, row, event=None):
+        if self.when_full == "block":
+            self.pending.put((row, event))
+            return
+        try:
+            self.pending.put_nowait((row, event))
+        except Queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        conn = connect(self.filename)
+        done = False
+        while not done:
+            batch = []
+            item = self.pending.get()
+            deadline = time.time() + self.flush_interval
+            while True:
+                if item is self.STOP:
+                    done = True
+                    break
+                batch.append(item)
+                if len(batch) >= self.flush_rows:
+                    break
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.pending.get(timeout=timeout)
+                except Queue.Empty:
+                    break
+            if batch:
+                self.write(conn, batch)
+        conn.close()
+
+    def write(self, conn, batch):
+        try:
+            with conn:
+                conn.executemany(self.insert_sql, [row for row, event in batch])
+                for row, event in batch:
+                    if event is not None:
+                        self.aggregator.apply(conn, event)
+            self.written += len(batch)
+        except sqlite3.Error as e:
+            print(e)
+
+    # Write out everything that's pending, and stop the thread
+    def close(self, timeout=10):
+        self.pending.put(self.STOP)
+        self.join(timeout)
+
+    def stats(self):
+        return {
+            "pending": self.pending.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+        }
+
+# Keeps a log table from growing forever.
+# Log rows are bucketed by the (UTC) day they were written on, using the timestamp index.
+# Once a day is more than keep_days old, its rows are (optionally) archived to
+# <archive_path>/<table>-<day>.jsonl.gz, and then deleted a chunk at a time, so that the log writer
+# is never locked out for long. Freed pages are then given back to the filesystem a few at a time.
+# Runs every interval seconds on its own thread and connection.
+class LogRetention(threading.Thread):
+    def __init__(self, filename, log_table, keep_days=30, archive_path=None, interval=3600, chunk_rows=1000, vacuum_pages=1000):
+        super(LogRetention, self).__init__(name="LogRetention-{}".format(log_table))
+        self.daemon = True
+        self.filename = filename
+        self.log_table = log_table
+        self.keep_days = keep_days
+        self.archive_path = os.path.expandvars(archive_path) if archive_path else None
+        self.interval = interval
+        self.chunk_rows = chunk_rows
+        self.vacuum_pages = vacuum_pages
+        self.stopping = threading.Event()
+        self.archived = 0
+        self.deleted = 0
+
+    def run(self):
+        conn = connect(self.filename)
+        conn.row_factory = sqlite3.Row
+        while not self.stopping.is_set():
+            try:
+                self.expire(conn)
+                self.compact(conn)
+            except (sqlite3.Error, IOError, OSError) as e:
+                print(e)
+            self.stopping.wait(self.interval)
+        conn.close()
+
+    # The oldest day that still has rows, if it is older than keep_days
+    def oldest_expired_day(self, conn):
+        row = conn.execute("""SELECT date(MIN(timestamp)) < date('now', ?), date(MIN(timestamp))
+            FROM {table};""".format(table=self.log_table), ("-{0} days".format(int(self.keep_days)),)).fetchone()
+        if row[1] is None or not row[0]:
+            return None
+        return row[1]
+
+    def expire(self, conn):
+        while not self.stopping.is_set():
+            day = self.oldest_expired_day(conn)
+            if day is None:
+                return
+            if self.archive_path is not None:
+                self.archive(conn, day)
+            self.delete(conn, day)
+
+    def archive(self, conn, day):
+        if not os.path.isdir(self.archive_path):
+            os.makedirs(self.archive_path)
+        base = os.path.join(self.archive_path, "{0}-{1}".format(self.log_table, day))
+        # Don't overwrite the archive of a day we were interrupted part way through deleting
+        filename = base + ".jsonl.gz"
+        n = 0
+        while os.path.exists(filename):
+            n += 1
+            filename = "{0}.{1}.jsonl.gz".format(base, n)
+        rows = conn.execute("""SELECT * FROM {table}
+            WHERE timestamp >= ? AND timestamp < date(?, '+1 day') ORDER BY pk;""".format(table=self.log_table), (day, day))
+        f = gzip.open(filename + ".tmp", "wb")
+        try:
+            for r in rows:
+                f.write(json.dumps(row_dict(r)) + "\n")
+                self.archived += 1
+        finally:
+            f.close()
+        os.rename(filename + ".tmp", filename)
+
+    # Delete everything up to the end of the given day, in chunks
+    def delete(self, conn, day):
+        sql = """DELETE FROM {table} WHERE pk IN
+            (SELECT pk FROM {table} WHERE timestamp < date(?, '+1 day') LIMIT ?);""".format(table=self.log_table)
+        while True:
+            with conn:
+                n = conn.execute(sql, (day, self.chunk_rows)).rowcount
+            self.deleted += n
+            if n < self.chunk_rows:
+                return
+            # Give the log writer a chance at the database
+            time.sleep(0.01)
+
+    def compact(self, conn):
+        # Databases created before auto_vacuum was turned on keep their free pages for reuse instead
+        if conn.execute("PRAGMA auto_vacuum;").fetchone()[0] != 2:
+            return
+        conn.execute("PRAGMA incremental_vacuum({0});".format(int(self.vacuum_pages))).fetchall()
+
+    def close(self, timeout=10):
+        self.stopping.set()
+        self.join(timeout)
+
+    def stats(self):
+        return {
+            "archived": self.archived,
+            "deleted": self.deleted,
+        }
+
+# Answers history queries (see history_page) on its own thread and read-only connection,
+# so that a long scan over the logs never holds up the log writer or the IOLoop.
+class LogReader(threading.Thread):
+    def __init__(self, filename, log_table):
+        super(LogReader, self).__init__(name="LogReader-{}".format(log_table))
+        self.daemon = True
+        self.filename = filename
+        self.log_table = log_table
+        # (filters, callback) pairs; None to stop
+        self.requests = Queue.Queue()
+
+    def query(self, callback, **filters):
+        self.requests.put((filters, callback))
+
+    def run(self):
+        conn = connect(self.filename)
+        conn.row_factory = sqlite3.Row
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            filters, callback = request
+            try:
+                result = history_page(conn, self.log_table, **filters)
+            except Exception as e:
+                callback(None, e)
+            else:
+                callback(result, None)
+        conn.close()
+
+    def close(self, timeout=10):
+        self.requests.put(None)
+        self.join(timeout)
+
+# The most entries returned in one page of history
+max_history_page = 500
+
+# One page of a log table, newest first.
+# Pass the "next" value of a page as before to get the page after it; it is None on the last page.
+# With after instead of before, entries are returned oldest first, starting after that pk
+# (so a client can follow new entries as they are logged); then pass "next" back as after instead.
+# since and until are timestamps ("YYYY-MM-DD HH:MM:SS", UTC), inclusive and exclusive respectively.
+# queue limits the page to the rows of one queue of a multi-queue.
+def history_page(conn, log_table, uid=None, namespace=None, queue=None, since=None, until=None, before=None, after=None, limit=100):
+    limit = max(1, min(int(limit), max_history_page))
+    where = []
+    params = []
+    for column, op, value in (("uid", "=", uid), ("namespace", "=", namespace), ("queue", "=", queue),
+                              ("timestamp", ">=", since), ("timestamp", "<", until),
+                              ("pk", "<", before), ("pk", ">", after)):
+        if value is not None:
+            where.append("{0} {1} ?".format(column, op))
+            params.append(value)
+    sql = "SELECT pk, uid, namespace, queue, timestamp, input_json, output_json FROM {0}".format(log_table)
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY pk {0} LIMIT ?;".format("ASC" if after is not None else "DESC")
+    params.append(limit)
+    entries = []
+    for r in conn.execute(sql, params):
+        entries.append({
+            "pk": r["pk"],
+            "uid": r["uid"],
+            "namespace": r["namespace"],
+            "queue": r["queue"],
+            "timestamp": r["timestamp"],
+            "command": json.loads(r["input_json"]),
+            "response": json.loads(r["output_json"]),
+        })
+    next_pk = None
+    if len(entries) == limit:
+        next_pk = entries[-1]["pk"]
+    return {"entries": entries, "next": next_pk}
+
 class Database(object):
-    def __init__(self, filename=None, log_table=None):
+    def __init__(self, filename=None, log_table=None, aggregator=None):
         if filename is None:
             try:
                 filename = settings.log_database_path
             except:
                 filename = ":memory:"
 
-        self.conn = sqlite3.connect(filename)
+        self.conn = connect(filename)
         self.conn.row_factory = sqlite3.Row
         #XXX check to make sure that log_table is 'safe'
         self.log_table = log_table
+        self.writer = None
+        self.retention = None
+        self.reader = None
+        # Keeps the top_* tables up to date as commands are logged (see TopAggregator)
+        self.aggregator = aggregator
+        if self.aggregator is not None:
+            self.create_top_schema()
         if self.log_table is not None:
+            self.insert_sql = log_insert_sql(self.log_table)
             self.create_log_schema()
+            # An in-memory database can't be shared with another connection
+            writer_settings = settings.get("log_writer", {})
+            if writer_settings is not False and filename != ":memory:":
+                self.writer = LogWriter(filename, self.log_table, aggregator=self.aggregator, **writer_settings)
+                self.writer.start()
+            retention_settings = settings.get("log_retention", False)
+            if retention_settings is not False and filename != ":memory:":
+                self.retention = LogRetention(filename, self.log_table, **retention_settings)
+                self.retention.start()
+            if filename != ":memory:":
+                self.reader = LogReader(filename, self.log_table)
+                self.reader.start()
 
     def execute(self, _sql_command, **kwargs):
         try:
@@ -33,32 +459,103 @@ class Database(object):
     def commit(self):
         return self.conn.commit()
 
-    def log(self, uid, namespace, command, response, raw=False):
+    def log(self, uid, namespace, command, response, raw=False, queue=None):
         if raw:
             input_json = command
             output_json = response
         else:
             input_json = json.dumps(command)
             output_json = json.dumps(response)
-        self.execute("INSERT INTO {} (uid, namespace, input_json, output_json) VALUES (:uid, :nspace, :input_json, :output_json);".format(self.log_table),
-                     uid=uid, nspace=namespace, input_json=input_json, output_json=output_json)
+        event = None
+        if self.aggregator is not None:
+            event = self.aggregator.extract(uid, namespace, command, response, queue)
+        if self.writer is not None:
+            self.writer.put((uid, namespace, input_json, output_json, queue), event)
+            return
+        try:
+            self.conn.execute(self.insert_sql, (uid, namespace, input_json, output_json, queue))
+            if event is not None:
+                self.aggregator.apply(self.conn, event)
+        except sqlite3.OperationalError as e:
+            print(e)
 
         self.commit()
 
+    # The n most played items in a category (module type).
+    # If window_days is given, only plays in the last window_days days (including today) count.
+    # Reads only the top_* tables, so it costs about the same however long the logs are.
+    # If queue is given, only plays on that queue of a multi-queue count.
+    def top_items(self, category, n=10, window_days=None, queue=None):
+        if queue is not None:
+            # Counted from the modules played on the queue, which are in top_item_module
+            since = "-{0} days".format(int(window_days)) if window_days is not None else None
+            rows = self.conn.execute("""SELECT i.canonical_id, i.url, i.description, i.requeue_command, COUNT(*) AS plays, MAX(m.played_timestamp) AS last_played
+                FROM top_item_module m JOIN top_item i ON i.pk = m.item_pk JOIN top_category c ON c.pk = i.category_pk
+                WHERE m.queue = ? AND m.played_timestamp IS NOT NULL AND c.slug = ?
+                AND (? IS NULL OR m.played_timestamp > date('now', ?))
+                GROUP BY m.item_pk
+                ORDER BY plays DESC LIMIT ?;""", (queue, category, since, since, n))
+        elif window_days is None:
+            rows = self.conn.execute("""SELECT i.canonical_id, i.url, i.description, i.requeue_command, i.play_count AS plays, i.last_played
+                FROM top_item i JOIN top_category c ON c.pk = i.category_pk
+                WHERE c.slug = ? AND i.play_count > 0
+                ORDER BY i.play_count DESC LIMIT ?;""", (category, n))
+        else:
+            rows = self.conn.execute("""SELECT i.canonical_id, i.url, i.description, i.requeue_command, SUM(d.plays) AS plays, i.last_played
+                FROM top_item_daily d JOIN top_item i ON i.pk = d.item_pk JOIN top_category c ON c.pk = d.category_pk
+                WHERE c.slug = ? AND d.day > date('now', ?)
+                GROUP BY d.item_pk
+                ORDER BY plays DESC LIMIT ?;""", (category, "-{0} days".format(int(window_days)), n))
+        return [row_dict(r) for r in rows]
+
+    # Look up a page of the log (see history_page), and call callback(result, error) with it.
+    # Unless the database is in memory, the callback is called from another thread.
+    def history(self, callback, **filters):
+        if self.reader is not None:
+            self.reader.query(callback, **filters)
+            return
+        try:
+            result = history_page(self.conn, self.log_table, **filters)
+        except Exception as e:
+            callback(None, e)
+        else:
+            callback(result, None)
+
+    # Flush any pending log rows and close the database
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        if self.retention is not None:
+            self.retention.close()
+            self.retention = None
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.conn.close()
+
     #def queue_log(self, action, target, raw_command=''):
     #    self.execute("INSERT INTO queue (action, target, command) VALUES (:action, :target, :command);",
     #                 action=action, target=target, command=json.dumps(raw_command))
 
     def create_log_schema(self):
-        self.execute("""CREATE TABLE IF NOT EXISTS {} (
-            pk INTEGER PRIMARY KEY,
-            uid TEXT,
-            namespace TEXT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            input_json TEXT,
-            output_json TEXT
-        );""".format(self.log_table))
-        self.commit()
+        self.migrate(self.log_table, log_migrations)
+
+    # Bring the named table up to the latest version in migrations.
+    # The version of each table is kept in schema_version; tables from before it existed start at 0.
+    # Errors are raised rather than printed, so that we don't run on a half-upgraded schema.
+    def migrate(self, name, migrations):
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS schema_version (
+            name TEXT PRIMARY KEY,
+            version INTEGER
+        );""")
+        row = self.conn.execute("SELECT version FROM schema_version WHERE name = ?;", (name,)).fetchone()
+        version = row[0] if row is not None else 0
+        for i in range(version, len(migrations)):
+            with self.conn:
+                for statement in migrations[i]:
+                    self.conn.execute(statement.format(table=name))
+                self.conn.execute("INSERT OR REPLACE INTO schema_version (name, version) VALUES (?, ?);", (name, i + 1))
 
     def destroy_top_schema(self):
         self.execute("DROP TABLE IF EXISTS top_module")
@@ -67,6 +564,9 @@ class Database(object):
         self.execute("DROP TABLE IF EXISTS top_item")
         self.execute("DROP TABLE IF EXISTS top_log_entry")
         self.execute("DROP TABLE IF EXISTS top_module_log_entry")
+        self.execute("DROP TABLE IF EXISTS top_item_daily")
+        self.execute("DROP TABLE IF EXISTS top_item_module")
+        self.execute("DELETE FROM schema_version WHERE name = 'top'")
         self.commit()
 
     def create_top_schema(self):
@@ -118,3 +618,4 @@ class Database(object):
             log_type TEXT
         );""")
         self.commit()
+        self.migrate("top", top_migrations)
@@ -0,0 +1,111 @@
+# An ordered collection of (uid, obj) pairs, with constant-time lookup, removal and reordering by uid.
+# Iterating over it gives (uid, obj) pairs in order, like the list of pairs it replaces.
+#
+# It's a doubly-linked list of [prev, next, uid, obj] links, plus a dict from uid to link.
+# Everything removed is also recorded, until collected with take_removed(), so that whoever keeps
+# modules in sync with the queue doesn't have to diff the whole queue to find out what went away.
+
+PREV, NEXT, UID, OBJ = 0, 1, 2, 3
+
+class IndexedQueue(object):
+    def __init__(self, items=()):
+        # root is a sentinel: root[NEXT] is the first link, and root[PREV] the last
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+        self.links = {}
+        self.removed = []
+        for uid, obj in items:
+            self.append(uid, obj)
+
+    def __len__(self):
+        return len(self.links)
+
+    def __nonzero__(self):
+        return bool(self.links)
+
+    def __contains__(self, uid):
+        return uid in self.links
+
+    def __getitem__(self, uid):
+        return self.links[uid][OBJ]
+
+    def get(self, uid, default=None):
+        link = self.links.get(uid)
+        if link is None:
+            return default
+        return link[OBJ]
+
+    def __iter__(self):
+        link = self.root[NEXT]
+        while link is not self.root:
+            # Fetch the next link first, so that the current one may be removed while iterating
+            next_link = link[NEXT]
+            yield (link[UID], link[OBJ])
+            link = next_link
+
+    def uids(self):
+        return [uid for uid, obj in self]
+
+    # The first (uid, obj) pair, or None if the queue is empty
+    def first(self):
+        link = self.root[NEXT]
+        if link is self.root:
+            return None
+        return (link[UID], link[OBJ])
+
+    # Every pair but the first
+    def rest(self):
+        it = iter(self)
+        next(it, None)
+        return it
+
+    def append(self, uid, obj):
+        if uid in self.links:
+            raise KeyError("Duplicate uid: {0}".format(uid))
+        last = self.root[PREV]
+        link = [last, self.root, uid, obj]
+        last[NEXT] = link
+        self.root[PREV] = link
+        self.links[uid] = link
+
+    def unlink(self, link):
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+
+    # Remove uid, if it is in the queue. Returns whether it was.
+    def discard(self, uid):
+        link = self.links.pop(uid, None)
+        if link is None:
+            return False
+        self.unlink(link)
+        self.removed.append((uid, link[OBJ]))
+        return True
+
+    def clear(self):
+        self.removed.extend(self)
+        self.root[:] = [self.root, self.root, None, None]
+        self.links = {}
+
+    # Move the given uids to the front of the queue, in the given order.
+    # Uids that aren't in the queue are ignored; everything else keeps its order.
+    def move_to_front(self, uids):
+        # If a uid is given more than once, its first position counts
+        seen = set()
+        links = []
+        for uid in uids:
+            if uid in self.links and uid not in seen:
+                seen.add(uid)
+                links.append(self.links[uid])
+        for link in reversed(links):
+            self.unlink(link)
+            first = self.root[NEXT]
+            link[PREV] = self.root
+            link[NEXT] = first
+            first[PREV] = link
+            self.root[NEXT] = link
+
+    # Returns everything removed since the last call, in the order it was removed
+    def take_removed(self):
+        removed = self.removed
+        self.removed = []
+        return removed
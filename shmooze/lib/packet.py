@@ -1,7 +1,10 @@
 import json
 
-def error(err):
-    return {'success':False,'error':err}
+# Any extra fields (e.g. retry_after) are added to the response
+def error(err,**extra):
+    response={'success':False,'error':err}
+    response.update(extra)
+    return response
 
 def good(payload=None):
     if payload is not None:
@@ -22,4 +25,14 @@ def assert_success(response):
         raise Exception("Malformed response")
     raise Exception(response['error'])
 
+# A response which may be sent many times, which remembers how it was encoded by each codec (see shmooze.lib.codec)
+# It must not be changed once it has been sent.
+class Cached(dict):
+    def __init__(self,response):
+        dict.__init__(self,response)
+        self.encodings={}
 
+    def encoded(self,codec_name,encode):
+        if codec_name not in self.encodings:
+            self.encodings[codec_name]=encode(self)
+        return self.encodings[codec_name]
@@ -3,14 +3,24 @@ from tornado.gen import *
 from tornado.concurrent import *
 import tornado.iostream
 import tornado.ioloop
+import tornado.netutil
 import itertools
+import errno
+import collections
 import json
 import traceback
 import time
+import shmooze.lib.admission as admission
+import shmooze.lib.codec as codec
 import shmooze.lib.packet as packet
+import shmooze.lib.stats as stats
+import shmooze.lib.transport as transport
+import shmooze.settings as settings
 from toro import *
 import datetime
 import socket
+import signal
+import uuid
 
 ioloop=tornado.ioloop.IOLoop.instance()
 
@@ -35,19 +45,104 @@ def accept(sock):
     finally:
         ioloop.remove_handler(sock.fileno())
 
-@coroutine
-def wait(proc):
-    poll_period=datetime.timedelta(milliseconds=10)
-    while True:
+# A single listening socket that spawned processes connect back to,
+# instead of a fresh listening socket per connection.
+# Each process is given a one-time token, and starts each of its connections with a line "<token> <channel>".
+# The connection is then handed to whoever is expecting that token and channel.
+class Rendezvous(tornado.tcpserver.TCPServer):
+    handshake_timeout=datetime.timedelta(milliseconds=2000)
+
+    def __init__(self,host='localhost'):
+        tornado.tcpserver.TCPServer.__init__(self)
+        socks=tornado.netutil.bind_sockets(0,host,family=socket.AF_INET)
+        self.add_sockets(socks)
+        self.host=host
+        self.port=socks[0].getsockname()[1]
+        # (token, channel) -> Future for the stream
+        self.expecting={}
+
+    # Returns a new token, and a future for the IOStream of each of the given channels
+    def expect(self,channels):
+        token=uuid.uuid4().hex
+        futures=[]
+        for channel in channels:
+            f=Future()
+            self.expecting[(token,channel)]=f
+            futures.append(f)
+        return token,futures
+
+    # Stop expecting connections for a token, e.g. because the process never connected
+    def cancel(self,token):
+        for key in [key for key in self.expecting if key[0] == token]:
+            del self.expecting[key]
+
+    @coroutine
+    def handle_stream(self,stream,address):
+        try:
+            line = yield with_timeout(self.handshake_timeout,stream.read_until('\n',max_bytes=256))
+            token,channel = line.split()
+            f = self.expecting.pop((token,channel))
+        except Exception:
+            # Unknown token, bad handshake or whatever; this isn't one of ours
+            stream.close()
+            return
+        if not f.done():
+            f.set_result(stream)
+
+# Keeps track of child processes that someone is waiting on,
+# and reaps them when SIGCHLD arrives instead of polling on a timer.
+class ChildReaper(object):
+    def __init__(self):
+        # pid -> (proc, [futures waiting on it])
+        self.waiting={}
+        self.installed=False
+        self.previous_handler=None
+
+    # Must be called from the main thread (which is where the IOLoop runs)
+    def install(self):
+        if self.installed:
+            return
+        self.previous_handler=signal.signal(signal.SIGCHLD,self.handle_sigchld)
+        # Restart system calls interrupted by SIGCHLD, rather than failing them with EINTR
+        # (as they would in the log, snapshot and other background threads whenever a module exits)
+        signal.siginterrupt(signal.SIGCHLD,False)
+        self.installed=True
+
+    def handle_sigchld(self,signum,frame):
+        ioloop.add_callback_from_signal(self.reap)
+        if callable(self.previous_handler):
+            self.previous_handler(signum,frame)
+
+    # Returns a future which resolves to the return code of proc once it has exited
+    def watch(self,proc):
+        self.install()
+        f=Future()
+        if proc.pid not in self.waiting:
+            self.waiting[proc.pid]=(proc,[])
+        self.waiting[proc.pid][1].append(f)
+        # The process may have died before we started watching it
+        self.reap_one(proc.pid)
+        return f
+
+    # Only the processes we are waiting on are reaped, so other users of subprocess aren't affected
+    def reap(self):
+        for pid in self.waiting.keys():
+            self.reap_one(pid)
+
+    def reap_one(self,pid):
+        proc,futures=self.waiting[pid]
         p=proc.poll()
-        if p is not None:
-            raise Return(p)
+        if p is None:
+            return
+        del self.waiting[pid]
+        for f in futures:
+            if not f.done():
+                f.set_result(p)
 
-        @return_future
-        def pause(callback):
-            ioloop.add_timeout(poll_period,callback)
+reaper=ChildReaper()
 
-        yield pause()
+def wait(proc):
+    return reaper.watch(proc)
 
 def connection_ready(sock, fd, events):
     while True:
@@ -60,14 +155,56 @@ def connection_ready(sock, fd, events):
         connection.setblocking(0)
         handle_connection(connection, address)
 
+# If a single command carries an "id", echo it back on the reply
+# so that pipelining clients can match up responses.
+def tag_response(query,response):
+    if isinstance(query,dict) and 'id' in query and isinstance(response,dict):
+        response=dict(response)
+        response['id']=query['id']
+    return response
+
+# Work out which codec the other end of a stream is speaking, from the first byte it sends.
+# Returns the codec, and the bytes that were consumed doing so.
 @coroutine
-def listen_for_commands(stream,handle_cr,over_fn=None):
+def negotiate(stream):
+    first = yield stream.read_bytes(1)
+    raise Return((codec.detect(first),first))
+
+# Read one message from a stream.
+# prefix is anything already read from the start of the message (see negotiate)
+@coroutine
+def read_message(stream,msg_codec,prefix=''):
+    if msg_codec.framed:
+        header = prefix
+        if len(header) < msg_codec.header_size:
+            header += yield stream.read_bytes(msg_codec.header_size-len(header))
+        data = yield stream.read_bytes(msg_codec.frame_length(header))
+    else:
+        data = yield stream.read_until(msg_codec.delimiter)
+        data = prefix+data
+    raise Return(msg_codec.decode(data))
+
+# Read commands from a stream and write back responses, in whichever codec the other end uses.
+# With pipeline_depth=1, each command is run to completion before the next one is read.
+# With a larger pipeline_depth, up to that many commands from the same connection are read ahead,
+# and responses are still written back in the order that the requests came in.
+# Commands for which read_only(command) is true may run at the same time as each other;
+# any other command runs alone, after everything before it has finished (as in JSONCommandProcessor.multiple_commands).
+@coroutine
+def listen_for_commands(stream,handle_cr,over_fn=None,pipeline_depth=1,read_only=None):
+    if pipeline_depth > 1:
+        yield listen_for_pipelined_commands(stream,handle_cr,pipeline_depth,read_only or (lambda query: False))
+        if over_fn:
+            over_fn()
+        return
+
     try:
+        msg_codec,prefix = yield negotiate(stream)
         while True:
-            data = yield stream.read_until('\n')
-            parsed = json.loads(data)
+            parsed = yield read_message(stream,msg_codec,prefix)
+            prefix = ''
             response = yield handle_cr(parsed)
-            encoded = json.dumps(response)+'\n'
+            encoded = msg_codec.encode(tag_response(parsed,response))
             yield stream.write(encoded)
     except tornado.iostream.StreamClosedError:
         pass
@@ -81,48 +218,381 @@ def listen_for_commands(stream,handle_cr,over_fn=None):
         over_fn()
 
 @coroutine
-def json_query(addr,port,inp,timeout=2):
+def listen_for_pipelined_commands(stream,handle_cr,pipeline_depth,read_only):
+    # Each slot is one command that has been read but whose response hasn't been written yet
+    slots=Semaphore(pipeline_depth)
+    # Futures for responses, in request order. None marks the end of the stream.
+    pending=Queue()
+    # The last command that wasn't read-only, and the read-only commands started since then
+    barrier=None
+    running=[]
+
+    # Run a command once the commands it has to wait for have finished (whether or not they succeeded)
     @coroutine
-    def talk(stream):
-        yield stream.connect((addr,port))
-        encoded = json.dumps(inp)+'\n'
-        yield stream.write(encoded)
-        data = yield stream.read_until('\n')
-        decoded = json.loads(data)
-        raise Return(decoded)
-
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    stream = tornado.iostream.IOStream(s)
+    def run(parsed,after):
+        for f in after:
+            try:
+                yield f
+            except Exception:
+                pass
+        response = yield handle_cr(parsed)
+        raise Return(tag_response(parsed,response))
+
+    @coroutine
+    def write_responses(msg_codec):
+        try:
+            while True:
+                f = yield pending.get()
+                if f is None:
+                    break
+                try:
+                    response = yield f
+                    encoded = msg_codec.encode(response)
+                    yield stream.write(encoded)
+                finally:
+                    slots.release()
+        except tornado.iostream.StreamClosedError:
+            pass
+        except Exception:
+            print "Communication exception!"
+            traceback.print_exc()
+            print "(communication interrupted)"
+        finally:
+            stream.close()
+            # The reader may be waiting for a slot; wake it so that it finds the stream closed
+            slots.release()
+
+    writer = None
     try:
-        result = yield with_timeout(datetime.timedelta(seconds=timeout),talk(stream))
-    finally:
+        msg_codec,prefix = yield negotiate(stream)
+        writer = write_responses(msg_codec)
+        while True:
+            yield slots.acquire()
+            # The writer closes the stream if it fails; don't run commands that were read ahead but can't be answered
+            if stream.closed():
+                break
+            parsed = yield read_message(stream,msg_codec,prefix)
+            prefix = ''
+            after = [barrier] if barrier is not None else []
+            if read_only(parsed):
+                f = run(parsed,after)
+                running.append(f)
+            else:
+                f = run(parsed,after+running)
+                barrier = f
+                running = []
+            pending.put(f)
+    except tornado.iostream.StreamClosedError:
+        slots.release()
+    except Exception:
+        slots.release()
+        print "Communication exception!"
+        traceback.print_exc()
+        print "(communication interrupted)"
+    if writer is None:
         stream.close()
+        return
+    # Let any commands that are still running finish up before closing the stream
+    pending.put(None)
+    yield writer
+
+# Raised by PooledConnection.query for a request that was never written to the connection,
+# which makes it safe to send again on another one
+class RequestNotSent(tornado.iostream.StreamClosedError):
+    pass
+
+# A client connection to a shmooze service.
+# Several requests may be outstanding on it at once; responses come back in request order.
+class PooledConnection(object):
+    def __init__(self,addr,port,msg_codec):
+        self.codec = msg_codec
+        s, address = transport.client_socket(addr,port)
+        self.stream = tornado.iostream.IOStream(s)
+        self.connected = self.stream.connect(address)
+        # Futures for responses that haven't been read yet, in request order
+        self.waiting = collections.deque()
+        self.last_used = time.time()
+
+    def closed(self):
+        return self.stream.closed()
+
+    # Whether the connection can take another request.
+    # The other end may have closed it while it was idle, which the stream won't notice until it next reads,
+    # so peek at the socket: an idle connection should have nothing to read yet.
+    def alive(self):
+        if self.stream.closed():
+            return False
+        if self.waiting or not self.connected.done():
+            return True
+        try:
+            self.stream.socket.recv(1,socket.MSG_PEEK)
+        except socket.error as e:
+            return e.args[0] in (errno.EAGAIN,errno.EWOULDBLOCK)
+        # Either the connection was closed, or the other end sent something that wasn't asked for
+        return False
+
+    def close(self):
+        self.stream.close()
+
+    @coroutine
+    def query(self,inp):
+        f = Future()
+        self.waiting.append(f)
+        self.last_used = time.time()
+        if len(self.waiting) == 1:
+            ioloop.add_future(self.read_responses(),lambda f: None)
+        try:
+            yield self.connected
+            if self.stream.closed():
+                raise tornado.iostream.StreamClosedError()
+        except Exception as e:
+            # No response is coming for a request that wasn't sent
+            if f in self.waiting:
+                self.waiting.remove(f)
+            elif f.done():
+                f.exception() # read_responses already failed it; the error is passed on here instead
+            raise RequestNotSent(e)
+        try:
+            encoded = self.codec.encode(inp)
+            yield self.stream.write(encoded)
+        except tornado.iostream.StreamClosedError:
+            pass # read_responses will pass the error on through f
+        response = yield f
+        raise Return(response)
+
+    @coroutine
+    def read_responses(self):
+        try:
+            yield self.connected
+            while self.waiting:
+                response = yield read_message(self.stream,self.codec)
+                f = self.waiting.popleft()
+                self.last_used = time.time()
+                if not f.done():
+                    f.set_result(response)
+        except Exception as e:
+            self.close()
+            while self.waiting:
+                f = self.waiting.popleft()
+                if not f.done():
+                    f.set_exception(e)
+
+# Keeps connections to shmooze services open so that json_query doesn't need a new connection each time.
+# A port of None means addr is the path of a unix socket (see transport.service_address)
+class ConnectionPool(object):
+    def __init__(self,max_connections=4,max_pipeline=8,max_idle=datetime.timedelta(seconds=60),wire_codec=None):
+        # Codec that requests are sent in (see shmooze.lib.codec)
+        self.codec = codec.get(wire_codec or transport.wire_codec)
+        # Maximum number of open connections to a single service
+        self.max_connections = max_connections
+        # Requests outstanding on a connection before another one is opened
+        self.max_pipeline = max_pipeline
+        # Idle connections are closed after this long
+        self.max_idle = max_idle
+        # (addr,port) -> [PooledConnection]
+        self.connections = {}
+        self.hits = 0
+        self.misses = 0
+        self.retries = 0
+
+    # Drop connections which have been closed, or that have been idle for too long
+    def check_health(self,key):
+        now = time.time()
+        healthy = []
+        for conn in self.connections.get(key,[]):
+            if not conn.waiting and now - conn.last_used > self.max_idle.total_seconds():
+                conn.close()
+            elif not conn.alive():
+                conn.close()
+            if not conn.closed():
+                healthy.append(conn)
+        self.connections[key] = healthy
+        return healthy
+
+    def get(self,addr,port):
+        conns = self.check_health((addr,port))
+        best = min(conns,key=lambda c: len(c.waiting)) if conns else None
+        if best is not None and (len(best.waiting) < self.max_pipeline or len(conns) >= self.max_connections):
+            self.hits += 1
+            return best
+        self.misses += 1
+        return self.connect(addr,port)
+
+    # Open a new connection, and add it to the pool
+    def connect(self,addr,port):
+        conn = PooledConnection(addr,port,self.codec)
+        self.connections.setdefault((addr,port),[]).append(conn)
+        return conn
+
+    @coroutine
+    def query(self,addr,port,inp,timeout=2):
+        conn = self.get(addr,port)
+        try:
+            result = yield self.query_on(conn,inp,timeout)
+        except RequestNotSent:
+            # The connection closed before the request went out; try once more on a new one.
+            # Requests that were sent are never retried (even if the connection closed because another request timed out),
+            # since the service may have run them.
+            self.retries += 1
+            result = yield self.query_on(self.connect(addr,port),inp,timeout)
+        raise Return(result)
+
+    @coroutine
+    def query_on(self,conn,inp,timeout):
+        try:
+            result = yield with_timeout(datetime.timedelta(seconds=timeout),conn.query(inp),quiet_exceptions=(tornado.iostream.StreamClosedError,))
+        except Exception:
+            # Whatever went wrong, this connection can no longer be trusted to line up responses
+            conn.close()
+            raise
+        raise Return(result)
+
+    def close(self):
+        for conns in self.connections.values():
+            for conn in conns:
+                conn.close()
+        self.connections = {}
+
+    def stats(self):
+        conns = [conn for conns in self.connections.values() for conn in conns if not conn.closed()]
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'retries': self.retries,
+            'open': len(conns),
+            'in_flight': sum([len(conn.waiting) for conn in conns]),
+        }
+
+client_pool = ConnectionPool()
+
+# Send a command to a shmooze service and return its response.
+# Connections are reused through client_pool unless another pool is given.
+@coroutine
+def json_query(addr,port,inp,timeout=2,pool=None):
+    if pool is None:
+        pool = client_pool
+    result = yield pool.query(addr,port,inp,timeout)
     raise Return(result)
 
 class Service(tornado.tcpserver.TCPServer):
+    # How many commands from a single connection may be run at once (see listen_for_commands)
+    pipeline_depth=1
+    # Name of the service in settings.ports; when set, the service also listens on a unix socket
+    # if the unix transport is configured
+    name=None
+
     def __init__(self,port=None):
         if port is not None:
             self.port = port
         tornado.tcpserver.TCPServer.__init__(self)
+        # TCP is always available, for remote clients
         self.listen(self.port)
+        if self.name is not None and transport.use_unix():
+            path = transport.prepare_service_socket(self.name)
+            self.add_socket(tornado.netutil.bind_unix_socket(path))
 
     # Override this
+    # client is the address of the peer that sent the query ('local' for unix sockets)
     @coroutine
-    def command(self,query):
+    def command(self,query,client=None):
         raise Return(query)
 
+    # Override this
+    # Whether a query doesn't change any state, and so may be run at the same time as others from the same connection
+    def read_only(self,query):
+        return False
+
     def handle_stream(self,stream,address):
-        return listen_for_commands(stream,self.command)
+        client=address[0] if isinstance(address,tuple) and address else 'local'
+        def handle_cr(query):
+            return self.command(query,client=client)
+        return listen_for_commands(stream,handle_cr,pipeline_depth=self.pipeline_depth,read_only=self.read_only)
+
+# A version number for the state of a service, which goes up every time the state changes.
+# Clients pass the last version they saw to find out what changed since, or to wait for a change.
+class StateVersion(object):
+    # Longest a client may wait for a change, in seconds
+    max_wait=60
+
+    def __init__(self):
+        self.version=0
+        self.condition=Condition()
+
+    def bump(self):
+        self.version+=1
+        self.condition.notify_all()
+        return self.version
+
+    # Wait until the version is newer than since_version, or timeout seconds pass.
+    # Returns the current version.
+    @coroutine
+    def wait(self,since_version,timeout):
+        deadline=ioloop.time()+min(timeout,self.max_wait)
+        while self.version <= since_version:
+            try:
+                yield self.condition.wait(deadline)
+            except Timeout:
+                break
+        raise Return(self.version)
+
+# Responses to read-only commands (see JSONCommandProcessor.cached_cmds), kept for as long as the state they describe is current.
+# Responses are kept as packet.Cached, so each is only encoded once per codec, however many clients it is sent to.
+class ResponseCache(object):
+    # Most (command, arguments) pairs kept at once; past that, the cache starts over
+    max_entries=64
+
+    def __init__(self,state):
+        # The StateVersion whose changes make cached responses stale
+        self.state=state
+        self.version=None
+        self.entries={}
+        self.hits=0
+        self.misses=0
+
+    def key(self,cmd,args):
+        return (cmd,json.dumps(args,sort_keys=True))
+
+    # The cached response for key, or None
+    def get(self,key):
+        if self.version != self.state.version:
+            self.version=self.state.version
+            self.entries={}
+        response=self.entries.get(key)
+        if response is None:
+            self.misses+=1
+        else:
+            self.hits+=1
+        return response
+
+    # Keep a response that was made at the given version, unless the state has changed since.
+    # Returns the response to send.
+    def put(self,key,version,response):
+        if version != self.state.version or not response.get('success'):
+            return response
+        if self.version != version or len(self.entries) >= self.max_entries:
+            self.version=version
+            self.entries={}
+        response=packet.Cached(response)
+        self.entries[key]=response
+        return response
+
+    def stats(self):
+        return {
+            'hits':self.hits,
+            'misses':self.misses,
+            'entries':len(self.entries),
+        }
+
+# Peers which may say which client they are passing a command on for (see JSONCommandProcessor.client_of).
+# None by default, since any local process could otherwise claim to be any client.
+client_proxies=set(settings.get("client_proxies",[]))
 
 class JSONCommandProcessor(object):
     @coroutine
-    def command(self,line):
+    def command(self,line,client=None):
         if isinstance(line,list):
             try:
-                result=[]
-                for c in line:
-                    single_result=yield self.single_command(c)
-                    result.append(single_result)
+                result=yield self.multiple_commands(line,client)
             except Exception:
                 traceback.print_exc()
                 result = packet.error("Generic multi-command processing error")
@@ -130,7 +600,7 @@ class JSONCommandProcessor(object):
                 raise Return(result)
         elif isinstance(line,dict):
             try:
-                result = yield self.single_command(line)
+                result = yield self.single_command(line,client)
             except Exception:
                 traceback.print_exc()
                 result = packet.error("Generic command processing error")
@@ -139,9 +609,37 @@ class JSONCommandProcessor(object):
         else:
             raise Return(packet.error("Command must be either dict (single command) or list (multiple commands)"))
 
+    # Run a list of commands, returning their results in the same order.
+    # Consecutive read-only commands (see read_only_cmds) are run simultaneously.
+    # Any other command acts as a barrier: it runs alone, after everything before it has finished.
+    @coroutine
+    def multiple_commands(self,lines,client=None):
+        result=[]
+        group=[]
+        for c in lines:
+            if isinstance(c,dict) and c.get('cmd') in self.read_only_cmds:
+                group.append(c)
+                continue
+            if group:
+                group_results=yield [self.single_command(g,client) for g in group]
+                result+=group_results
+                group=[]
+            single_result=yield self.single_command(c,client)
+            result.append(single_result)
+        if group:
+            group_results=yield [self.single_command(g,client) for g in group]
+            result+=group_results
+        raise Return(result)
+
+    # Whether a single command, or every command in a list, is one of read_only_cmds
+    def read_only(self,query):
+        if isinstance(query,list):
+            return all([self.read_only(q) for q in query])
+        return isinstance(query,dict) and query.get('cmd') in self.read_only_cmds
+
     # Parse and run a command
     @coroutine
-    def single_command(self,line):
+    def single_command(self,line,client=None):
         if not isinstance(line,dict):
             raise Return(packet.error('Command not a dict.'))
 
@@ -161,23 +659,116 @@ class JSONCommandProcessor(object):
         try:
             f=self.commands[cmd]
         except KeyError:
-            raise Return(packet.error('Bad command.'))
+            try:
+                f=self.builtin_commands[cmd]
+            except KeyError:
+                raise Return(packet.error('Bad command.'))
 
-        try:
-            result=yield f(self,**args)
-            result=packet.good(result)
-        except Exception as e:
-            traceback.print_exc()
-            result=packet.error(str(e))
+        if self.admission is not None:
+            charged_cmd,count=self.admission_cost(cmd,args)
+            try:
+                retry_after=self.admission.admit(self.client_of(line,client),charged_cmd,count)
+            except admission.TooLarge as e:
+                raise Return(packet.error(str(e)))
+            if retry_after is not None:
+                raise Return(packet.error('Too many requests; try again later.',retry_after=round(retry_after,3)))
+
+        start=time.time()
+        result=None
+        cache_key=None
+        if cmd in self.cached_cmds and self.response_cache is not None:
+            cache_key=self.response_cache.key(cmd,args)
+            result=self.response_cache.get(cache_key)
+        if result is None:
+            version=self.response_cache.state.version if cache_key is not None else None
+            try:
+                result=yield f(self,**args)
+                result=packet.good(result)
+            except Exception as e:
+                traceback.print_exc()
+                result=packet.error(str(e))
+            if cache_key is not None:
+                result=self.response_cache.put(cache_key,version,result)
+        stats.collector(self.stats_name()).record(cmd,time.time()-start,not result['success'])
 
         if cmd in self.log_cmds and self.logger:
             #self.logger.log({'timestamp':str(datetime.datetime.utcnow()),'id':self.log_prefix,'sent':line,'received':result})
-            self.logger.log(self.log_uid, self.log_namespace, line, result)
+            self.logger.log(self.log_uid, self.log_namespace, line, result, queue=self.log_queue)
+
+        raise Return(result)
+
+    # Who a command came from, for admission control.
+    # A peer in client_proxies (such as shmooze.wsgi) may pass commands on for other clients, naming them in a "client" field.
+    def client_of(self,line,peer):
+        if peer in client_proxies and 'client' in line:
+            return line['client']
+        return peer
 
+    # What a command is charged against admission limits as: the name of the command whose limits apply, and how many tokens it takes
+    def admission_cost(self,cmd,args):
+        if cmd in self.per_item_cmds:
+            charged_cmd,arg=self.per_item_cmds[cmd]
+            if isinstance(args.get(arg),list):
+                return charged_cmd,max(1,len(args[arg]))
+        return cmd,1
+
+    # Name that this processor's commands are counted under in shmooze.lib.stats
+    def stats_name(self):
+        return self.log_namespace or type(self).__name__
+
+    # Called from client
+    # Retrieves counts and latencies of the commands handled by this process
+    @coroutine
+    def get_stats(self):
+        result={
+            'commands':stats.summary(),
+            'connections':client_pool.stats(),
+        }
+        if self.admission is not None:
+            result['admission']=self.admission.stats()
+        if self.response_cache is not None:
+            result['response_cache']=self.response_cache.stats()
         raise Return(result)
 
+    # Called from client
+    # Retrieves a page of this processor's command log (see shmooze.lib.database.history_page)
+    # A processor that logs for one queue of a shared log only sees that queue's entries.
+    @coroutine
+    def get_history(self,**filters):
+        if self.logger is None or not hasattr(self.logger,'history'):
+            raise Exception("No command log to read")
+        if self.log_queue is not None:
+            filters['queue']=self.log_queue
+        f=Future()
+        def done(result,error):
+            if error is not None:
+                ioloop.add_callback(f.set_exception,error)
+            else:
+                ioloop.add_callback(f.set_result,result)
+        self.logger.history(done,**filters)
+        result=yield f
+        raise Return(result)
+
+    # Commands that every processor understands, in addition to its own
+    builtin_commands = {
+        'stats':get_stats,
+    }
+
     commands = {}
     log_cmds = []
+    # Commands which don't change any state, and so may be run at the same time as each other
+    read_only_cmds = []
     log_uid = None
     log_namespace = None
+    # Which queue of a shared log (see shmooze.multiqueue) this processor's entries belong to
+    log_queue = None
     logger = None
+    # Limits on who may run which commands how often (see shmooze.lib.admission), or None for no limits
+    admission = None
+    # Commands which do the work of several others, charged against admission limits once per item:
+    # command -> (command whose limits apply, argument holding the list of items)
+    per_item_cmds = {}
+    # Read-only commands whose responses are kept in response_cache (a ResponseCache, or None for no caching)
+    # Their results must depend only on their arguments and on state covered by the cache's StateVersion.
+    cached_cmds = []
+    response_cache = None
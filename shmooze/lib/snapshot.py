@@ -0,0 +1,66 @@
+import json
+import os
+import threading
+
+# Writes snapshots of a service's state to a JSON file from a background thread.
+# Only the latest snapshot matters, so if several are put while one is being written, only the last of them is written next.
+# Each write goes to a temporary file which is then renamed over the old snapshot, so a crash never leaves half a snapshot behind.
+
+class SnapshotWriter(threading.Thread):
+    def __init__(self, path):
+        super(SnapshotWriter, self).__init__(name="SnapshotWriter")
+        self.daemon = True
+        self.path = os.path.expandvars(path)
+        self.latest = None
+        self.stopping = False
+        self.condition = threading.Condition()
+        self.written = 0
+
+    def put(self, state):
+        with self.condition:
+            self.latest = state
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.latest is None and not self.stopping:
+                    self.condition.wait()
+                state = self.latest
+                self.latest = None
+            if state is None:
+                break
+            self.write(state)
+
+    def write(self, state):
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, self.path)
+            self.written += 1
+        except (IOError, OSError, TypeError, ValueError) as e:
+            print "Error writing snapshot {0}: {1}".format(self.path, e)
+
+    # Write out the latest snapshot, and stop the thread
+    def close(self, timeout=10):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.join(timeout)
+
+# The snapshot at path, or None if there isn't a readable one
+def load(path):
+    path = os.path.expandvars(path)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        if os.path.exists(path):
+            print "Error reading snapshot {0}: {1}".format(path, e)
+        return None
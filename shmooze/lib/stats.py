@@ -0,0 +1,78 @@
+import bisect
+import math
+
+# Cheap, always-on counters for the commands a process handles.
+# Collectors are kept per name (e.g. per service, or per module type) for the life of the process,
+# and are reported by the "stats" command of any JSONCommandProcessor.
+
+# Upper bounds of the latency histogram buckets, in seconds (50us, 100us, 200us, ... ~105s)
+bucket_bounds = [0.00005 * 2 ** i for i in range(22)]
+
+class LatencyHistogram(object):
+    def __init__(self):
+        # The last bucket is for anything slower than the last bound
+        self.buckets = [0] * (len(bucket_bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.buckets[bisect.bisect_left(bucket_bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    # Estimate of the p-th percentile; accurate to within a factor of two
+    def percentile(self, p):
+        if self.count == 0:
+            return None
+        target = int(math.ceil(self.count * p / 100.0))
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target:
+                break
+        if i >= len(bucket_bounds):
+            return self.max
+        return min(bucket_bounds[i], self.max)
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+        }
+
+class CommandStats(object):
+    def __init__(self):
+        # cmd -> (LatencyHistogram, number of errors)
+        self.commands = {}
+
+    def record(self, cmd, seconds, error=False):
+        if cmd not in self.commands:
+            self.commands[cmd] = [LatencyHistogram(), 0]
+        entry = self.commands[cmd]
+        entry[0].record(seconds)
+        if error:
+            entry[1] += 1
+
+    def summary(self):
+        result = {}
+        for cmd, (histogram, errors) in self.commands.items():
+            d = histogram.summary()
+            d['errors'] = errors
+            result[cmd] = d
+        return result
+
+collectors = {}
+
+def collector(name):
+    if name not in collectors:
+        collectors[name] = CommandStats()
+    return collectors[name]
+
+def summary():
+    return dict([(name, c.summary()) for name, c in collectors.items()])
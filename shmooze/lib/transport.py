@@ -0,0 +1,45 @@
+import os
+import socket
+import shmooze.settings as settings
+
+# Shmooze services (and their modules) talk to each other either over loopback TCP,
+# or, with "transport": "unix" in settings.json, over unix domain sockets.
+# Remote hosts are always reached over TCP.
+
+transport = settings.get("transport", "tcp")
+
+# Directory that holds the unix sockets of local services
+socket_path = os.path.expandvars(settings.get("socket_path", "/tmp/shmooze"))
+
+# Codec for messages between services and modules (see shmooze.lib.codec)
+wire_codec = settings.get("wire_codec", "json")
+
+local_hosts = ('localhost', '127.0.0.1', '::1', '')
+
+# Whether connections to the given host should use unix domain sockets
+def use_unix(host='localhost'):
+    return transport == 'unix' and host in local_hosts
+
+# Path of the unix socket that the named service listens on
+def service_socket(name):
+    return os.path.join(socket_path, name + '.sock')
+
+# Make sure the directory for unix sockets exists, and return the socket path of the named service
+def prepare_service_socket(name):
+    if not os.path.isdir(socket_path):
+        os.makedirs(socket_path)
+    return service_socket(name)
+
+# Where to reach the named service.
+# Returns (host, port) for TCP, or (path, None) for a unix socket.
+def service_address(name, host='localhost'):
+    if use_unix(host):
+        return (service_socket(name), None)
+    return (host, settings.ports[name])
+
+# Returns an unconnected socket for the given address (see service_address),
+# along with the address to pass to connect()
+def client_socket(addr, port):
+    if port is None:
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM), addr
+    return socket.socket(socket.AF_INET, socket.SOCK_STREAM), (addr, port)
@@ -1,2 +1,2 @@
-from module import Module
+from module import Module, PyModule
 from pymodule import ParentConnection, JSONParentPoller
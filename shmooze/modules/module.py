@@ -1,13 +1,68 @@
 import shmooze.lib.service as service
+import shmooze.lib.codec as codec
 import shmooze.lib.packet as packet
+import shmooze.lib.stats as stats
+import shmooze.lib.transport as transport
+from shmooze.modules import warm
 import socket
 import tornado.iostream
+import tornado.platform.auto
 import subprocess
 import json
+import os
 import datetime
+import time
 import traceback
 import uuid
 
+# All modules spawned by this process connect back through one listener
+rendezvous=None
+
+def get_rendezvous(host):
+    global rendezvous
+    if rendezvous is None:
+        rendezvous=service.Rendezvous(host)
+    return rendezvous
+
+# Start several modules at once. modules is a list of (module, args) pairs.
+# At most concurrency are started at a time, and any still waiting to start after deadline (a time.time()) are not started.
+# Returns a list with, for each module, None if it started, or the exception that stopped it.
+@service.coroutine
+def start_many(modules,concurrency,deadline=None):
+    slots=service.Semaphore(concurrency)
+
+    @service.coroutine
+    def start(module,args):
+        with (yield slots.acquire()):
+            if deadline is not None and time.time() > deadline:
+                raise service.Return(Exception("Ran out of time to start module"))
+            try:
+                yield module.new(args)
+            except Exception as e:
+                raise service.Return(e)
+        raise service.Return(None)
+
+    result=yield [start(module,args) for module,args in modules]
+    raise service.Return(result)
+
+# Start moving a module on a queue or pool to the given state, unless it's already headed there.
+# transitions is the set of the queue/pool's transitions that are under way; the module's is kept in it until done.
+# A module that fails to change state is terminated, which removes it from the queue/pool.
+def transition(transitions,uid,obj,target):
+    if obj.target == target and obj.reconciler is not None:
+        return
+    f=obj.transition(target)
+    if f in transitions:
+        return
+    transitions.add(f)
+    def transition_done(f):
+        transitions.discard(f)
+        if f.exception() is not None:
+            print "Error updating module {0}: {1}".format(uid,f.exception())
+            print "Removing bad module:",uid
+            obj.terminate()
+    service.ioloop.add_future(f,transition_done)
+
 # A module is an object on the queue.
 # The actual code for a module runs in a sub-process.
 # This class contains the infrastructure for starting, stopping, and communicating with that sub-process.
@@ -19,13 +74,47 @@ class Module(service.JSONCommandProcessor):
     # Hostname for connecting socket (passed to sub-process)
     # i.e. "Where does the queue process live?"
     connect_host = 'localhost'
+    # Hand the subprocess a pair of inherited unix sockets instead of having it connect back over TCP (see shmooze.lib.transport)
+    # Only for modules that understand "- cmd_fd update_fd" arguments; PyModule turns this on with the unix transport
+    use_socketpair = False
+    # Connect back through the shared rendezvous listener (see service.Rendezvous)
+    # Only for modules that understand "host port token=<token>" arguments (such as those built on shmooze.modules);
+    # otherwise modules are given "host cmd_port update_port"
+    use_rendezvous = False
+    # Codec for the command stream; passed to the subprocess in $SHMOOZE_CODEC
+    # Modules that don't read $SHMOOZE_CODEC only understand JSON, so this is JSON unless a subclass opts in,
+    # e.g. with codec = codec.get(transport.wire_codec) for a module whose process is built on shmooze.modules
+    codec = codec.get('json')
+    # Modules that pre-started processes for this module import while they wait (see shmooze.modules.warm)
+    warm_imports = []
 
     connect_timeout=datetime.timedelta(milliseconds=2000)
     cmd_write_timeout=datetime.timedelta(milliseconds=1000)
     cmd_read_timeout=datetime.timedelta(milliseconds=1000)
+    # How long play etc. wait behind prepare; a module that is slow to prepare is not killed for it (see prepare)
+    prepare_timeout=datetime.timedelta(milliseconds=2000)
     natural_death_timeout=datetime.timedelta(milliseconds=3000) # give SIGTERM after 1 sec
     sigterm_timeout=datetime.timedelta(milliseconds=5000) # give SIGKILL after 1 sec
 
+    # Called with this module whenever its parameters change (set by the queue/pool)
+    on_change=None
+    # Version of the queue/pool state when this module's parameters last changed (see service.StateVersion)
+    version=0
+    # Whether the module has been sent prepare
+    prepared=False
+    # Streams to and from the sub-process, once it has connected (see setup_connections)
+    cmd_stream=None
+    update_stream=None
+    # Future for the response to a command that timed out without the module being terminated (see send_cmd).
+    # The next command waits for it, however long it takes, and throws it away before reading its own response.
+    late_response=None
+    # The state the queue wants this module to be in: "play", "suspend" or "rm" (see transition())
+    target=None
+    # Future of the coroutine bringing the module to its target, if there is one
+    reconciler=None
+    # Shared limit on how many modules may be starting at once (an admission.SpawnLimit), or None
+    spawn_limit=None
+
     # Make a new instance of this module.
     # This constructor is fairly bare because it is not a coroutine.
     # Most of the object initialization is done in new()
@@ -38,64 +127,158 @@ class Module(service.JSONCommandProcessor):
     # Helper function for new()
     # Set up listening sockets for subprocess
     def listen(self):
+        if self.use_socketpair:
+            return self.make_socketpairs()
+        if self.use_rendezvous:
+            self.rendezvous=get_rendezvous(self.listen_host)
+            self.rendezvous_token,futures=self.rendezvous.expect(['cmd','update'])
+            return futures
         s1=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tornado.platform.auto.set_close_exec(s1.fileno())
         s1.bind((self.listen_host, 0))
         s1.listen(0)
         self.cmd_port = s1.getsockname()[1]
         s2=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tornado.platform.auto.set_close_exec(s2.fileno())
         s2.bind((self.listen_host, 0))
         s2.listen(0)
         self.update_port = s2.getsockname()[1]
         return [service.accept(s1),service.accept(s2)]
 
+    # Helper function for listen()
+    # Make connected socket pairs; one end of each is inherited by the subprocess
+    def make_socketpairs(self):
+        futures=[]
+        self.child_socks=[]
+        for i in range(2):
+            parent_sock,child_sock=socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+            # Only the subprocess for this module should inherit its end
+            tornado.platform.auto.set_close_exec(parent_sock.fileno())
+            self.child_socks.append(child_sock)
+            f=service.Future()
+            f.set_result((parent_sock,None))
+            futures.append(f)
+        return futures
+
     # Helper function for new()
+    # A pre-started process to use instead of spawning one, or None
+    def take_warm_worker(self):
+        pool=warm.get_pool(self)
+        if pool is None:
+            return None
+        return pool.take()
+
+    # Helper function for new()
+    # Replace any warm worker that was taken. This waits until the module has started (or failed to),
+    # so that starting replacements doesn't slow down modules that are starting at the same time.
+    def refill_warm_workers(self):
+        pool=warm.get_pool(self)
+        if pool is not None:
+            pool.refill()
+
     # Launch subprocess
-    def spawn(self):
-        additional_args=[self.connect_host,str(self.cmd_port),str(self.update_port)]
-        self.proc=subprocess.Popen(self.process+additional_args)
+    # If a warm worker is given, it is handed the arguments instead
+    def spawn(self,worker=None):
+        if self.use_socketpair:
+            # A host of '-' tells the subprocess that the "ports" are inherited file descriptors
+            additional_args=['-']+[str(s.fileno()) for s in self.child_socks]
+        elif self.use_rendezvous:
+            additional_args=[self.connect_host,str(self.rendezvous.port),'token='+self.rendezvous_token]
+        else:
+            additional_args=[self.connect_host,str(self.cmd_port),str(self.update_port)]
+        try:
+            if worker is not None:
+                self.proc=worker.start(additional_args)
+            else:
+                env=dict(os.environ,SHMOOZE_CODEC=self.codec.name)
+                self.proc=subprocess.Popen(self.process+additional_args,env=env)
+        finally:
+            if self.use_socketpair:
+                for s in self.child_socks:
+                    s.close()
         self.alive=True
 
+    # Helper function for new()
+    # Stop expecting the subprocess to connect. Unless it connected on every channel,
+    # close the connections that did come in, since nothing is going to use them.
+    def stop_listening(self,listen_futures,connected):
+        if self.use_rendezvous and not self.use_socketpair:
+            self.rendezvous.cancel(self.rendezvous_token)
+        if connected:
+            return
+        for f in listen_futures:
+            if not f.done() or f.exception() is not None:
+                continue
+            conn=f.result()
+            if isinstance(conn,tornado.iostream.IOStream):
+                conn.close()
+            else:
+                conn[0].close()
+
     # Helper function for new()
     # Set up IOstreams for the command and update connection objects
+    # Connections are either (socket, address) pairs, or streams handed over by the rendezvous
     def setup_connections(self,connections):
         conn1,conn2=tuple(connections)
-        self.cmd_stream = tornado.iostream.IOStream(conn1[0])
-        #self.cmd_stream.set_close_callback(self.on_disconnect)
-
-        self.update_stream = tornado.iostream.IOStream(conn2[0])
-        #self.update_stream.set_close_callback(self.on_disconnect)
+        if isinstance(conn1,tornado.iostream.IOStream):
+            self.cmd_stream = conn1
+            self.update_stream = conn2
+        else:
+            self.cmd_stream = tornado.iostream.IOStream(conn1[0])
+            #self.cmd_stream.set_close_callback(self.on_disconnect)
+
+            self.update_stream = tornado.iostream.IOStream(conn2[0])
+            #self.update_stream.set_close_callback(self.on_disconnect)
+        # Otherwise modules spawned later would hold our end open, and this module wouldn't see it close
+        tornado.platform.auto.set_close_exec(self.cmd_stream.fileno())
+        tornado.platform.auto.set_close_exec(self.update_stream.fileno())
 
     # Handles the majority of object initialization
     # Waits for socket communication to be established
     # and for the initialization command to return successfully
     @service.coroutine
     def new(self,args=None):
+        # Kept so the queue can re-create this module (see Queue.snapshot)
+        self.args=args
         # Set up appropriate log_prefix now that uid is set
         self.log_prefix = {"node": self.log_namespace, "instance": self.log_uid}
-        # Set up two sockets for communication with the sub-process
-        listen_futures = self.listen()
-        # Launch the subprocess
-        self.spawn()
-
+        # Wait our turn, if the number of modules starting at once is limited (see shmooze.lib.admission)
+        if self.spawn_limit is not None:
+            yield self.spawn_limit.acquire()
         try:
-            # Wait for the subprocess to connect
+            # Set up two sockets for communication with the sub-process
+            listen_futures = self.listen()
+            connected = False
             try:
-                connections = yield [service.with_timeout(self.connect_timeout,f) for f in listen_futures]
-            except service.TimeoutError:
-                raise Exception("Could not connect to spawned module")
-            self.setup_connections(connections)
-
-            # Helps the queue keep track of whether a module is playing or suspended
-            self.is_on_top=False
-
-            # Send initialization data to the sub-process
-            try:
-                result = yield self.send_cmd("init",args)
-            except service.TimeoutError:
-                raise Exception("Could not init spawned module")
-        except Exception:
-            self.terminate() # ensure process is dead if any sort of error occurs
-            raise
+                # Launch the subprocess, or take over a pre-started one
+                self.spawn(self.take_warm_worker())
+
+                try:
+                    # Wait for the subprocess to connect
+                    try:
+                        connections = yield [service.with_timeout(self.connect_timeout,f) for f in listen_futures]
+                    except service.TimeoutError:
+                        raise Exception("Could not connect to spawned module")
+                    connected = True
+                    self.setup_connections(connections)
+
+                    # Helps the queue keep track of whether a module is playing or suspended
+                    self.is_on_top=False
+
+                    # Send initialization data to the sub-process
+                    try:
+                        result = yield self.send_cmd("init",args)
+                    except service.TimeoutError:
+                        raise Exception("Could not init spawned module")
+                except Exception:
+                    self.terminate() # ensure process is dead if any sort of error occurs
+                    raise
+            finally:
+                self.stop_listening(listen_futures,connected)
+        finally:
+            if self.spawn_limit is not None:
+                self.spawn_limit.release()
+            self.refill_warm_workers()
 
         def poll_updates_done(f):
             if f.exception() is not None:
@@ -117,6 +300,20 @@ class Module(service.JSONCommandProcessor):
         yield self.send_cmd("play")
         self.is_on_top=True
 
+    # Called from queue
+    # Lets the module get ready to play, as it is nearly at the top of the queue.
+    # Modules don't have to support this, so errors are ignored. Only sent once.
+    # If the module takes longer than prepare_timeout, commands after it are sent anyway rather than the module being terminated.
+    @service.coroutine
+    def prepare(self):
+        if self.prepared or not self.alive:
+            return
+        self.prepared=True
+        try:
+            yield self.send_cmd("prepare",read_timeout=self.prepare_timeout,terminate_on_timeout=False)
+        except Exception:
+            pass
+
     # Called from queue
     # Suspends the module, as it has been bumped down from the top of the queue
     @service.coroutine
@@ -124,6 +321,36 @@ class Module(service.JSONCommandProcessor):
         yield self.send_cmd("suspend")
         self.is_on_top=False
 
+    # Called from queue
+    # Start bringing the module to the given state ("play", "suspend" or "rm"), without waiting for it to get there.
+    # Commands are sent one at a time. If the target changes again before the module gets there,
+    # it goes straight to the latest target, skipping any that were superseded (e.g. play then suspend becomes nothing).
+    # Returns a future which resolves once the module has reached its target, or fails.
+    def transition(self,target):
+        self.target=target
+        if self.reconciler is None or self.reconciler.done():
+            self.reconciler=self.reconcile()
+        return self.reconciler
+
+    @service.coroutine
+    def reconcile(self):
+        while self.alive:
+            if self.target == "rm":
+                yield self.remove()
+            elif self.target == "play" and not self.is_on_top:
+                yield self.play()
+            elif self.target == "suspend" and self.is_on_top:
+                yield self.suspend()
+            else:
+                break
+
+    # Called by queue, when building "most played" lists (see database.TopAggregator)
+    # Given the arguments this module was added with, return (canonical_id, url, description),
+    # or None if it shouldn't be counted. Override this to group together items added with different arguments.
+    @staticmethod
+    def top_item(args):
+        return (json.dumps(args, sort_keys=True), None, None)
+
     # Called by queue
     # Retrieve some cached parameters
     def get_multiple_parameters(self,parameters):
@@ -137,34 +364,66 @@ class Module(service.JSONCommandProcessor):
         raise service.Return(result)
 
     # Send a command to the sub-process over the command pipe
+    # If terminate_on_timeout is False and no response comes within read_timeout, the module is left running,
+    # and the response is skipped over when it does come.
     @service.coroutine
-    def send_cmd(self,cmd,args=None):
+    def send_cmd(self,cmd,args=None,read_timeout=None,terminate_on_timeout=True):
         cmd_dict={"cmd":cmd}
         if args is not None:
             cmd_dict["args"]=args
-        cmd_str=json.dumps(cmd_dict)+'\n'
+        cmd_str=self.codec.encode(cmd_dict)
+        if read_timeout is None:
+            read_timeout=self.cmd_read_timeout
 
-        toe=None
+        start=time.time()
         # Lock on the command pipe so we ensure sequential req/rep transactions
         try:
             with (yield self.cmd_lock.acquire()):
                 yield service.with_timeout(self.cmd_write_timeout,self.cmd_stream.write(cmd_str))
-                response_str = yield service.with_timeout(self.cmd_read_timeout,self.cmd_stream.read_until('\n'))
+                if self.late_response is not None:
+                    late_response,self.late_response=self.late_response,None
+                    if not late_response.done():
+                        print "Waiting for {0} module to answer an earlier command before {1}".format(self.TYPE_STRING,cmd)
+                    yield late_response
+                    start=time.time()
+                response=service.read_message(self.cmd_stream,self.codec)
+                try:
+                    response_dict = yield service.with_timeout(read_timeout,response,quiet_exceptions=(tornado.iostream.StreamClosedError,))
+                except service.TimeoutError:
+                    if terminate_on_timeout:
+                        raise
+                    self.late_response=response
+                    # In case the module is terminated before anything reads it
+                    service.ioloop.add_future(response,lambda f: f.exception())
+                    stats.collector(self.cmd_stats_name()).record(cmd,time.time()-start,True)
+                    if self.logger is not None:
+                        self.logger.log(self.uid, "queue-module", cmd_dict, None, queue=self.log_queue)
+                    raise Exception("Timeout waiting for module to respond to "+cmd)
         except (service.TimeoutError,tornado.iostream.StreamClosedError) as e:
+            stats.collector(self.cmd_stats_name()).record(cmd,time.time()-start,True)
             self.terminate()
             if self.logger is not None:
-                self.logger.log(self.uid, "queue-module", cmd_dict, None)
+                self.logger.log(self.uid, "queue-module", cmd_dict, None, queue=self.log_queue)
             if isinstance(e,service.TimeoutError):
                 raise Exception("Timeout sending message to module")
             if isinstance(e,tornado.iostream.StreamClosedError):
                 raise Exception("Pipe to module unexpectedly closed")
             raise
 
-        response_dict=json.loads(response_str)
+        success=isinstance(response_dict,dict) and response_dict.get('success',False)
+        stats.collector(self.cmd_stats_name()).record(cmd,time.time()-start,not success)
         if self.logger is not None:
-            self.logger.log(self.uid, "queue-module", cmd_dict, response_dict)
+            self.logger.log(self.uid, "queue-module", cmd_dict, response_dict, queue=self.log_queue)
         raise service.Return(packet.assert_success(response_dict))
 
+    # Updates from modules are counted per module type, rather than per instance
+    def stats_name(self):
+        return "module-update:"+self.TYPE_STRING
+
+    # Commands sent to modules (see send_cmd) are counted here
+    def cmd_stats_name(self):
+        return "module-cmd:"+self.TYPE_STRING
+
     # This function schedules a module's death and returns immediately.
     # It also removes the module from the queue if it is on it.
     def terminate(self):
@@ -182,16 +441,15 @@ class Module(service.JSONCommandProcessor):
 
     # Ensure this module's sub-process is dead
     # Like, no really.
+    # The streams may not exist, if the module never connected.
     @service.coroutine
     def terminate_process(self):
-        try:
-            self.cmd_stream.close()
-        except OSError:
-            pass
-        try:
-            self.update_stream.close()
-        except OSError:
-            pass
+        for stream in (self.cmd_stream,self.update_stream):
+            try:
+                if stream is not None:
+                    stream.close()
+            except OSError:
+                pass
         try:
             yield service.with_timeout(self.natural_death_timeout,service.wait(self.proc))
         except (service.TimeoutError, AttributeError):
@@ -211,14 +469,21 @@ class Module(service.JSONCommandProcessor):
     def poll_updates(self):
         return service.listen_for_commands(self.update_stream,self.command,self.terminate)
 
+    # Let the queue/pool know that this module's parameters changed
+    def changed(self):
+        if self.on_change is not None:
+            self.on_change(self)
+
     @service.coroutine
     def set_parameters(self,parameters):
         self.parameters.update(parameters)
+        self.changed()
 
     @service.coroutine
     def unset_parameters(self,parameters):
         for parameter in parameters:
             self.parameters.pop(parameter, None)
+        self.changed()
 
     commands={
         'set_parameters':set_parameters,
@@ -228,3 +493,8 @@ class Module(service.JSONCommandProcessor):
 
     log_cmds = ['set_parameters','unset_parameters','rm']
 
+# A module whose process is built on shmooze.modules (see pymodule.ParentConnection),
+# which can be handed its sockets when the unix transport is configured
+class PyModule(Module):
+    use_socketpair = transport.use_unix()
+
@@ -1,60 +1,93 @@
-import json
+import os
 import socket
 import sys
 import traceback
 
+import shmooze.lib.codec as codec
 import shmooze.lib.packet as packet
 
 # Modules can be written in any language, but if you choose to write them in python.
 # you may find the contents of this file helpful.
 
 # Connects back to the queue based on command-line arguments
+# The arguments are one of:
+# - "host port token=<token>" to connect both streams to the queue's rendezvous listener
+# - "- cmd_fd update_fd" if the queue handed us already-connected unix sockets
+# - "host cmd_port update_port"
 class ParentConnection(object):
     def __init__(self):
         host = sys.argv[-3]
-        cmd_port = int(sys.argv[-2])
-        update_port = int(sys.argv[-1])
-        self.cs=socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-        self.us=socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-        self.cs.connect((host,cmd_port))
-        self.us.connect((host,update_port))
+        if host == '-':
+            self.cs=self.inherit_socket(int(sys.argv[-2]))
+            self.us=self.inherit_socket(int(sys.argv[-1]))
+        elif sys.argv[-1].startswith('token='):
+            port = int(sys.argv[-2])
+            token = sys.argv[-1][len('token='):]
+            self.cs=self.rendezvous(host,port,token,'cmd')
+            self.us=self.rendezvous(host,port,token,'update')
+        else:
+            cmd_port = int(sys.argv[-2])
+            update_port = int(sys.argv[-1])
+            self.cs=socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+            self.us=socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+            self.cs.connect((host,cmd_port))
+            self.us.connect((host,update_port))
 
         self.cs_buffer=''
         self.us_buffer=''
 
+        # The queue tells us which codec to speak (see shmooze.lib.codec)
+        self.codec=codec.get(os.environ.get("SHMOOZE_CODEC"))
+
+    @staticmethod
+    def rendezvous(host,port,token,channel):
+        s=socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        s.connect((host,port))
+        s.sendall('{0} {1}\n'.format(token,channel))
+        return s
+
+    @staticmethod
+    def inherit_socket(fd):
+        s=socket.fromfd(fd,socket.AF_UNIX,socket.SOCK_STREAM)
+        # fromfd makes a duplicate, so the original can go
+        os.close(fd)
+        return s
+
     # Blocks until a command has been received and returns it
     def recv_cmd(self):
         while True:
-            self.cs_buffer+=self.cs.recv(4096)
-            a=self.cs_buffer.find('\n')
-            if a >= 0:
-                cmd=self.cs_buffer[0:a]
-                self.cs_buffer=self.cs_buffer[a+1:]
-                break
-        return json.loads(cmd)
+            cmd,self.cs_buffer=self.codec.decode_buffer(self.cs_buffer)
+            if cmd is not None:
+                return cmd
+            self.cs_buffer+=self.recv(self.cs)
 
     # Blocks until an update has been acknowledged
     def recv_update_resp(self):
         while True:
-            self.us_buffer+=self.us.recv(4096)
-            a=self.us_buffer.find('\n')
-            if a >= 0:
-                resp=self.us_buffer[0:a]
-                self.us_buffer=self.us_buffer[a+1:]
+            resp_dict,self.us_buffer=self.codec.decode_buffer(self.us_buffer)
+            if resp_dict is not None:
                 break
-        resp_dict = json.loads(resp)
+            self.us_buffer+=self.recv(self.us)
         packet.assert_success(resp_dict)
         return resp_dict['result']
 
+    # The queue has gone away if the connection is closed, so there is nothing left to do
+    @staticmethod
+    def recv(s):
+        data=s.recv(4096)
+        if not data:
+            raise EOFError("Connection to queue closed")
+        return data
+
     # Sends response to a command
     def send_resp(self,packet):
-        p_str=json.dumps(packet)+'\n'
-        self.cs.send(p_str)
+        p_str=self.codec.encode(packet)
+        self.cs.sendall(p_str)
 
     # Sends an update packet
     def send_update(self, packet):
-        p_str=json.dumps(packet)+'\n'
-        self.us.send(p_str)
+        p_str=self.codec.encode(packet)
+        self.us.sendall(p_str)
         # Right now, updates are not responded to
         #return self.recv_update_resp()
 
@@ -80,12 +113,14 @@ class JSONParentPoller(object):
 
             cmd=data['cmd']
 
-            if cmd not in self.commands:
+            if cmd in self.commands:
+                cmd_f=self.commands[cmd]
+            elif cmd in self.default_commands:
+                cmd_f=self.default_commands[cmd]
+            else:
                 print "Unrecognized command:", cmd, data
                 raise Exception("Unrecognized command")
 
-            cmd_f=self.commands[cmd]
-
             args = data.get("args", {})
 
             self.connection.send_resp(packet.good(cmd_f(self,**args)))
@@ -106,3 +141,14 @@ class JSONParentPoller(object):
         data = {"cmd": "rm"}
         return self.connection.send_update(data)
 
+    # Sent by the queue when this module is a few places from the top, so that it can get ready to play
+    # (e.g. start buffering) ahead of time. It should return quickly; the play command waits for it.
+    # To handle it, put a 'prepare' entry in commands.
+    def prepare(self):
+        pass
+
+    # Commands which modules don't have to implement
+    default_commands = {
+        'prepare': prepare,
+    }
+
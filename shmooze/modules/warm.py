@@ -0,0 +1,136 @@
+import json
+import os
+import runpy
+import subprocess
+import sys
+import tornado.platform.auto
+
+import shmooze.settings as settings
+
+# Pools of pre-started python module processes ("warm workers").
+#
+# Spawning a python module means paying for interpreter startup and imports before the module can connect back.
+# A warm worker is a module process started ahead of time, with this file as its entry point:
+# it does its imports, then waits on stdin for the arguments that it would have been spawned with.
+# When a module is added, a worker is handed its arguments and becomes the module, and another is started to take its place.
+#
+# The number of workers kept for each module type is set by "warm_workers" in settings.json, e.g. {"youtube": 2}.
+# Only modules whose process is "python script.py ..." or "python -m module ..." can be run by a warm worker,
+# and only when the queue connects modules over TCP (not with inherited unix sockets, see shmooze.lib.transport).
+
+pool_sizes = settings.get("warm_workers", {})
+
+# Modules that every worker imports before it waits
+default_imports = ["shmooze.modules.pymodule"]
+
+# The command that starts a worker for the given process, or None if it can't be run by one
+def worker_command(process):
+    if len(process) < 2 or not os.path.basename(process[0]).startswith("python"):
+        return None
+    if process[1] == "-m":
+        if len(process) < 3:
+            return None
+    elif process[1].startswith("-"):
+        return None
+    return [process[0], "-m", "shmooze.modules.warm"] + list(process[1:])
+
+class Worker(object):
+    def __init__(self, command, env):
+        # Workers connect back over TCP, so they don't need anything of ours but stdin
+        self.proc = subprocess.Popen(command, env=env, stdin=subprocess.PIPE, close_fds=True)
+        # Otherwise other children would inherit it, and the worker wouldn't see it close
+        tornado.platform.auto.set_close_exec(self.proc.stdin.fileno())
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    # Hand over the arguments the module would have been spawned with. Returns the process, which is now the module.
+    def start(self, args):
+        self.proc.stdin.write(json.dumps(args) + "\n")
+        self.proc.stdin.close()
+        return self.proc
+
+    def stop(self):
+        # Workers exit when stdin closes without any arguments
+        self.proc.stdin.close()
+
+class WorkerPool(object):
+    def __init__(self, command, size, env):
+        self.command = command
+        self.size = size
+        self.env = env
+        self.idle = []
+
+    # A ready worker, or None if there isn't one
+    def take(self):
+        worker = None
+        while self.idle:
+            w = self.idle.pop(0)
+            if w.alive():
+                worker = w
+                break
+        return worker
+
+    def refill(self):
+        while len(self.idle) < self.size:
+            self.idle.append(Worker(self.command, self.env))
+
+    def close(self):
+        for w in self.idle:
+            w.stop()
+        self.idle = []
+
+# TYPE_STRING -> WorkerPool
+pools = {}
+
+# The worker pool for a module class (or instance), or None if it shouldn't have one
+def get_pool(module):
+    if module.TYPE_STRING in pools:
+        return pools[module.TYPE_STRING]
+    size = pool_sizes.get(module.TYPE_STRING, 0)
+    command = worker_command(module.process)
+    if size <= 0 or command is None or module.use_socketpair:
+        pools[module.TYPE_STRING] = None
+        return None
+    env = dict(os.environ, SHMOOZE_CODEC=module.codec.name,
+               SHMOOZE_WARM_IMPORTS=",".join(default_imports + list(module.warm_imports)))
+    pools[module.TYPE_STRING] = WorkerPool(command, size, env)
+    return pools[module.TYPE_STRING]
+
+# Start workers for the given module classes
+def prestart(modules):
+    for m in modules:
+        pool = get_pool(m)
+        if pool is not None:
+            pool.refill()
+
+def close_all():
+    for pool in pools.values():
+        if pool is not None:
+            pool.close()
+
+# Entry point of a worker.
+# Arguments are the module's process, minus the python interpreter: either a script and its arguments, or "-m module ..."
+def main():
+    for name in os.environ.get("SHMOOZE_WARM_IMPORTS", "").split(","):
+        if name:
+            __import__(name)
+    line = sys.stdin.readline()
+    if not line:
+        sys.exit(0)
+    args = [str(a) for a in json.loads(line)]
+    # Don't keep the pipe from the queue as stdin
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    process = sys.argv[1:]
+    if process[0] == "-m":
+        sys.argv = [process[1]] + process[2:] + args
+        runpy.run_module(process[1], run_name="__main__", alter_sys=True)
+    else:
+        sys.argv = process + args
+        sys.path[0] = os.path.dirname(os.path.abspath(process[0]))
+        runpy.run_path(process[0], run_name="__main__")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+import shmooze.lib.admission as admission
+import shmooze.lib.packet as packet
+import shmooze.lib.service as service
+import shmooze.lib.stats as stats
+import shmooze.modules.warm as warm
+import shmooze.queue
+import shmooze.settings as settings
+import re
+import time
+
+# A multi-queue hosts many named queues (say, one per room) in one process, behind the queue's port.
+#
+# Each queue is a shmooze.queue.Queue with its own lock, background, state version and snapshot,
+# but all of them share the process, the command log and the admission limits.
+# Entries in the command log are tagged with the name of their queue, which history and top are limited to,
+# and each queue's commands are counted in stats under client-queue:<name>.
+# Commands are sent to a queue by giving its name as a "queue" argument, e.g.
+#   {"cmd": "add", "args": {"queue": "lounge", "type": "youtube", "args": {...}}}
+# Commands without one go to the default queue, so clients of a single queue work unchanged.
+# Queues are created the first time a command is sent to them, and evicted once they have been empty and unused for a while.
+
+class MultiQueue(service.JSONCommandProcessor, service.Service):
+    name="queue"
+    port=settings.ports["queue"]
+    pipeline_depth=settings.get("pipeline_depth",1)
+    multi_queue_settings=settings.get("multi_queue",{})
+    # Queues which are created at startup and never evicted; the first is the default queue
+    permanent_queues=multi_queue_settings.get("queues",["default"])
+    # Seconds a queue must be empty and unused before it is evicted
+    idle_timeout=multi_queue_settings.get("idle_timeout",600)
+    # Most queues hosted at once
+    max_queues=multi_queue_settings.get("max_queues",100)
+
+    queue_name_re=re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+    def __init__(self,modules,backgrounds,logfilename=None):
+        self.modules=modules
+        self.backgrounds=backgrounds
+        self.default_queue=self.permanent_queues[0]
+
+        # name -> Queue
+        self.queues={}
+        # name -> when a command was last sent to the queue
+        self.last_used={}
+        self.evicted=0
+
+        # Shared by every queue (see Queue.__init__)
+        if logfilename:
+            self.logger=shmooze.queue.queue_logger(modules)
+        self.log_namespace="client-multiqueue"
+        self.admission=admission.from_settings(settings.get("admission",False))
+
+        for name in self.permanent_queues:
+            self.get_queue(name)
+        service.ioloop.call_later(min(self.idle_timeout,60),self.evict_idle)
+
+        # JSONCommandService handles all of the low-level TCP connection stuff.
+        super(MultiQueue,self).__init__()
+
+    # The queue with the given name, which is created if it doesn't exist
+    def get_queue(self,name):
+        if not isinstance(name,basestring) or not self.queue_name_re.match(name):
+            raise Exception("Bad queue name")
+        if name not in self.queues:
+            if len(self.queues) >= self.max_queues:
+                raise Exception("Too many queues")
+            self.queues[name]=shmooze.queue.Queue(self.modules,self.backgrounds,host=self,queue_name=name)
+        self.last_used[name]=time.time()
+        return self.queues[name]
+
+    # Which queue a command is for, and the command without the "queue" argument.
+    # Returns a name of None for commands that the multi-queue itself handles.
+    def route(self,line):
+        if not isinstance(line,dict):
+            return self.default_queue,line
+        args=line.get('args')
+        if not isinstance(args,dict) or 'queue' not in args:
+            if line.get('cmd') in self.commands or line.get('cmd') in self.builtin_commands:
+                return None,line
+            return self.default_queue,line
+        args=dict(args)
+        name=args.pop('queue')
+        line=dict(line,args=args)
+        return name,line
+
+    # Commands are read-only if the queue (or the multi-queue) that handles them says so
+    def read_only(self,query):
+        if isinstance(query,list):
+            return all([self.read_only(q) for q in query])
+        name,line=self.route(query)
+        if name is None:
+            return super(MultiQueue,self).read_only(line)
+        return isinstance(line,dict) and line.get('cmd') in shmooze.queue.Queue.read_only_cmds
+
+    @service.coroutine
+    def command(self,line,client=None):
+        if isinstance(line,list):
+            result=yield self.multiple_routed_commands(line,client)
+            raise service.Return(result)
+        result=yield self.routed_command(line,client)
+        raise service.Return(result)
+
+    @service.coroutine
+    def routed_command(self,line,client=None):
+        name,line=self.route(line)
+        if name is None:
+            result=yield super(MultiQueue,self).command(line,client)
+            raise service.Return(result)
+        try:
+            q=self.get_queue(name)
+        except Exception as e:
+            raise service.Return(packet.error(str(e)))
+        result=yield q.command(line,client)
+        raise service.Return(result)
+
+    # Run a list of commands, in order.
+    # Consecutive commands for the same queue are passed to it together, so read-only ones can still run at the same time.
+    @service.coroutine
+    def multiple_routed_commands(self,lines,client=None):
+        result=[]
+        i=0
+        while i < len(lines):
+            name,first=self.route(lines[i])
+            group=[first]
+            i+=1
+            while i < len(lines) and name is not None:
+                next_name,line=self.route(lines[i])
+                if next_name != name:
+                    break
+                group.append(line)
+                i+=1
+            if name is None:
+                result.append((yield super(MultiQueue,self).command(first,client)))
+                continue
+            try:
+                q=self.get_queue(name)
+            except Exception as e:
+                result+=[packet.error(str(e))]*len(group)
+                continue
+            group_results=yield q.command(group,client)
+            if isinstance(group_results,list):
+                result+=group_results
+            else:
+                result+=[group_results]*len(group)
+        raise service.Return(result)
+
+    # Evict queues that have been idle for idle_timeout seconds, then check again later
+    def evict_idle(self):
+        now=time.time()
+        def close_done(f):
+            if f.exception() is not None:
+                print "Error closing queue:",f.exception()
+        for name,q in self.queues.items():
+            if name in self.permanent_queues or now-self.last_used[name] < self.idle_timeout or not q.idle():
+                continue
+            del self.queues[name]
+            del self.last_used[name]
+            self.evicted+=1
+            # So that the stats of every queue that was ever used don't pile up
+            stats.collectors.pop(q.stats_name(),None)
+            service.ioloop.add_future(q.close(),close_done)
+        service.ioloop.call_later(min(self.idle_timeout,60),self.evict_idle)
+
+    # Called from client
+    # Retrieves the names of the queues being hosted, with how many modules each has, and how long since each was used
+    @service.coroutine
+    def list_queues(self):
+        now=time.time()
+        raise service.Return(dict([(name,{'modules':len(q.queue),'bg':q.bg is not None,'idle':round(now-self.last_used[name],1)})
+                                   for name,q in self.queues.items()]))
+
+    @service.coroutine
+    def get_stats(self):
+        result=yield super(MultiQueue,self).get_stats()
+        result['queues']={'hosted':len(self.queues),'evicted':self.evicted}
+        raise service.Return(result)
+
+    def shutdown(self):
+        def shutdown_complete(f):
+            warm.close_all()
+            if self.logger is not None:
+                self.logger.close()
+            service.ioloop.stop()
+        service.ioloop.add_future(self.close(),shutdown_complete)
+
+    # Close every queue (see Queue.close)
+    @service.coroutine
+    def close(self):
+        queues=self.queues.values()
+        self.queues={}
+        self.last_used={}
+        yield [q.close() for q in queues]
+
+    @service.coroutine
+    def killall(self):
+        yield [q.killall() for q in self.queues.values()]
+
+    commands = {
+        'queues':list_queues,
+    }
+
+    builtin_commands = {
+        'stats':get_stats,
+    }
+
+    read_only_cmds = ['queues','stats']
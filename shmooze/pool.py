@@ -1,13 +1,20 @@
+import shmooze.lib.admission as admission
 import shmooze.lib.cmdlog
 import shmooze.lib.database as database
 import shmooze.lib.service as service
+import shmooze.modules.module as module
+import shmooze.modules.warm as warm
 import shmooze.settings as settings
 import uuid
 
 # A pool manages the life and death of modules, through tornado's IOLoop.
 
 class Pool(service.JSONCommandProcessor, service.Service):
+    name="pool"
     port=settings.ports["pool"]
+    pipeline_depth=settings.get("pipeline_depth",1)
+    # Most modules add_many starts at once
+    add_concurrency=settings.get("add_concurrency",8)
 
     def __init__(self,modules,logfilename=None):
         print "Pool started."
@@ -17,15 +24,27 @@ class Pool(service.JSONCommandProcessor, service.Service):
         # Create lookup table of possible modules & backgrounds
         self.modules_available_dict = dict([(m.TYPE_STRING,m) for m in modules])
 
-        # pool is the actual pool of modules
-        self.pool=set()
+        # pool is the actual pool of modules, as a dict from uid to module
+        self.pool={}
         # pool is a synchronization object so that multiple clients don't try to alter the pool at the same time
         # (also includes background)
         self.pool_lock=service.Lock()
 
-        # old_queue is used to take diffs of the pool (and from there, send appropriate messages to affected modules.)
-        # whenever the pool is unlocked, it should equal the pool.
-        self.old_pool=[]
+        # Changes to the pool that modules haven't been told about yet (see pool_updated):
+        # uids of modules added to the pool, which need starting,
+        # and modules removed from it, which need stopping (uid -> module)
+        self.pending_start=set()
+        self.pending_stop={}
+        self.flush_scheduled=False
+        # Futures of modules' transitions that are under way (see module.transition())
+        self.transitions=set()
+
+        # Goes up every time the pool, or a module's parameters change
+        self.state=service.StateVersion()
+        # Version at which modules were last added to or removed from the pool
+        self.pool_version=0
+        # Answers to repeated reads, until the next change (see cached_cmds)
+        self.response_cache=service.ResponseCache(self.state)
 
         # When debugging, uids are assigned sequentially
         self.debug = False
@@ -39,6 +58,12 @@ class Pool(service.JSONCommandProcessor, service.Service):
             self.logger = database.Database(log_table="pool_log")
         self.log_namespace = "client-pool"
 
+        # Limits on how often clients may send commands, and how many modules may start at once
+        self.admission = admission.from_settings(settings.get("admission",False))
+
+        # Pre-start processes for the module types that want them (see shmooze.modules.warm)
+        warm.prestart(modules)
+
         # JSONCommandService handles all of the low-level TCP connection stuff.
         super(Pool,self).__init__()
 
@@ -53,10 +78,9 @@ class Pool(service.JSONCommandProcessor, service.Service):
     # Retrieves given parameters from the module
     @service.coroutine
     def ask_module(self,uid,parameters):
-        d=dict(self.pool)
-        if uid not in d:
+        if uid not in self.pool:
             raise Exception("Module identifier not in queue")
-        raise service.Return(d[uid].get_multiple_parameters(parameters))
+        raise service.Return(self.pool[uid].get_multiple_parameters(parameters))
 
     # Called from client
     # Retrieves names of possible modules that can be added to the pool
@@ -66,15 +90,40 @@ class Pool(service.JSONCommandProcessor, service.Service):
 
     # Called from client
     # Retrieves the current pool, and info about modules on it
+    # With since_version (the version from an earlier response), only returns what changed since then:
+    #   'version': the current version
+    #   'uids': the modules in the pool, if that changed
+    #   'modules': info about modules added, or with changed parameters
     @service.coroutine
-    def get_pool(self,parameters={}):
-        l=[]
-        for (uid,obj) in self.pool:
-            d={'uid':uid,'type':obj.TYPE_STRING}
-            if obj.TYPE_STRING in parameters:
-                d['parameters']=obj.get_multiple_parameters(parameters[obj.TYPE_STRING])
-            l.append(d)
-        raise service.Return(l)
+    def get_pool(self,parameters={},since_version=None):
+        if since_version is None:
+            raise service.Return([self.describe(uid,obj,parameters) for (uid,obj) in self.pool.items()])
+        # A version from the future means the pool was restarted
+        full=since_version > self.state.version
+        result={'version':self.state.version}
+        if full or self.pool_version > since_version:
+            result['uids']=self.pool.keys()
+        result['modules']=[self.describe(uid,obj,parameters) for (uid,obj) in self.pool.items() if full or obj.version > since_version]
+        raise service.Return(result)
+
+    # Info about a module in the pool
+    def describe(self,uid,obj,parameters):
+        d={'uid':uid,'type':obj.TYPE_STRING}
+        if obj.TYPE_STRING in parameters:
+            d['parameters']=obj.get_multiple_parameters(parameters[obj.TYPE_STRING])
+        return d
+
+    # Called from client
+    # Waits until the version is newer than since_version, or timeout seconds pass.
+    # Returns {'version': the current version}
+    @service.coroutine
+    def wait_for_change(self,since_version,timeout=10):
+        version=yield self.state.wait(since_version,timeout)
+        raise service.Return({'version':version})
+
+    # Called from modules in the pool, when their parameters change
+    def module_changed(self,obj):
+        obj.version=self.state.bump()
 
     # Called from client
     # Issues a command to a module
@@ -82,18 +131,13 @@ class Pool(service.JSONCommandProcessor, service.Service):
     # This is in contrast to ask_module which only retrieves cached information and does not create additional transactions.
     @service.coroutine
     def tell_module(self,uid,cmd,args={}):
-        d=dict(self.pool)
-        if uid not in d:
+        if uid not in self.pool:
             raise Exception("Module identifier not in pool")
-        result = yield d[uid].tell(cmd,args)
+        result = yield self.pool[uid].tell(cmd,args)
         raise service.Return(result)
 
-    # Called from client
-    # Create a new module and add it to the pool
-    # May take a little while as module is spawned and constructed.
-    @service.coroutine
-    def add(self,type,args={}):
-        uid=self.get_uid()
+    # Construct (but don't start) a module to go in the pool
+    def make_module(self,type,uid):
         if type not in self.modules_available_dict:
             raise Exception("Unrecognized module name")
         mod_inst=self.modules_available_dict[type](self.get_remover(uid))
@@ -101,59 +145,114 @@ class Pool(service.JSONCommandProcessor, service.Service):
         mod_inst.uid = uid 
         mod_inst.log_uid = uid 
         mod_inst.log_namespace = "module-instance" 
+        mod_inst.on_change = self.module_changed
+        if self.admission is not None:
+            mod_inst.spawn_limit = self.admission.spawn_limit
+        return mod_inst
+
+    # Called from client
+    # Create a new module and add it to the pool
+    # May take a little while as module is spawned and constructed.
+    @service.coroutine
+    def add(self,type,args={}):
+        uid=self.get_uid()
+        mod_inst=self.make_module(type,uid)
         yield mod_inst.new(args)
         with (yield self.pool_lock.acquire()):
-            self.pool.add((uid,mod_inst))
+            self.put(uid,mod_inst)
+            self.module_changed(mod_inst)
             yield self.pool_updated()
         raise service.Return({'uid':uid})
 
+    # Called from client
+    # Create several new modules and add them to the pool.
+    # items is a list of {"type": ..., "args": ...}, like the arguments of add.
+    # Modules are started at the same time (up to add_concurrency at once), and are all added to the pool together.
+    # Returns a list with, for each item, {"uid": ...} if it was added, or {"error": ...} if it wasn't.
+    @service.coroutine
+    def add_many(self,items):
+        results=[]
+        objs=[]
+        for item in items:
+            try:
+                if not isinstance(item,dict):
+                    raise Exception("Item not a dict.")
+                uid=self.get_uid()
+                obj=self.make_module(item.get('type'),uid)
+                objs.append((obj,item.get('args',{})))
+                results.append(obj)
+            except Exception as e:
+                results.append({'error':str(e)})
+        errors=yield module.start_many(objs,self.add_concurrency)
+        errors=iter(errors)
+        added=[]
+        for i,r in enumerate(results):
+            if isinstance(r,dict):
+                continue
+            error=next(errors)
+            if error is not None:
+                results[i]={'error':str(error)}
+            else:
+                added.append(r)
+                results[i]={'uid':r.uid}
+        if added:
+            with (yield self.pool_lock.acquire()):
+                for obj in added:
+                    self.put(obj.uid,obj)
+                    self.module_changed(obj)
+                yield self.pool_updated()
+        raise service.Return(results)
+
     # Called from client
     # Removes some modules from the pool
     # May take a little while as the modules are destroyed.
     @service.coroutine
     def rm(self,uids):
         with (yield self.pool_lock.acquire()):
-            self.pool={(uid,obj) for (uid,obj) in self.pool if uid not in uids}
+            for uid in uids:
+                self.discard(uid)
             yield self.pool_updated()
 
-    # Take a diff of the pool, and issue appropriate commands to modules (start and rm) if necessary.
-    # May take a little while as the commands are executed.
-    # Commands are executed simultaneously.
+    # Add a module to the pool; it is started by the next flush_pending()
     # Pool should be locked for this operation
-    # TODO harden this
-    @service.coroutine
-    def pool_updated(self):
-        again=True
-        while again:
-            again=False
-            cur_uids=[uid for (uid,obj) in self.pool]
-            to_remove=[((uid,obj),obj.remove) for (uid,obj) in self.old_pool if uid not in cur_uids and obj.alive]
-            to_play=[]
-            for (uid, obj) in self.pool:
-                if not obj.is_on_top: # is_on_top is alias for 'is running'  in this case
-                    to_play.append(((uid, obj), obj.play))
+    def put(self,uid,obj):
+        self.pool[uid]=obj
+        self.pending_start.add(uid)
 
-            to_suspend = [] # Nothing should be suspended
+    # Remove uid from the pool, if it's in it; it is stopped by the next flush_pending()
+    # Pool should be locked for this operation
+    def discard(self,uid):
+        obj=self.pool.pop(uid,None)
+        if obj is None:
+            return
+        # A module added and removed before it was started still needs stopping, since it was spawned
+        self.pending_start.discard(uid)
+        self.pending_stop[uid]=obj
 
-            self.old_pool=self.pool
+    # Tell modules about changes to the pool: start the ones that were added, and remove the ones that were removed.
+    # Returns straight away. Changes are collected in pending_start and pending_stop, and all those made in the same
+    # IOLoop iteration are sent together (see flush_pending), so each costs work in proportion to the modules it affects.
+    # Modules are brought to their new states in the background (see Module.transition);
+    # those that fail to change state are terminated, which removes them from the pool.
+    # Pool should be locked for this operation
+    @service.coroutine
+    def pool_updated(self):
+        self.pool_version=self.state.bump()
+        if not self.flush_scheduled and (self.pending_start or self.pending_stop):
+            self.flush_scheduled=True
+            service.ioloop.add_callback(self.flush_pending)
 
-            actions=to_remove+to_suspend+to_play
-            try:
-                if len(actions) > 0:
-                    # Execute all operations simultaneously
-                    actions=[(mod,future()) for mod,future in actions]
-                    yield [future for uid,future in actions]
-            except Exception as e:
-                print "Errors trying to update poool:"
-                for (uid,obj),f in actions:
-                    if f.exception():
-                        print "- {0} raised {1}".format(uid,f.exception())
-                bad_modules=[mod for mod,f in actions if f.exception()]
-                print "Removing bad modules:",bad_modules
-                for uid,obj in bad_modules:
-                    obj.terminate()
-                self.pool={(uid,obj) for uid,obj in self.pool if uid not in [uid2 for uid2,obj2 in bad_modules]}
-                again=True
+    def flush_pending(self):
+        self.flush_scheduled=False
+        stops=self.pending_stop.items()
+        starts=[(uid,self.pool[uid]) for uid in self.pending_start if uid in self.pool]
+        self.pending_stop={}
+        self.pending_start=set()
+        for uid,obj in stops:
+            if obj.alive:
+                module.transition(self.transitions,uid,obj,"rm")
+        for uid,obj in starts:
+            module.transition(self.transitions,uid,obj,"play") # A pool module plays for as long as it's in the pool
 
     # Returns a coroutine that may be executed to remove the current module from the queue
     # Generally, the result of this function is passed into a newly constructed module, so that
@@ -162,28 +261,52 @@ class Pool(service.JSONCommandProcessor, service.Service):
         @service.coroutine
         def remove_self():
             with (yield self.pool_lock.acquire()):
-                self.pool={(uid,obj) for (uid,obj) in self.pool if uid != my_uid}
+                self.discard(my_uid)
                 yield self.pool_updated()
         return remove_self
 
     def shutdown(self):
         def shutdown_complete(f):
+            warm.close_all()
+            if self.logger is not None:
+                self.logger.close()
             service.ioloop.stop()
         service.ioloop.add_future(self.killall(),shutdown_complete)
 
     @service.coroutine
     def killall(self):
         with (yield self.pool_lock.acquire()):
-            self.pool = set()
+            for uid in self.pool.keys():
+                self.discard(uid)
             yield self.pool_updated()
+            self.flush_pending()
+        # Wait for the modules to be removed
+        # (finished transitions stay in the set until their callbacks run, so only wait on the unfinished ones)
+        while True:
+            pending=[f for f in self.transitions if not f.done()]
+            if not pending:
+                break
+            try:
+                yield pending
+            except Exception:
+                pass
 
     commands = {
         'rm':rm,
         'add':add,
+        'add_many':add_many,
         'pool':get_pool,
         'modules_available':modules_available,
         'tell_module':tell_module,
         'ask_module':ask_module,
+        'history':service.JSONCommandProcessor.get_history,
+        'wait_for_change':wait_for_change,
     }
 
-    log_cmds = ['rm','add','tell_module']
+    log_cmds = ['rm','add','add_many','tell_module']
+
+    read_only_cmds = ['stats','history','pool','modules_available','ask_module','wait_for_change']
+
+    cached_cmds = ['pool']
+
+    per_item_cmds = {'add_many':('add','items')}
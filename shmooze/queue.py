@@ -1,16 +1,41 @@
+import shmooze.lib.admission as admission
 import shmooze.lib.cmdlog
 import shmooze.lib.database as database
+import shmooze.lib.indexedqueue as indexedqueue
 import shmooze.lib.service as service
+import shmooze.lib.snapshot as snapshot
+import shmooze.lib.stats as stats
+import shmooze.modules.module as module
+import shmooze.modules.warm as warm
 import shmooze.settings as settings
+import time
 import uuid
 
 # A queue manages the life and death of modules, through tornado's IOLoop.
 
+# The command log for queues of the given module types (see log_database_path and top_aggregation)
+def queue_logger(modules):
+    aggregator = None
+    if settings.get("top_aggregation", False):
+        aggregator = database.TopAggregator(dict([(m.TYPE_STRING,m.top_item) for m in modules]))
+    return database.Database(log_table="queue_log", aggregator=aggregator)
+
 class Queue(service.JSONCommandProcessor, service.Service):
+    name="queue"
     port=settings.ports["queue"]
-
-    def __init__(self,modules,backgrounds,logfilename=None):
+    pipeline_depth=settings.get("pipeline_depth",1)
+    # Number of modules after the top of the queue to send prepare to
+    prefetch_depth=settings.get("prefetch_depth",0)
+    # Most modules add_many starts at once
+    add_concurrency=settings.get("add_concurrency",8)
+    # Where and how to save the queue, so it can be restored if the queue restarts (see snapshot())
+    snapshot_settings=settings.get("queue_snapshot",False)
+
+    # A queue either runs its own service, or is one of the queues hosted by a shmooze.multiqueue.MultiQueue.
+    # A hosted queue is named queue_name, doesn't listen on a port, and shares its host's command log and admission limits.
+    def __init__(self,modules,backgrounds,logfilename=None,host=None,queue_name=None):
         print "Queue started."
+        self.queue_name = queue_name
         # Create a UUID for this instance
         self.instance = str(uuid.uuid4())
 
@@ -18,19 +43,31 @@ class Queue(service.JSONCommandProcessor, service.Service):
         self.modules_available_dict = dict([(m.TYPE_STRING,m) for m in modules])
         self.backgrounds_available_dict = dict([(b.TYPE_STRING,b) for b in backgrounds])
 
-        # queue is the actual queue of modules
-        self.queue=[]
+        # queue is the actual queue of modules, as (uid, module) pairs
+        self.queue=indexedqueue.IndexedQueue()
         # bg is the module running in the background
         self.bg = None
         # queue_lock is a synchronization object so that multiple clients don't try to alter the queue at the same time
         # (also includes background)
         self.queue_lock=service.Lock()
 
-        # old_queue is used to take diffs of the queue (and from there, send appropriate messages to affected modules.)
-        # whenever the queue is unlocked, it should equal the queue.
-        self.old_queue=[]
-        # Same with old_bg
+        # Modules that have been told to play, and haven't since been suspended or removed.
+        # Together with the queue's record of removed modules, this is used to take diffs of the queue
+        # (and from there, send appropriate messages to affected modules.)
+        self.playing={}
+        # old_bg is used the same way for the background.
+        # whenever the queue is unlocked, it should equal bg.
         self.old_bg=None
+        # Futures of modules' transitions that are under way (see module.transition())
+        self.transitions=set()
+
+        # Goes up every time the queue, the background, or a module's parameters change
+        self.state=service.StateVersion()
+        # Versions at which the order of the queue, and the background, last changed
+        self.queue_version=0
+        self.bg_version=0
+        # Answers to repeated reads, until the next change (see cached_cmds)
+        self.response_cache=service.ResponseCache(self.state)
 
         # When debugging, uids are assigned sequentially
         self.debug = False
@@ -40,12 +77,49 @@ class Queue(service.JSONCommandProcessor, service.Service):
 
         # Log important commands
         # (used in JSONCommandProcessor)
-        if logfilename:
-            self.logger = database.Database(log_table="queue_log")
+        if host is not None:
+            self.logger = host.logger
+            # Tells apart the entries of each hosted queue in the log, and in history and top
+            self.log_queue = queue_name
+        elif logfilename:
+            self.logger = queue_logger(modules)
         self.log_namespace = "client-queue"
 
+        # Limits on how often clients may send commands, and how many modules may start at once
+        if host is not None:
+            self.admission = host.admission
+        else:
+            self.admission = admission.from_settings(settings.get("admission",False))
+
+        # Pre-start processes for the module types that want them (see shmooze.modules.warm)
+        warm.prestart(list(modules)+list(backgrounds))
+
+        # Save the queue when it changes, and restore it from the last time it ran
+        self.snapshot_writer=None
+        self.snapshot_pending=False
+        # Until restore() is done, the queue is only part of what was saved, so it isn't saved again
+        self.restoring=False
+        if self.snapshot_settings:
+            self.snapshot_path=self.snapshot_settings["path"]
+            if queue_name is not None:
+                self.snapshot_path="{0}.{1}".format(self.snapshot_path,queue_name)
+            self.snapshot_writer=snapshot.SnapshotWriter(self.snapshot_path)
+            self.snapshot_writer.start()
+            def restore_done(f):
+                if f.exception() is not None:
+                    print "Error restoring queue:",f.exception()
+            self.restoring=True
+            service.ioloop.add_future(self.restore(),restore_done)
+
         # JSONCommandService handles all of the low-level TCP connection stuff.
-        super(Queue,self).__init__()
+        if host is None:
+            super(Queue,self).__init__()
+
+    # A hosted queue's commands are counted apart from those of the other queues, under client-queue:<name>
+    def stats_name(self):
+        if self.log_queue is not None:
+            return "{0}:{1}".format(self.log_namespace,self.log_queue)
+        return self.log_namespace
 
     # Get a new UID for a module.
     def get_uid(self):
@@ -58,10 +132,9 @@ class Queue(service.JSONCommandProcessor, service.Service):
     # Retrieves given parameters from the module
     @service.coroutine
     def ask_module(self,uid,parameters):
-        d=dict(self.queue)
-        if uid not in d:
+        if uid not in self.queue:
             raise Exception("Module identifier not in queue")
-        raise service.Return(d[uid].get_multiple_parameters(parameters))
+        raise service.Return(self.queue[uid].get_multiple_parameters(parameters))
 
     # Called fom client
     # Retrieves given parameters from the background
@@ -86,30 +159,160 @@ class Queue(service.JSONCommandProcessor, service.Service):
     def backgrounds_available(self):
         raise service.Return(self.backgrounds_available_dict.keys())
 
+    # Info about a module on the queue, or the background
+    def describe(self,uid,obj,parameters):
+        d={'uid':uid,'type':obj.TYPE_STRING}
+        if obj.TYPE_STRING in parameters:
+            d['parameters']=obj.get_multiple_parameters(parameters[obj.TYPE_STRING])
+        return d
+
     # Called from client
     # Retrieves the current queue, and info about modules on it
+    # With since_version (the version from an earlier response), only returns what changed since then:
+    #   'version': the current version
+    #   'uids': the order of the queue, if it changed
+    #   'modules': info about modules added, or with changed parameters
     @service.coroutine
-    def get_queue(self,parameters={}):
-        l=[]
-        for (uid,obj) in self.queue:
-            d={'uid':uid,'type':obj.TYPE_STRING}
-            if obj.TYPE_STRING in parameters:
-                d['parameters']=obj.get_multiple_parameters(parameters[obj.TYPE_STRING])
-            l.append(d)
-        raise service.Return(l)
+    def get_queue(self,parameters={},since_version=None):
+        if since_version is None:
+            raise service.Return([self.describe(uid,obj,parameters) for (uid,obj) in self.queue])
+        # A version from the future means the queue was restarted
+        full=since_version > self.state.version
+        result={'version':self.state.version}
+        if full or self.queue_version > since_version:
+            result['uids']=self.queue.uids()
+        result['modules']=[self.describe(uid,obj,parameters) for (uid,obj) in self.queue if full or obj.version > since_version]
+        raise service.Return(result)
 
     # Called from client
     # Retrieves the current background, and info about it
+    # With since_version, returns {'version': the current version}, plus 'bg' if it changed since then
     @service.coroutine
-    def get_bg(self,parameters={}):
-        if self.bg is None:
-            return None
-        (uid,obj)=self.bg
+    def get_bg(self,parameters={},since_version=None):
+        d=None
+        if self.bg is not None:
+            (uid,obj)=self.bg
+            d=self.describe(uid,obj,parameters)
+        if since_version is None:
+            raise service.Return(d)
+        result={'version':self.state.version}
+        bg_version=max(self.bg_version,self.bg[1].version if self.bg is not None else 0)
+        if since_version > self.state.version or bg_version > since_version:
+            result['bg']=d
+        raise service.Return(result)
 
-        d={'uid':uid,'type':obj.TYPE_STRING}
-        if obj.TYPE_STRING in parameters:
-            d['parameters']=obj.get_multiple_parameters(parameters[obj.TYPE_STRING])
-        raise service.Return(d)
+    # Called from client
+    # Waits until the version is newer than since_version, or timeout seconds pass.
+    # Returns {'version': the current version}
+    @service.coroutine
+    def wait_for_change(self,since_version,timeout=10):
+        version=yield self.state.wait(since_version,timeout)
+        raise service.Return({'version':version})
+
+    # Called from modules on the queue (and the background), when their parameters change
+    def module_changed(self,obj):
+        obj.version=self.state.bump()
+        self.schedule_snapshot()
+
+    # Save a snapshot of the queue soon, collecting together changes made in the meantime
+    def schedule_snapshot(self):
+        if self.snapshot_writer is None or self.snapshot_pending or self.restoring:
+            return
+        self.snapshot_pending=True
+        service.ioloop.call_later(self.snapshot_settings.get("delay",1.0),self.write_snapshot)
+
+    def write_snapshot(self):
+        self.snapshot_pending=False
+        if self.snapshot_writer is not None and not self.restoring:
+            self.snapshot_writer.put(self.snapshot())
+
+    # What's needed to re-create the queue and background: their modules' uids, types, arguments and parameters
+    def snapshot(self):
+        def entry(uid,obj):
+            return {'uid':uid,'type':obj.TYPE_STRING,'args':getattr(obj,'args',None),'parameters':dict(obj.parameters)}
+        return {
+            'instance':self.instance,
+            'queue':[entry(uid,obj) for (uid,obj) in self.queue],
+            'bg':entry(*self.bg) if self.bg is not None else None,
+        }
+
+    # Start the modules described by the given snapshot entries, at most restore_concurrency at a time.
+    # Modules that haven't started by the time restore_timeout seconds have passed are abandoned.
+    # Returns a list with a started module, or None, for each entry.
+    @service.coroutine
+    def start_modules(self,entries,make):
+        deadline=time.time()+self.snapshot_settings.get("restore_timeout",30)
+        objs=[]
+        for entry in entries:
+            try:
+                obj=make(entry['type'],entry['uid'])
+                obj.parameters=dict(entry.get('parameters') or {})
+                objs.append(obj)
+            except Exception as e:
+                print "Could not restore module {0}: {1}".format(entry.get('uid'),e)
+                objs.append(None)
+        errors=yield module.start_many([(m,entry.get('args')) for m,entry in zip(objs,entries) if m is not None],
+                                       self.snapshot_settings.get("restore_concurrency",8),deadline)
+        errors=iter(errors)
+        result=[]
+        for obj,entry in zip(objs,entries):
+            if obj is not None:
+                error=next(errors)
+                if error is not None:
+                    print "Could not restore module {0}: {1}".format(entry['uid'],error)
+                    obj=None
+            result.append(obj)
+        raise service.Return(result)
+
+    # Re-create the queue and background from the last snapshot, if there is one.
+    # Restored modules go in front of anything added while they were starting, as they were on the queue first.
+    @service.coroutine
+    def restore(self):
+        try:
+            yield self.restore_snapshot()
+        finally:
+            self.restoring=False
+            # Save whatever changed in the meantime
+            self.schedule_snapshot()
+
+    @service.coroutine
+    def restore_snapshot(self):
+        saved=snapshot.load(self.snapshot_path)
+        if not saved:
+            return
+        start=time.time()
+        entries=saved.get('queue') or []
+        bg_entry=saved.get('bg')
+        modules=yield self.start_modules(entries,self.make_module)
+        bg=None
+        if bg_entry is not None:
+            bg=(yield self.start_modules([bg_entry],self.make_background))[0]
+        with (yield self.queue_lock.acquire()):
+            for obj in modules:
+                if obj is not None:
+                    self.queue.append(obj.uid,obj)
+                    self.module_changed(obj)
+            self.queue.move_to_front([obj.uid for obj in modules if obj is not None])
+            if bg is not None:
+                # Unless a new background was set in the meantime
+                if self.bg is None:
+                    self.bg=(bg_entry['uid'],bg)
+                else:
+                    bg.terminate()
+            yield self.queue_updated()
+        restored=len([m for m in modules+[bg] if m is not None])
+        total=len(entries)+(1 if bg_entry is not None else 0)
+        elapsed=time.time()-start
+        stats.collector("queue-restore").record("restore",elapsed,restored < total)
+        print "Restored {0} of {1} modules in {2:.2f}s".format(restored,total,elapsed)
+
+    # Called from client
+    # Retrieves the most played items of a module type, optionally only counting the last window_days days
+    @service.coroutine
+    def top(self,type,n=10,window_days=None):
+        if self.logger is None or self.logger.aggregator is None:
+            raise Exception("Top lists are not enabled")
+        raise service.Return(self.logger.top_items(type,n,window_days,queue=self.log_queue))
 
     # Called from client
     # Issues a command to a module
@@ -117,10 +320,9 @@ class Queue(service.JSONCommandProcessor, service.Service):
     # This is in contrast to ask_module which only retrieves cached information and does not create additional transactions.
     @service.coroutine
     def tell_module(self,uid,cmd,args={}):
-        d=dict(self.queue)
-        if uid not in d:
+        if uid not in self.queue:
             raise Exception("Module identifier not in queue")
-        result = yield d[uid].tell(cmd,args)
+        result = yield self.queue[uid].tell(cmd,args)
         raise service.Return(result)
 
     # Called from client
@@ -135,12 +337,8 @@ class Queue(service.JSONCommandProcessor, service.Service):
         result = yield bg_obj.tell(cmd,args)
         raise service.Return(result)
 
-    # Called from client
-    # Create a new module and add it to the queue
-    # May take a little while as module is spawned and constructed.
-    @service.coroutine
-    def add(self,type,args={}):
-        uid=self.get_uid()
+    # Construct (but don't start) a module to go on the queue
+    def make_module(self,type,uid):
         if type not in self.modules_available_dict:
             raise Exception("Unrecognized module name")
         mod_inst=self.modules_available_dict[type](self.get_remover(uid))
@@ -148,21 +346,82 @@ class Queue(service.JSONCommandProcessor, service.Service):
         mod_inst.uid = uid 
         mod_inst.log_uid = uid 
         mod_inst.log_namespace = "module-instance" 
+        mod_inst.log_queue = self.log_queue
+        mod_inst.on_change = self.module_changed
+        if self.admission is not None:
+            mod_inst.spawn_limit = self.admission.spawn_limit
+        return mod_inst
+
+    # Construct (but don't start) a background
+    def make_background(self,type,uid):
+        if type not in self.backgrounds_available_dict:
+            raise Exception("Unrecognized module name")
+        bg_inst=self.backgrounds_available_dict[type](self.get_remover(uid))
+        bg_inst.on_change=self.module_changed
+        if self.admission is not None:
+            bg_inst.spawn_limit=self.admission.spawn_limit
+        return bg_inst
+
+    # Called from client
+    # Create a new module and add it to the queue
+    # May take a little while as module is spawned and constructed.
+    @service.coroutine
+    def add(self,type,args={}):
+        uid=self.get_uid()
+        mod_inst=self.make_module(type,uid)
         yield mod_inst.new(args)
         with (yield self.queue_lock.acquire()):
-            self.queue.append((uid,mod_inst))
+            self.queue.append(uid,mod_inst)
+            self.module_changed(mod_inst)
             yield self.queue_updated()
         raise service.Return({'uid':uid})
 
+    # Called from client
+    # Create several new modules and add them to the end of the queue, in order.
+    # items is a list of {"type": ..., "args": ...}, like the arguments of add.
+    # Modules are started at the same time (up to add_concurrency at once), and are all added to the queue together.
+    # Returns a list with, for each item, {"uid": ...} if it was added, or {"error": ...} if it wasn't.
+    @service.coroutine
+    def add_many(self,items):
+        results=[]
+        objs=[]
+        for item in items:
+            try:
+                if not isinstance(item,dict):
+                    raise Exception("Item not a dict.")
+                uid=self.get_uid()
+                obj=self.make_module(item.get('type'),uid)
+                objs.append((obj,item.get('args',{})))
+                results.append(obj)
+            except Exception as e:
+                results.append({'error':str(e)})
+        errors=yield module.start_many(objs,self.add_concurrency)
+        errors=iter(errors)
+        added=[]
+        for i,r in enumerate(results):
+            if isinstance(r,dict):
+                continue
+            error=next(errors)
+            if error is not None:
+                results[i]={'error':str(error)}
+            else:
+                added.append(r)
+                results[i]={'uid':r.uid}
+        if added:
+            with (yield self.queue_lock.acquire()):
+                for obj in added:
+                    self.queue.append(obj.uid,obj)
+                    self.module_changed(obj)
+                yield self.queue_updated()
+        raise service.Return(results)
+
     # Called from client
     # Create a new background and add it to the queue
     # May take a little while as background is spawned and constructed.
     @service.coroutine
     def set_bg(self,type,args={}):
         uid=self.get_uid()
-        if type not in self.backgrounds_available_dict:
-            raise Exception("Unrecognized module name")
-        bg_inst=self.backgrounds_available_dict[type](self.get_remover(uid))
+        bg_inst=self.make_background(type,uid)
         yield bg_inst.new(args)
         with (yield self.queue_lock.acquire()):
             self.bg=(uid,bg_inst)
@@ -175,7 +434,8 @@ class Queue(service.JSONCommandProcessor, service.Service):
     @service.coroutine
     def rm(self,uids):
         with (yield self.queue_lock.acquire()):
-            self.queue=[(uid,obj) for (uid,obj) in self.queue if uid not in uids]
+            for uid in uids:
+                self.queue.discard(uid)
             if self.bg is not None and self.bg[0] in uids:
                 self.bg=None
             yield self.queue_updated()
@@ -186,70 +446,55 @@ class Queue(service.JSONCommandProcessor, service.Service):
     @service.coroutine
     def mv(self,uids):
         with (yield self.queue_lock.acquire()):
-            newqueue=[]
-            oldqueue=[uid for (uid,obj) in self.queue]
-            d=dict(self.queue)
-            for uid in uids:
-                if uid in oldqueue:
-                    oldqueue.remove(uid)
-                    newqueue.append(uid)
-            newqueue+=oldqueue
-            self.queue=[(uid,d[uid]) for uid in newqueue]
+            self.queue.move_to_front(uids)
             yield self.queue_updated()
 
-    # Take a diff of the queue, and issue appropriate commands to modules (play, suspend, and rm) if necessary.
-    # May take a little while as the commands are executed.
-    # Commands are executed simultaneously.
+    # Take a diff of the queue, and set the state each affected module should be in (play, suspend, or rm).
+    # Returns straight away: modules are brought to their new states in the background (see Module.transition),
+    # so a slow or hung module doesn't hold up changes to the queue.
+    # Modules that fail to change state are terminated, which removes them from the queue.
     # Queue should be locked for this operation
-    # TODO harden this
     @service.coroutine
     def queue_updated(self):
-        again=True
-        while again:
-            again=False
-            cur_uids=[uid for (uid,obj) in self.queue]
-            to_remove=[((uid,obj),obj.remove) for (uid,obj) in self.old_queue if uid not in cur_uids and obj.alive]
-            if self.bg:
-                bg_uid,bg_obj=self.bg
-            if self.old_bg:
-                old_bg_uid,old_bg_obj=self.old_bg
-            if self.old_bg is not None and (self.bg is None or bg_uid != old_bg_uid) and old_bg_obj.alive:
-                to_remove.append(((old_bg_uid,old_bg_obj),old_bg_obj.remove))
-            to_play=[]
-            if len(self.queue) > 0:
-                uid,obj=self.queue[0]
-                if not obj.is_on_top:
-                    to_play=[((uid,obj),obj.play)]
-            elif self.bg:
-                if not bg_obj.is_on_top:
-                    to_play=[((bg_uid,bg_obj),bg_obj.play)]
-
-            to_suspend=[((uid,obj),obj.suspend) for (uid,obj) in self.queue[1:] if obj.is_on_top]
-            if len(self.queue) > 0 and self.bg:
-                to_suspend.append(((bg_uid,bg_obj),bg_obj.suspend))
-
-            self.old_queue=self.queue
-            self.old_bg=self.bg
-
-            actions=to_remove+to_suspend+to_play
-            try:
-                if len(actions) > 0:
-                    # Execute all operations simultaneously
-                    actions=[(mod,future()) for mod,future in actions]
-                    yield [future for uid,future in actions]
-            except Exception as e:
-                print "Errors trying to update queue:"
-                for (uid,obj),f in actions:
-                    if f.exception():
-                        print "- {0} raised {1}".format(uid,f.exception())
-                bad_modules=[mod for mod,f in actions if f.exception()]
-                print "Removing bad modules:",bad_modules
-                for uid,obj in bad_modules:
-                    obj.terminate()
-                self.queue=[(uid,obj) for uid,obj in self.queue if uid not in [uid2 for uid2,obj2 in bad_modules]]
-                if self.bg is not None and self.bg[0] in [uid for uid,obj in bad_modules]:
-                    self.bg=None
-                again=True
+        self.queue_version=self.state.bump()
+        if self.bg != self.old_bg:
+            self.bg_version=self.queue_version
+
+        for uid,obj in self.queue.take_removed():
+            self.playing.pop(uid,None)
+            if obj.alive:
+                module.transition(self.transitions,uid,obj,"rm")
+        if self.old_bg is not None and self.bg != self.old_bg and self.old_bg[1].alive:
+            module.transition(self.transitions,self.old_bg[0],self.old_bg[1],"rm")
+
+        top=self.queue.first()
+        # Only modules that were told to play can need suspending
+        for uid,obj in self.playing.items():
+            if top is None or uid != top[0]:
+                del self.playing[uid]
+                module.transition(self.transitions,uid,obj,"suspend")
+        if top is not None:
+            uid,obj=top
+            self.playing[uid]=obj
+            module.transition(self.transitions,uid,obj,"play")
+        if self.bg is not None:
+            module.transition(self.transitions,self.bg[0],self.bg[1],"suspend" if top is not None else "play")
+
+        self.old_bg=self.bg
+
+        self.prefetch()
+        self.schedule_snapshot()
+
+    # Send prepare to the next few modules on the queue, without waiting for them
+    def prefetch(self):
+        def prepare_done(f):
+            if f.exception() is not None:
+                print "Error preparing module:",f.exception()
+        for i,(uid,obj) in enumerate(self.queue.rest()):
+            if i >= self.prefetch_depth:
+                break
+            if not obj.prepared:
+                service.ioloop.add_future(obj.prepare(),prepare_done)
 
     # Returns a coroutine that may be executed to remove the current module from the queue
     # Generally, the result of this function is passed into a newly constructed module, so that
@@ -258,7 +503,7 @@ class Queue(service.JSONCommandProcessor, service.Service):
         @service.coroutine
         def remove_self():
             with (yield self.queue_lock.acquire()):
-                self.queue=[(uid,obj) for (uid,obj) in self.queue if uid != my_uid]
+                self.queue.discard(my_uid)
                 if self.bg is not None and self.bg[0] == my_uid:
                     self.bg=None
                 yield self.queue_updated()
@@ -266,20 +511,48 @@ class Queue(service.JSONCommandProcessor, service.Service):
 
     def shutdown(self):
         def shutdown_complete(f):
+            warm.close_all()
+            if self.logger is not None:
+                self.logger.close()
             service.ioloop.stop()
-        service.ioloop.add_future(self.killall(),shutdown_complete)
+        service.ioloop.add_future(self.close(),shutdown_complete)
+
+    # Remove all modules, after saving a snapshot of the queue as it was, so that it comes back when the queue restarts
+    @service.coroutine
+    def close(self):
+        if self.snapshot_writer is not None:
+            if not self.restoring:
+                self.snapshot_writer.put(self.snapshot())
+            self.snapshot_writer.close()
+            self.snapshot_writer=None
+        yield self.killall()
+
+    # Whether the queue has nothing in it or going on
+    def idle(self):
+        return not self.queue and self.bg is None and not self.transitions and not self.queue_lock.locked()
 
     @service.coroutine
     def killall(self):
         with (yield self.queue_lock.acquire()):
-            self.queue=[]
+            self.queue.clear()
             self.bg=None
             yield self.queue_updated()
+        # Wait for the modules to be removed
+        # (finished transitions stay in the set until their callbacks run, so only wait on the unfinished ones)
+        while True:
+            pending=[f for f in self.transitions if not f.done()]
+            if not pending:
+                break
+            try:
+                yield pending
+            except Exception:
+                pass
 
     commands = {
         'rm':rm,
         'mv':mv,
         'add':add,
+        'add_many':add_many,
         'queue':get_queue,
         'bg':get_bg,
         'set_bg':set_bg,
@@ -289,6 +562,15 @@ class Queue(service.JSONCommandProcessor, service.Service):
         'tell_background':tell_background,
         'ask_module':ask_module,
         'ask_background':ask_background,
+        'top':top,
+        'wait_for_change':wait_for_change,
+        'history':service.JSONCommandProcessor.get_history,
     }
 
-    log_cmds = ['rm','mv','add','set_bg','tell_module','tell_background']
+    log_cmds = ['rm','mv','add','add_many','set_bg','tell_module','tell_background']
+
+    read_only_cmds = ['stats','queue','bg','top','history','wait_for_change','modules_available','backgrounds_available','ask_module','ask_background']
+
+    cached_cmds = ['queue','bg']
+
+    per_item_cmds = {'add_many':('add','items')}
@@ -2,4 +2,5 @@ import shmooze.wsgi
 import shmooze.settings
 import werkzeug.serving
 
-werkzeug.serving.run_simple('',shmooze.settings.ports["wsgi"],shmooze.wsgi.application,use_reloader=False, use_debugger=False)
+# Threaded, so that a client waiting on a long-poll (wait_for_change) doesn't hold up everyone else's requests
+werkzeug.serving.run_simple('',shmooze.settings.ports["wsgi"],shmooze.wsgi.application,use_reloader=False, use_debugger=False, threaded=True)
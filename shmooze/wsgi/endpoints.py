@@ -1,5 +1,6 @@
 import util
 import pkg_resources
+import shmooze.lib.transport as transport
 import shmooze.settings as settings
 
 prefix = settings.get("wsgi_prefix", "/")
@@ -10,7 +11,8 @@ wsgi_endpoints = {
     prefix + "settings.json": util.wsgi_settings_json(settings.public_settings),
 }
 
-for service, portnum in settings.ports.items():
+for service in settings.ports:
     if service != "wsgi":
-        wsgi_endpoints[prefix + service] = util.wsgi_control("localhost", portnum)
+        addr, port = transport.service_address(service)
+        wsgi_endpoints[prefix + service] = util.wsgi_control(addr, port)
 
@@ -1,34 +1,85 @@
 import werkzeug
 import json
-import socket
+import shmooze.lib.codec as codec
+import shmooze.lib.transport as transport
+import shmooze.settings as settings
 
+# Same as shmooze.lib.service.StateVersion.max_wait; the wsgi server doesn't run an IOLoop
+service_max_wait=60
+
+# How much longer than usual to wait for a response, for commands which wait for a change (wait_for_change)
+def long_poll_time(inp):
+    if isinstance(inp,list):
+        return max([long_poll_time(c) for c in inp] or [0])
+    if isinstance(inp,dict) and inp.get('cmd') == 'wait_for_change':
+        args=inp.get('args')
+        if isinstance(args,dict):
+            try:
+                return float(args.get('timeout',10))
+            except (TypeError,ValueError):
+                return 0
+        return 10
+    return 0
+
+# Proxies (and shmooze services) trust these peers to say who the real client is
+trusted_proxies=set(settings.get("trusted_proxies",['127.0.0.1','::1','local']))
+
+# The address of the client that sent a request, looking through any trusted proxies in front of us
+def client_address(request):
+    addr=request.remote_addr
+    forwarded=request.headers.get('X-Forwarded-For')
+    if forwarded:
+        hops=[h.strip() for h in forwarded.split(',') if h.strip()]
+        while hops and addr in trusted_proxies:
+            addr=hops.pop()
+    return addr
+
+# Tell the service who the commands are from, for its admission control (see JSONCommandProcessor.client_of)
+def tag_client(inp,client):
+    if isinstance(inp,list):
+        for c in inp:
+            tag_client(c,client)
+    elif isinstance(inp,dict):
+        inp['client']=client
+
+# If port is None, addr is the path of a unix socket
 def wsgi_control(addr,port,timeout=10):
 
+    wire_codec=codec.get(transport.wire_codec)
+
+    # Returns the response as JSON text.
+    # JSON from the service is passed on as it is, rather than decoded and encoded again
+    # (so responses the service has cached, see shmooze.lib.service.ResponseCache, are never re-encoded)
     def query(inp):
-        data=json.dumps(inp)
-        s=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(timeout)
-        s.connect((addr,port))
-        s.sendall(data+'\n')
+        s,address=transport.client_socket(addr,port)
+        s.settimeout(timeout+min(long_poll_time(inp),service_max_wait))
+        s.connect(address)
+        s.sendall(wire_codec.encode(inp))
         result=''
         while True:
-            result+=s.recv(4096)
-            if '\n' in result:
-                result=result[0:result.find('\n')]
+            outp,result=wire_codec.split_buffer(result)
+            if outp is not None:
                 break
+            data=s.recv(4096)
+            if not data:
+                raise Exception("Connection closed before a response was received")
+            result+=data
         s.close()
-        return json.loads(result)
+        if wire_codec.name != 'json':
+            outp=json.dumps(wire_codec.decode(outp))
+        return outp
 
     @werkzeug.Request.application
     def wsgi(request):
         mime_type = request.headers.get('content-type').partition(';')[0]
         if mime_type in {'text/json', 'application/json'}:
             inp=json.loads(request.data)
+            tag_client(inp,client_address(request))
             try:
                 outp=query(inp)
             except Exception as e:
                 return werkzeug.exceptions.InternalServerError(e)
-            return werkzeug.Response(json.dumps(outp),content_type='text/json')
+            return werkzeug.Response(outp,content_type='text/json')
         return werkzeug.Response('Endpoint only accepts JSON.')
     return wsgi
 
@@ -91,6 +91,29 @@
         this.reqs = [];
     }
 
+    // Long-poll for a change of state (the queue and pool's "wait_for_change" command).
+    // Sent on its own, so that it doesn't hold up queries batched by runQueries.
+    // Calls cb with the new version, which may be the same as `version` if nothing changed within `timeout` seconds.
+    Endpoint.prototype.waitForChange = function(version, timeout, cb, err){
+        $.ajax(this.url, {
+            data: JSON.stringify({"cmd": "wait_for_change", "args": {"since_version": version, "timeout": timeout}}),
+            dataType: 'json',
+            type: 'POST',
+            contentType: 'text/json',
+            success: function(resp){
+                if(!resp.success){
+                    console.error("Server Error:", resp.error);
+                    err && err();
+                }else{
+                    cb(resp.result.version);
+                }
+            },
+            error: function(){
+                err && err();
+            }
+        });
+    }
+
     exports.endpoints = {};
 
     exports.regainConnection = function(){
@@ -0,0 +1,4 @@
+import os
+
+# The tests use their own settings, unless others are given
+os.environ.setdefault("SHMOOZE_SETTINGS", os.path.join(os.path.dirname(os.path.abspath(__file__)), "settings.json"))
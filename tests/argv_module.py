@@ -0,0 +1,15 @@
+# A module that only understands "host cmd_port update_port" arguments, like those written before the rendezvous
+import json
+import socket
+import sys
+import time
+
+host, cmd_port, update_port = sys.argv[-3], int(sys.argv[-2]), int(sys.argv[-1])
+cs = socket.create_connection((host, cmd_port))
+us = socket.create_connection((host, update_port))
+for line in cs.makefile():
+    cmd = json.loads(line)
+    if cmd['cmd'] == 'prepare':
+        # Slow to get ready
+        time.sleep(1)
+    cs.sendall(json.dumps({'success': True, 'result': cmd['cmd']}) + '\n')
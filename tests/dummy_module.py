@@ -0,0 +1,29 @@
+# A module built on shmooze.modules, which does nothing but keep track of its state
+import shmooze.modules
+
+class Dummy(shmooze.modules.JSONParentPoller):
+    running = True
+
+    def init(self, **kwargs):
+        self.set_parameters({'state': 'init'})
+
+    def play(self):
+        self.set_parameters({'state': 'play'})
+
+    def suspend(self):
+        self.set_parameters({'state': 'suspend'})
+
+    def rm(self):
+        self.running = False
+
+    commands = {
+        'init': init,
+        'play': play,
+        'suspend': suspend,
+        'rm': rm,
+    }
+
+d = Dummy()
+while d.running:
+    d.handle_one_command()
+d.close()
@@ -0,0 +1,118 @@
+import json
+import unittest
+
+import shmooze.lib.admission as admission
+import shmooze.lib.service as service
+from tests.util import run
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst_then_refill(self):
+        bucket = admission.TokenBucket(2, 3, 0)
+        for i in range(3):
+            self.assertEqual(bucket.wait_time(0), 0)
+            bucket.take()
+        self.assertEqual(bucket.wait_time(0), 0.5)
+        self.assertEqual(bucket.wait_time(0.5), 0)
+
+    def test_refill_stops_at_burst(self):
+        bucket = admission.TokenBucket(2, 3, 0)
+        bucket.take()
+        self.assertTrue(bucket.full(100))
+        self.assertEqual(bucket.tokens, 3)
+
+    def test_several_tokens(self):
+        bucket = admission.TokenBucket(1, 3, 0)
+        bucket.take(2)
+        self.assertEqual(bucket.wait_time(0, 2), 1)
+
+    def test_rate_must_be_positive(self):
+        self.assertRaises(ValueError, admission.TokenBucket, 0, 1, 0)
+        self.assertRaises(ValueError, admission.from_settings, {"per_client": {"rate": 0, "burst": 5}})
+        self.assertRaises(ValueError, admission.from_settings, {"per_command": {"add": {"rate": 1, "burst": 0}}})
+
+class AdmissionTest(unittest.TestCase):
+    def setUp(self):
+        self.admission = admission.Admission({"rate": 10, "burst": 4}, {"add": {"rate": 1, "burst": 2}})
+
+    def test_rejects_with_retry_after(self):
+        self.assertIsNone(self.admission.admit('a', 'add'))
+        self.assertIsNone(self.admission.admit('a', 'add'))
+        retry_after = self.admission.admit('a', 'add')
+        self.assertTrue(0 < retry_after <= 1)
+        # Other commands have only the per-client limit
+        self.assertIsNone(self.admission.admit('a', 'queue'))
+        # Which was charged for the rejected add too, so this is the fourth
+        self.assertIsNone(self.admission.admit('a', 'queue'))
+        self.assertIsNotNone(self.admission.admit('a', 'queue'))
+        self.assertEqual(self.admission.stats()['rejected'], {'add': 1, 'queue': 1})
+
+    def test_clients_are_separate(self):
+        self.admission.admit('a', 'add')
+        self.admission.admit('a', 'add')
+        self.assertIsNotNone(self.admission.admit('a', 'add'))
+        self.assertIsNone(self.admission.admit('b', 'add'))
+
+    def test_count(self):
+        self.assertIsNone(self.admission.admit('a', 'add', 2))
+        self.assertIsNotNone(self.admission.admit('a', 'add', 1))
+        self.assertRaises(admission.TooLarge, self.admission.admit, 'b', 'add', 3)
+
+class SpawnLimitTest(unittest.TestCase):
+    def test_concurrency_cap(self):
+        limit = admission.SpawnLimit(2)
+        @service.coroutine
+        def go():
+            yield limit.acquire()
+            yield limit.acquire()
+            third = limit.acquire()
+            yield service.sleep(0.05)
+            self.assertFalse(third.done())
+            self.assertEqual((limit.active, limit.waiting), (2, 1))
+            limit.release()
+            yield third
+            self.assertEqual((limit.active, limit.waiting), (2, 0))
+        run(go)
+
+class Adder(service.JSONCommandProcessor):
+    log_namespace = 'adder'
+
+    def __init__(self):
+        self.admission = admission.Admission(None, {"add": {"rate": 1, "burst": 3}})
+
+    @service.coroutine
+    def add(self):
+        pass
+
+    @service.coroutine
+    def add_many(self, items):
+        pass
+
+    commands = {
+        'add': add,
+        'add_many': add_many,
+    }
+
+    per_item_cmds = {'add_many': ('add', 'items')}
+
+class ServiceAdmissionTest(unittest.TestCase):
+    def command(self, processor, line, peer='127.0.0.1'):
+        return run(lambda: processor.single_command(line, peer))
+
+    def test_add_many_charged_per_item(self):
+        adder = Adder()
+        self.assertTrue(self.command(adder, {'cmd': 'add_many', 'args': {'items': [{}, {}]}})['success'])
+        response = self.command(adder, {'cmd': 'add_many', 'args': {'items': [{}, {}]}})
+        self.assertFalse(response['success'])
+        # Always valid JSON
+        json.loads(json.dumps(response, allow_nan=False))
+        self.assertTrue(response['retry_after'] > 0)
+        self.assertFalse(self.command(adder, {'cmd': 'add_many', 'args': {'items': [{}] * 4}})['success'])
+
+    def test_client_field_not_trusted_by_default(self):
+        adder = Adder()
+        for i in range(3):
+            self.assertTrue(self.command(adder, {'cmd': 'add', 'client': 'client-%d' % i})['success'])
+        self.assertFalse(self.command(adder, {'cmd': 'add', 'client': 'someone-else'})['success'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import shmooze.lib.cmdlog as cmdlog
+
+def lines(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+# Wait up to timeout seconds for check() to be true
+def wait_for(check, timeout=2):
+    deadline = time.time() + timeout
+    while not check() and time.time() < deadline:
+        time.sleep(0.01)
+    return check()
+
+class FileLoggerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cmd.log')
+        self.fsyncs = []
+        self.fsync = os.fsync
+        os.fsync = self.fsyncs.append
+        self.loggers = []
+
+    def tearDown(self):
+        for logger in self.loggers:
+            if not logger.stopping:
+                logger.close()
+        os.fsync = self.fsync
+        shutil.rmtree(self.dir)
+
+    def logger(self, **kwargs):
+        logger = cmdlog.FileLogger(self.path, **kwargs)
+        self.loggers.append(logger)
+        return logger
+
+    def test_buffers_until_flush(self):
+        logger = self.logger(flush_interval=60)
+        logger.log({'n': 1})
+        logger.log('uid', 'ns', {'cmd': 'add'}, {'success': True})
+        self.assertEqual(lines(self.path), [])
+        logger.flush()
+        entries = lines(self.path)
+        self.assertEqual(entries[0], {'n': 1})
+        self.assertEqual(entries[1]['sent'], {'cmd': 'add'})
+        self.assertEqual(entries[1]['uid'], 'uid')
+
+    def test_full_buffer_is_written(self):
+        logger = self.logger(flush_interval=60, buffer_size=5)
+        logger.log({'n': 1})
+        self.assertTrue(wait_for(lambda: lines(self.path) == [{'n': 1}]))
+
+    def test_flush_interval(self):
+        logger = self.logger(flush_interval=0.05)
+        logger.log({'n': 1})
+        self.assertTrue(wait_for(lambda: lines(self.path) == [{'n': 1}]))
+
+    def test_close_flushes(self):
+        logger = self.logger(flush_interval=60)
+        logger.log({'n': 1})
+        logger.close()
+        self.assertEqual(lines(self.path), [{'n': 1}])
+
+    def test_fsync_none(self):
+        logger = self.logger(flush_interval=60)
+        logger.log({'n': 1})
+        logger.close()
+        self.assertEqual(self.fsyncs, [])
+
+    def test_fsync_always(self):
+        logger = self.logger(flush_interval=60, fsync='always')
+        logger.log({'n': 1})
+        # Written and synced before log() returns
+        self.assertEqual(lines(self.path), [{'n': 1}])
+        self.assertEqual(len(self.fsyncs), 1)
+        logger.log({'n': 2})
+        self.assertEqual(len(self.fsyncs), 2)
+        logger.close()
+        self.assertEqual(len(self.fsyncs), 2)
+
+    def test_fsync_periodic(self):
+        logger = self.logger(flush_interval=60, fsync='periodic', fsync_interval=0.2)
+        logger.log({'n': 1})
+        logger.flush()
+        self.assertEqual(len(self.fsyncs), 1)
+        # Too soon after the last fsync to sync again when it is written...
+        logger.log({'n': 2})
+        logger.flush()
+        self.assertEqual(len(self.fsyncs), 1)
+        # ...but it is synced within fsync_interval, although nothing else is written
+        self.assertTrue(wait_for(lambda: len(self.fsyncs) == 2))
+        time.sleep(0.3)
+        self.assertEqual(len(self.fsyncs), 2)
+        logger.close()
+        self.assertEqual(len(self.fsyncs), 2)
+
+    def test_rotate_by_size(self):
+        logger = self.logger(flush_interval=60, max_bytes=30, backup_count=2)
+        for i in range(4):
+            logger.log({'n': i, 'pad': 'x' * 5})
+            logger.flush()
+        logger.close()
+        self.assertEqual(lines(self.path), [{'n': 3, 'pad': 'xxxxx'}])
+        self.assertEqual(lines(self.path + '.1'), [{'n': 2, 'pad': 'xxxxx'}])
+        self.assertEqual(lines(self.path + '.2'), [{'n': 1, 'pad': 'xxxxx'}])
+        self.assertFalse(os.path.exists(self.path + '.3'))
+
+    def test_rotate_daily(self):
+        logger = self.logger(flush_interval=60, rotate_daily=True)
+        day = datetime.date(2020, 1, 1)
+        logger.today = lambda: day
+        logger.day = day
+        logger.log({'n': 1})
+        logger.flush()
+        day = datetime.date(2020, 1, 2)
+        logger.log({'n': 2})
+        logger.flush()
+        logger.close()
+        self.assertEqual(lines(self.path + '.2020-01-01'), [{'n': 1}])
+        self.assertEqual(lines(self.path), [{'n': 2}])
+
+if __name__ == '__main__':
+    unittest.main()
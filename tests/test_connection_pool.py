@@ -0,0 +1,110 @@
+import unittest
+
+import shmooze.lib.service as service
+from tests.util import free_port, run
+
+class Echo(service.JSONCommandProcessor, service.Service):
+    def __init__(self):
+        self.streams = []
+        self.port = free_port()
+        super(Echo, self).__init__()
+
+    def handle_stream(self, stream, address):
+        self.streams.append(stream)
+        return super(Echo, self).handle_stream(stream, address)
+
+    # Close every connection from the service's end, as a restarting service would
+    def drop_connections(self):
+        for stream in self.streams:
+            stream.close()
+        self.streams = []
+
+    @service.coroutine
+    def echo(self, value):
+        raise service.Return(value)
+
+    @service.coroutine
+    def slow(self, delay):
+        yield service.sleep(delay)
+
+    # Not safe to run twice
+    @service.coroutine
+    def inc(self):
+        self.count += 1
+        raise service.Return(self.count)
+
+    count = 0
+
+    commands = {
+        'echo': echo,
+        'slow': slow,
+        'inc': inc,
+    }
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.service = Echo()
+        self.pool = service.ConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+        self.service.stop()
+
+    def query(self, value):
+        return service.json_query('localhost', self.service.port, {'cmd': 'echo', 'args': {'value': value}}, pool=self.pool)
+
+    def test_reuses_connections(self):
+        @service.coroutine
+        def go():
+            for i in range(3):
+                r = yield self.query(i)
+                self.assertEqual(r['result'], i)
+        run(go)
+        self.assertEqual(self.pool.stats()['misses'], 1)
+
+    @service.coroutine
+    def query_after_drop(self):
+        r = yield self.query(1)
+        self.assertEqual(r['result'], 1)
+        self.service.drop_connections()
+        r = yield self.query(2)
+        raise service.Return(r)
+
+    def test_closed_connection_not_reused(self):
+        self.assertEqual(run(self.query_after_drop, timeout=5)['result'], 2)
+        self.assertEqual(self.pool.stats()['misses'], 2)
+
+    # A request that never went out on its connection is sent on a new one
+    def test_retry_unsent_request(self):
+        @service.coroutine
+        def go():
+            conn = self.pool.connect('localhost', self.service.port)
+            f = self.query(1)
+            # Still connecting, so the request hasn't been written yet
+            conn.close()
+            r = yield f
+            raise service.Return(r)
+        self.assertEqual(run(go, timeout=5)['result'], 1)
+        self.assertEqual(self.pool.stats()['retries'], 1)
+
+    # When one request times out, requests pipelined behind it on the same connection fail rather than being sent again
+    def test_no_retry_after_timeout(self):
+        @service.coroutine
+        def go():
+            r = yield service.json_query('localhost', self.service.port, {'cmd': 'inc'}, pool=self.pool)
+            self.assertEqual(r['result'], 1)
+            slow = service.json_query('localhost', self.service.port, {'cmd': 'slow', 'args': {'delay': 1}}, timeout=0.3, pool=self.pool)
+            inc = service.json_query('localhost', self.service.port, {'cmd': 'inc'}, timeout=2, pool=self.pool)
+            for f in (slow, inc):
+                try:
+                    yield f
+                except Exception:
+                    pass
+            # The service still runs the inc that was sent, once slow is done
+            yield service.sleep(1)
+        run(go, timeout=5)
+        self.assertEqual(self.service.count, 2)
+        self.assertEqual(self.pool.stats()['retries'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
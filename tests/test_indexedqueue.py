@@ -0,0 +1,138 @@
+import unittest
+
+from shmooze.lib.indexedqueue import IndexedQueue, PREV, NEXT, UID, OBJ
+
+class IndexedQueueTest(unittest.TestCase):
+    # Check that the links agree with each other and with the index, and that the queue holds expected
+    def assertQueue(self, q, expected):
+        self.assertEqual(list(q), expected)
+        self.assertEqual(q.uids(), [uid for uid, obj in expected])
+        self.assertEqual(len(q), len(expected))
+        self.assertEqual(bool(q), bool(expected))
+        self.assertEqual(q.first(), expected[0] if expected else None)
+        self.assertEqual(list(q.rest()), expected[1:])
+
+        # Forwards and backwards through the links
+        forwards = []
+        link = q.root[NEXT]
+        while link is not q.root:
+            self.assertIs(link[NEXT][PREV], link)
+            forwards.append((link[UID], link[OBJ]))
+            link = link[NEXT]
+        backwards = []
+        link = q.root[PREV]
+        while link is not q.root:
+            self.assertIs(link[PREV][NEXT], link)
+            backwards.append((link[UID], link[OBJ]))
+            link = link[PREV]
+        self.assertEqual(forwards, expected)
+        self.assertEqual(backwards, expected[::-1])
+
+        # Every uid is indexed, and nothing else is
+        self.assertEqual(sorted(q.links.keys()), sorted([uid for uid, obj in expected]))
+        for uid, obj in expected:
+            self.assertIn(uid, q)
+            self.assertIs(q[uid], obj)
+            self.assertIs(q.get(uid), obj)
+            self.assertEqual(q.links[uid][UID], uid)
+
+    def test_empty(self):
+        q = IndexedQueue()
+        self.assertQueue(q, [])
+        self.assertNotIn('a', q)
+        self.assertIsNone(q.get('a'))
+        self.assertEqual(q.get('a', 1), 1)
+        self.assertRaises(KeyError, lambda: q['a'])
+
+    def test_append(self):
+        q = IndexedQueue()
+        q.append('a', 1)
+        self.assertQueue(q, [('a', 1)])
+        q.append('b', 2)
+        q.append('c', 3)
+        self.assertQueue(q, [('a', 1), ('b', 2), ('c', 3)])
+        self.assertEqual(q.take_removed(), [])
+
+    def test_append_duplicate(self):
+        q = IndexedQueue([('a', 1)])
+        self.assertRaises(KeyError, q.append, 'a', 2)
+        self.assertQueue(q, [('a', 1)])
+
+    def test_discard(self):
+        q = IndexedQueue([('a', 1), ('b', 2), ('c', 3), ('d', 4)])
+        self.assertTrue(q.discard('b'))
+        self.assertQueue(q, [('a', 1), ('c', 3), ('d', 4)])
+        # First and last
+        self.assertTrue(q.discard('a'))
+        self.assertTrue(q.discard('d'))
+        self.assertQueue(q, [('c', 3)])
+        self.assertFalse(q.discard('a'))
+        self.assertTrue(q.discard('c'))
+        self.assertQueue(q, [])
+        self.assertEqual(q.take_removed(), [('b', 2), ('a', 1), ('d', 4), ('c', 3)])
+        self.assertEqual(q.take_removed(), [])
+
+        # The queue can be used again once it's empty
+        q.append('a', 5)
+        self.assertQueue(q, [('a', 5)])
+
+    def test_discard_while_iterating(self):
+        q = IndexedQueue([('a', 1), ('b', 2), ('c', 3)])
+        seen = []
+        for uid, obj in q:
+            seen.append(uid)
+            q.discard(uid)
+        self.assertEqual(seen, ['a', 'b', 'c'])
+        self.assertQueue(q, [])
+
+    def test_clear(self):
+        q = IndexedQueue([('a', 1), ('b', 2)])
+        q.discard('a')
+        q.clear()
+        self.assertQueue(q, [])
+        self.assertEqual(q.take_removed(), [('a', 1), ('b', 2)])
+        q.append('b', 3)
+        self.assertQueue(q, [('b', 3)])
+
+    def test_move_to_front(self):
+        q = IndexedQueue([('a', 1), ('b', 2), ('c', 3), ('d', 4), ('e', 5)])
+        q.move_to_front(['d', 'b'])
+        self.assertQueue(q, [('d', 4), ('b', 2), ('a', 1), ('c', 3), ('e', 5)])
+        # The last one
+        q.move_to_front(['e'])
+        self.assertQueue(q, [('e', 5), ('d', 4), ('b', 2), ('a', 1), ('c', 3)])
+        # Already at the front
+        q.move_to_front(['e', 'd'])
+        self.assertQueue(q, [('e', 5), ('d', 4), ('b', 2), ('a', 1), ('c', 3)])
+        # Everything, reversed
+        q.move_to_front(['c', 'a', 'b', 'd', 'e'])
+        self.assertQueue(q, [('c', 3), ('a', 1), ('b', 2), ('d', 4), ('e', 5)])
+        self.assertEqual(q.take_removed(), [])
+
+    def test_move_to_front_ignores_unknown_and_repeated_uids(self):
+        q = IndexedQueue([('a', 1), ('b', 2), ('c', 3)])
+        q.move_to_front(['x', 'c', 'b', 'c'])
+        self.assertQueue(q, [('c', 3), ('b', 2), ('a', 1)])
+        q.move_to_front([])
+        self.assertQueue(q, [('c', 3), ('b', 2), ('a', 1)])
+
+    def test_mixed(self):
+        q = IndexedQueue()
+        expected = []
+        for i in range(20):
+            q.append(i, object())
+            expected.append((i, q[i]))
+        for i in range(0, 20, 3):
+            q.discard(i)
+            expected = [e for e in expected if e[0] != i]
+            self.assertQueue(q, expected)
+        q.move_to_front([19, 1, 10])
+        moved = dict([e for e in expected if e[0] in (19, 1, 10)])
+        expected = [(i, moved[i]) for i in (19, 1, 10)] + [e for e in expected if e[0] not in moved]
+        self.assertQueue(q, expected)
+        q.append(0, 'zero')
+        expected.append((0, 'zero'))
+        self.assertQueue(q, expected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import datetime
+import os
+import sys
+import time
+import unittest
+
+import shmooze.lib.service as service
+import shmooze.modules.module as module
+from tests.util import run
+
+class ArgvModule(module.Module):
+    TYPE_STRING = 'argv'
+    process = [sys.executable, os.path.join(os.path.dirname(__file__), 'argv_module.py')]
+    cmd_read_timeout = datetime.timedelta(milliseconds=400)
+    prepare_timeout = datetime.timedelta(milliseconds=300)
+
+# As with the unix transport
+class SocketpairModule(module.PyModule):
+    TYPE_STRING = 'socketpair'
+    process = [sys.executable, '-m', 'tests.dummy_module']
+    use_socketpair = True
+
+# Connects back through the rendezvous, if it connects at all
+class SilentModule(module.Module):
+    TYPE_STRING = 'silent'
+    process = [sys.executable, '-c', 'pass']
+    use_rendezvous = True
+    connect_timeout = datetime.timedelta(milliseconds=300)
+
+# Starts, but never connects
+class HangingModule(module.Module):
+    TYPE_STRING = 'hanging'
+    process = [sys.executable, '-c', 'import time; time.sleep(30)']
+    connect_timeout = datetime.timedelta(milliseconds=300)
+    natural_death_timeout = datetime.timedelta(milliseconds=100)
+
+@service.coroutine
+def removed():
+    pass
+
+class ModuleTest(unittest.TestCase):
+    def test_default_argv(self):
+        m = ArgvModule(removed)
+        @service.coroutine
+        def go():
+            yield m.new({})
+        try:
+            run(go)
+            self.assertTrue(m.alive)
+        finally:
+            m.terminate()
+
+    def test_socketpair_is_opt_in(self):
+        self.assertFalse(module.Module.use_socketpair)
+
+    def test_socketpair(self):
+        m = SocketpairModule(removed)
+        @service.coroutine
+        def go():
+            yield m.new({})
+        try:
+            run(go)
+            self.assertTrue(m.alive)
+        finally:
+            m.terminate()
+
+    def test_slow_prepare_does_not_hold_up_play(self):
+        m = ArgvModule(removed)
+        @service.coroutine
+        def go():
+            yield m.new({})
+            yield m.prepare()
+            # The response to prepare comes in after it has timed out (and after play's own read timeout), and is skipped over
+            result = yield m.send_cmd('play')
+            raise service.Return(result)
+        try:
+            self.assertEqual(run(go), 'play')
+            self.assertTrue(m.alive)
+        finally:
+            m.terminate()
+
+    def test_rendezvous_cancelled_when_module_does_not_connect(self):
+        m = SilentModule(removed)
+        @service.coroutine
+        def go():
+            try:
+                yield m.new({})
+            except Exception as e:
+                raise service.Return(str(e))
+        self.assertEqual(run(go), "Could not connect to spawned module")
+        self.assertEqual(module.rendezvous.expecting, {})
+
+    def test_killed_when_it_does_not_connect(self):
+        m = HangingModule(removed)
+        @service.coroutine
+        def go():
+            try:
+                yield m.new({})
+            except Exception:
+                pass
+            deadline = time.time() + 5
+            while m.proc.poll() is None and time.time() < deadline:
+                yield service.sleep(0.1)
+            raise service.Return(m.proc.poll())
+        self.assertIsNotNone(run(go))
+
+if __name__ == '__main__':
+    unittest.main()
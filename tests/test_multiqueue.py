@@ -0,0 +1,119 @@
+import datetime
+import sys
+import time
+import unittest
+
+import shmooze.lib.database as database
+import shmooze.lib.service as service
+import shmooze.lib.stats as stats
+import shmooze.modules.module as module
+import shmooze.multiqueue as multiqueue
+from tests.util import free_port, run
+
+class Dummy(module.Module):
+    TYPE_STRING = 'mq-dummy'
+    process = [sys.executable, '-m', 'tests.dummy_module']
+    connect_timeout = datetime.timedelta(seconds=10)
+
+class Rooms(multiqueue.MultiQueue):
+    permanent_queues = ['default']
+    idle_timeout = 600
+
+    def __init__(self):
+        self.port = free_port()
+        self.logger = database.Database(':memory:', log_table='queue_log', aggregator=database.TopAggregator())
+        super(Rooms, self).__init__([Dummy], [])
+
+def add(queue=None):
+    args = {'type': Dummy.TYPE_STRING, 'args': {}}
+    if queue is not None:
+        args['queue'] = queue
+    return {'cmd': 'add', 'args': args}
+
+class MultiQueueTest(unittest.TestCase):
+    def setUp(self):
+        for name in list(stats.collectors):
+            if name.startswith('client-queue'):
+                del stats.collectors[name]
+        self.mq = Rooms()
+
+    def tearDown(self):
+        run(self.mq.close)
+        self.mq.stop()
+        self.mq.logger.close()
+
+    def command(self, line):
+        @service.coroutine
+        def go():
+            result = yield self.mq.command(line)
+            raise service.Return(result)
+        return run(go)
+
+    def result(self, line):
+        response = self.command(line)
+        self.assertTrue(response['success'], response)
+        return response['result']
+
+    def test_commands_are_routed_by_queue_argument(self):
+        lounge_uid = self.result(add('lounge'))['uid']
+        default_uid = self.result(add())['uid']
+        self.assertEqual([m['uid'] for m in self.result({'cmd': 'queue', 'args': {'queue': 'lounge'}})], [lounge_uid])
+        self.assertEqual([m['uid'] for m in self.result({'cmd': 'queue'})], [default_uid])
+
+        # A list of commands may name several queues
+        results = self.command([{'cmd': 'queue', 'args': {'queue': 'lounge'}}, {'cmd': 'queue'}, {'cmd': 'queues'}])
+        self.assertEqual([m['uid'] for m in results[0]['result']], [lounge_uid])
+        self.assertEqual([m['uid'] for m in results[1]['result']], [default_uid])
+        self.assertEqual(sorted(results[2]['result'].keys()), ['default', 'lounge'])
+
+    def test_queues_are_created_on_demand(self):
+        self.assertEqual(sorted(self.result({'cmd': 'queues'}).keys()), ['default'])
+        self.assertEqual(self.result({'cmd': 'queue', 'args': {'queue': 'kitchen'}}), [])
+        self.assertEqual(sorted(self.result({'cmd': 'queues'}).keys()), ['default', 'kitchen'])
+
+        self.assertFalse(self.command({'cmd': 'queue', 'args': {'queue': 'no spaces'}})['success'])
+        self.assertNotIn('no spaces', self.mq.queues)
+
+    def test_idle_queues_are_evicted(self):
+        self.result({'cmd': 'queue', 'args': {'queue': 'idle'}})
+        self.result({'cmd': 'queue', 'args': {'queue': 'recent'}})
+        self.result(add('busy'))
+        self.assertIn('client-queue:idle', stats.collectors)
+        long_ago = time.time() - self.mq.idle_timeout - 1
+        for name in ['default', 'idle', 'busy']:
+            self.mq.last_used[name] = long_ago
+
+        self.mq.evict_idle()
+        # The default queue is permanent, and busy still has a module on it
+        self.assertEqual(sorted(self.mq.queues.keys()), ['busy', 'default', 'recent'])
+        self.assertEqual(self.result({'cmd': 'stats'})['queues'], {'hosted': 3, 'evicted': 1})
+        self.assertNotIn('client-queue:idle', stats.collectors)
+
+    def test_history_top_and_stats_are_per_queue(self):
+        lounge_uid = self.result(add('lounge'))['uid']
+        kitchen_uid = self.result(add('kitchen'))['uid']
+
+        # Modules are played once they have been added
+        @service.coroutine
+        def played():
+            deadline = time.time() + 10
+            while time.time() < deadline and [item['plays'] for item in self.mq.logger.top_items(Dummy.TYPE_STRING)] != [2]:
+                yield service.sleep(0.05)
+        run(played)
+
+        entries = self.result({'cmd': 'history', 'args': {'queue': 'lounge'}})['entries']
+        self.assertTrue(entries)
+        self.assertEqual(set([e['queue'] for e in entries]), set(['lounge']))
+        # Commands the queue sent its modules are tagged too
+        self.assertIn(lounge_uid, [e['uid'] for e in entries])
+        self.assertNotIn(kitchen_uid, [e['uid'] for e in entries])
+
+        lounge_top = self.result({'cmd': 'top', 'args': {'queue': 'lounge', 'type': Dummy.TYPE_STRING}})
+        self.assertEqual([item['plays'] for item in lounge_top], [1])
+        # Both queues played the same item
+        self.assertEqual([item['plays'] for item in self.mq.logger.top_items(Dummy.TYPE_STRING)], [2])
+        self.assertEqual(self.result({'cmd': 'top', 'args': {'type': Dummy.TYPE_STRING}}), [])
+
+        self.assertIn('add', stats.collectors['client-queue:lounge'].commands)
+        self.assertIn('add', stats.collectors['client-queue:kitchen'].commands)
+        self.assertNotIn('add', stats.collectors.get('client-queue:default', stats.CommandStats()).commands)
@@ -0,0 +1,126 @@
+import json
+import time
+import unittest
+
+import tornado.iostream
+
+import shmooze.lib.service as service
+import shmooze.lib.transport as transport
+from tests.util import free_port, run
+
+class Recorder(service.JSONCommandProcessor, service.Service):
+    pipeline_depth = 8
+    delay = 0.2
+
+    def __init__(self):
+        self.calls = []
+        self.listeners = []
+        self.port = free_port()
+        super(Recorder, self).__init__()
+
+    def handle_stream(self, stream, address):
+        f = super(Recorder, self).handle_stream(stream, address)
+        self.listeners.append(f)
+        return f
+
+    @service.coroutine
+    def slow_add(self, name):
+        self.calls.append(('start', name))
+        yield service.sleep(self.delay)
+        self.calls.append(('end', name))
+
+    @service.coroutine
+    def rm(self, name):
+        self.calls.append(('start', name))
+        self.calls.append(('end', name))
+
+    @service.coroutine
+    def slow_read(self):
+        yield service.sleep(self.delay)
+        raise service.Return(len(self.calls))
+
+    @service.coroutine
+    def unencodable(self):
+        raise service.Return(object())
+
+    commands = {
+        'slow_add': slow_add,
+        'rm': rm,
+        'slow_read': slow_read,
+        'unencodable': unencodable,
+    }
+
+    read_only_cmds = ['slow_read']
+
+# Send all the commands at once on one connection, and read back a response for each
+@service.coroutine
+def pipeline(port, commands):
+    s, address = transport.client_socket('localhost', port)
+    stream = tornado.iostream.IOStream(s)
+    yield stream.connect(address)
+    yield stream.write(''.join([json.dumps(c) + '\n' for c in commands]))
+    responses = []
+    for c in commands:
+        line = yield stream.read_until('\n')
+        responses.append(json.loads(line))
+    stream.close()
+    raise service.Return(responses)
+
+class PipeliningTest(unittest.TestCase):
+    def setUp(self):
+        self.service = Recorder()
+
+    def tearDown(self):
+        self.service.stop()
+
+    def test_mutations_stay_in_order(self):
+        @service.coroutine
+        def go():
+            responses = yield pipeline(self.service.port, [
+                {'cmd': 'slow_add', 'args': {'name': 'add'}},
+                {'cmd': 'rm', 'args': {'name': 'rm'}},
+            ])
+            raise service.Return(responses)
+        responses = run(go)
+        self.assertTrue(all([r['success'] for r in responses]))
+        self.assertEqual(self.service.calls, [('start', 'add'), ('end', 'add'), ('start', 'rm'), ('end', 'rm')])
+
+    def test_reads_run_together(self):
+        @service.coroutine
+        def go():
+            start = time.time()
+            yield pipeline(self.service.port, [{'cmd': 'slow_read'}] * 4)
+            raise service.Return(time.time() - start)
+        self.assertLess(run(go), 2 * Recorder.delay)
+
+    def test_reads_wait_for_earlier_mutations(self):
+        @service.coroutine
+        def go():
+            responses = yield pipeline(self.service.port, [
+                {'cmd': 'slow_add', 'args': {'name': 'add'}},
+                {'cmd': 'slow_read'},
+            ])
+            raise service.Return(responses)
+        responses = run(go)
+        self.assertEqual(responses[1]['result'], 2)
+
+    def test_connection_closes_when_writer_fails(self):
+        @service.coroutine
+        def go():
+            # More commands than the pipeline holds, so the reader is waiting for a slot when the writer fails
+            commands = [{'cmd': 'unencodable'}] + [{'cmd': 'slow_read'}] * (Recorder.pipeline_depth + 2)
+            s, address = transport.client_socket('localhost', self.service.port)
+            stream = tornado.iostream.IOStream(s)
+            yield stream.connect(address)
+            yield stream.write(''.join([json.dumps(c) + '\n' for c in commands]))
+            try:
+                yield service.with_timeout(time.time() + 5, stream.read_until_close())
+            except tornado.iostream.StreamClosedError:
+                pass
+            # The service stops listening on the connection, rather than waiting forever for a slot
+            yield service.with_timeout(time.time() + 5, self.service.listeners[0])
+            raise service.Return(stream.closed())
+        self.assertTrue(run(go))
+
+if __name__ == '__main__':
+    unittest.main()
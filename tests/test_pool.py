@@ -0,0 +1,142 @@
+import unittest
+
+import shmooze.lib.service as service
+import shmooze.modules.module as module
+import shmooze.pool
+from tests.util import free_port, run
+
+# Stands in for a module; records the states it is sent to
+class Fake(object):
+    def __init__(self):
+        self.alive = True
+        self.target = None
+        self.reconciler = None
+        self.targets = []
+        self.terminated = False
+        self.fail = False
+
+    def transition(self, target):
+        self.target = target
+        self.targets.append(target)
+        self.reconciler = service.Future()
+        if self.fail:
+            self.reconciler.set_exception(Exception("Can't"))
+        else:
+            self.reconciler.set_result(None)
+        return self.reconciler
+
+    def terminate(self):
+        self.terminated = True
+
+class CountingPool(shmooze.pool.Pool):
+    def __init__(self):
+        self.port = free_port()
+        self.flushes = 0
+        super(CountingPool, self).__init__([])
+
+    def flush_pending(self):
+        self.flushes += 1
+        super(CountingPool, self).flush_pending()
+
+class PoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = CountingPool()
+
+    def tearDown(self):
+        self.pool.stop()
+
+    # Make changes to the pool, then let the IOLoop go round so that they are flushed
+    def change(self, f):
+        @service.coroutine
+        def go():
+            with (yield self.pool.pool_lock.acquire()):
+                f()
+                yield self.pool.pool_updated()
+            yield service.sleep(0.01)
+        run(go)
+
+    def test_changes_are_flushed_once_per_tick(self):
+        fakes = dict([(str(i), Fake()) for i in range(3)])
+        @service.coroutine
+        def go():
+            for uid, obj in fakes.items():
+                with (yield self.pool.pool_lock.acquire()):
+                    self.pool.put(uid, obj)
+                    yield self.pool.pool_updated()
+            yield service.sleep(0.01)
+        run(go)
+        self.assertEqual(self.pool.flushes, 1)
+        for obj in fakes.values():
+            self.assertEqual(obj.targets, ['play'])
+        self.assertEqual(self.pool.pending_start, set())
+
+        def rm():
+            for uid in fakes:
+                self.pool.discard(uid)
+        self.change(rm)
+        self.assertEqual(self.pool.flushes, 2)
+        for obj in fakes.values():
+            self.assertEqual(obj.targets, ['play', 'rm'])
+        self.assertEqual(self.pool.pending_stop, {})
+
+        # Nothing to tell the modules
+        self.change(lambda: None)
+        self.assertEqual(self.pool.flushes, 2)
+
+    def test_start_then_stop_in_one_tick(self):
+        obj = Fake()
+        def put_and_discard():
+            self.pool.put('a', obj)
+            self.pool.discard('a')
+        self.change(put_and_discard)
+        # It was spawned, so it is stopped, but it is never played
+        self.assertEqual(obj.targets, ['rm'])
+        self.assertNotIn('a', self.pool.pool)
+
+    def test_stop_then_start_in_one_tick(self):
+        first, second = Fake(), Fake()
+        self.change(lambda: self.pool.put('a', first))
+        def replace():
+            self.pool.discard('a')
+            self.pool.put('a', second)
+        self.change(replace)
+        self.assertEqual(first.targets, ['play', 'rm'])
+        self.assertEqual(second.targets, ['play'])
+        self.assertIs(self.pool.pool['a'], second)
+
+    def test_dead_modules_are_not_stopped(self):
+        obj = Fake()
+        self.change(lambda: self.pool.put('a', obj))
+        obj.alive = False
+        self.change(lambda: self.pool.discard('a'))
+        self.assertEqual(obj.targets, ['play'])
+
+class TransitionTest(unittest.TestCase):
+    def test_transition(self):
+        transitions = set()
+        obj = Fake()
+        module.transition(transitions, 'a', obj, 'play')
+        self.assertEqual(obj.targets, ['play'])
+        self.assertEqual(transitions, set([obj.reconciler]))
+        # Already headed there
+        module.transition(transitions, 'a', obj, 'play')
+        self.assertEqual(obj.targets, ['play'])
+        @service.coroutine
+        def go():
+            yield service.sleep(0.01)
+        run(go)
+        self.assertEqual(transitions, set())
+        self.assertFalse(obj.terminated)
+
+    def test_failed_transition_terminates_module(self):
+        transitions = set()
+        obj = Fake()
+        obj.fail = True
+        module.transition(transitions, 'a', obj, 'play')
+        self.assertEqual(len(transitions), 1)
+        @service.coroutine
+        def go():
+            yield service.sleep(0.01)
+        run(go)
+        self.assertTrue(obj.terminated)
+        self.assertEqual(transitions, set())
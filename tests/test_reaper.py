@@ -0,0 +1,19 @@
+import subprocess
+import sys
+import time
+import unittest
+
+import shmooze.lib.service as service
+from tests.util import run
+
+class ChildReaperTest(unittest.TestCase):
+    def test_wait_for_exit(self):
+        @service.coroutine
+        def go():
+            proc = subprocess.Popen([sys.executable, '-c', 'import sys; sys.exit(3)'])
+            code = yield service.with_timeout(time.time() + 10, service.wait(proc))
+            raise service.Return(code)
+        self.assertEqual(run(go), 3)
+
+if __name__ == '__main__':
+    unittest.main()
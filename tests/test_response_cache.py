@@ -0,0 +1,121 @@
+import datetime
+import sys
+import time
+import unittest
+
+import shmooze.lib.packet as packet
+import shmooze.lib.service as service
+import shmooze.modules.module as module
+import shmooze.queue
+from tests.util import free_port, run
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.state = service.StateVersion()
+        self.cache = service.ResponseCache(self.state)
+        self.key = self.cache.key('queue', {'parameters': ['a', 'b']})
+
+    def test_keys(self):
+        self.assertEqual(self.key, self.cache.key('queue', {'parameters': ['a', 'b']}))
+        self.assertNotEqual(self.key, self.cache.key('queue', {'parameters': ['b', 'a']}))
+        self.assertNotEqual(self.key, self.cache.key('bg', {'parameters': ['a', 'b']}))
+
+    def test_hit(self):
+        self.assertIsNone(self.cache.get(self.key))
+        response = self.cache.put(self.key, self.state.version, packet.good([1]))
+        self.assertIsInstance(response, packet.Cached)
+        self.assertIs(self.cache.get(self.key), response)
+        self.assertIs(self.cache.get(self.key), response)
+        self.assertEqual(self.cache.stats(), {'hits': 2, 'misses': 1, 'entries': 1})
+
+    def test_invalidated_when_state_changes(self):
+        self.cache.put(self.key, self.state.version, packet.good([1]))
+        self.state.bump()
+        self.assertIsNone(self.cache.get(self.key))
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+    def test_stale_response_is_not_kept(self):
+        # The state changed while the response was being made
+        version = self.state.version
+        self.state.bump()
+        response = self.cache.put(self.key, version, packet.good([1]))
+        self.assertNotIsInstance(response, packet.Cached)
+        self.assertIsNone(self.cache.get(self.key))
+
+    def test_errors_are_not_kept(self):
+        self.cache.put(self.key, self.state.version, packet.error('no'))
+        self.assertIsNone(self.cache.get(self.key))
+
+    def test_full(self):
+        for i in range(self.cache.max_entries):
+            self.cache.put(self.cache.key('queue', i), self.state.version, packet.good(i))
+        self.assertEqual(self.cache.stats()['entries'], self.cache.max_entries)
+        self.cache.put(self.key, self.state.version, packet.good([1]))
+        self.assertEqual(self.cache.stats()['entries'], 1)
+        self.assertIsNotNone(self.cache.get(self.key))
+
+class Dummy(module.Module):
+    TYPE_STRING = 'cache-dummy'
+    process = [sys.executable, '-m', 'tests.dummy_module']
+    connect_timeout = datetime.timedelta(seconds=10)
+
+class QueueCacheTest(unittest.TestCase):
+    read = {'cmd': 'queue', 'args': {'parameters': {Dummy.TYPE_STRING: ['state']}}}
+
+    def setUp(self):
+        shmooze.queue.Queue.port = free_port()
+        self.queue = shmooze.queue.Queue([Dummy], [])
+
+    def tearDown(self):
+        run(self.queue.close)
+        self.queue.stop()
+
+    def command(self, line):
+        @service.coroutine
+        def go():
+            result = yield self.queue.command(line)
+            raise service.Return(result)
+        return run(go)
+
+    def states(self):
+        response = self.command(self.read)
+        return response, [(m['uid'], m['parameters'].get('state')) for m in response['result']]
+
+    def test_cached_until_queue_changes(self):
+        first, modules = self.states()
+        self.assertEqual(modules, [])
+        self.assertIs(self.command(self.read), first)
+        hits = self.queue.response_cache.hits
+
+        # Adding a module
+        uid = self.command({'cmd': 'add', 'args': {'type': Dummy.TYPE_STRING}})['result']['uid']
+        response, modules = self.states()
+        self.assertIsNot(response, first)
+        self.assertEqual([m[0] for m in modules], [uid])
+
+        # Moving modules
+        other = self.command({'cmd': 'add', 'args': {'type': Dummy.TYPE_STRING}})['result']['uid']
+        self.command({'cmd': 'mv', 'args': {'uids': [other]}})
+        response, modules = self.states()
+        self.assertEqual([m[0] for m in modules], [other, uid])
+
+        # Removing a module
+        self.command({'cmd': 'rm', 'args': {'uids': [uid]}})
+        response, modules = self.states()
+        self.assertEqual([m[0] for m in modules], [other])
+        self.assertIs(self.command(self.read), response)
+        self.assertGreater(self.queue.response_cache.hits, hits)
+
+    def test_invalidated_by_set_parameters(self):
+        uid = self.command({'cmd': 'add', 'args': {'type': Dummy.TYPE_STRING}})['result']['uid']
+        # The module is played, and then tells the queue its state with set_parameters
+        @service.coroutine
+        def played():
+            deadline = time.time() + 10
+            while time.time() < deadline:
+                response = yield self.queue.command(self.read)
+                if response['result'][0]['parameters'].get('state') == 'play':
+                    break
+                yield service.sleep(0.05)
+        run(played)
+        self.assertEqual(self.states()[1], [(uid, 'play')])
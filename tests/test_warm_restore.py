@@ -0,0 +1,138 @@
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import shmooze.lib.service as service
+import shmooze.modules.module as module
+import shmooze.modules.warm as warm
+import shmooze.queue
+from tests.util import free_port, run
+
+class Dummy(module.Module):
+    TYPE_STRING = 'warm-dummy'
+    process = [sys.executable, '-m', 'tests.dummy_module']
+    # Startup is slow when every module starts at once on a small machine
+    connect_timeout = datetime.timedelta(seconds=10)
+
+class WarmQueue(shmooze.queue.Queue):
+    def restore(self):
+        self.restored = super(WarmQueue, self).restore()
+        return self.restored
+
+# Doesn't start the modules from its snapshot until release is resolved
+class HeldQueue(WarmQueue):
+    def __init__(self, *args):
+        self.release = service.Future()
+        super(HeldQueue, self).__init__(*args)
+
+    @service.coroutine
+    def start_modules(self, entries, make):
+        yield self.release
+        result = yield super(HeldQueue, self).start_modules(entries, make)
+        raise service.Return(result)
+
+def exited(proc):
+    return proc.poll() is not None
+
+class RestoreTestCase(unittest.TestCase):
+    entries = 6
+    queue_class = WarmQueue
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, 'snapshot.json')
+        with open(path, 'w') as f:
+            json.dump({'queue': [{'uid': str(i), 'type': Dummy.TYPE_STRING, 'args': {}, 'parameters': {}} for i in range(self.entries)],
+                       'bg': None}, f)
+        self.old_pool_sizes = warm.pool_sizes
+        warm.pool_sizes = {Dummy.TYPE_STRING: 2}
+        warm.pools.pop(Dummy.TYPE_STRING, None)
+        self.queue_class.port = free_port()
+        self.queue_class.snapshot_settings = {'path': path, 'delay': 0.1}
+        # The queue would start these itself; start them here to see that they're used
+        warm.prestart([Dummy])
+        self.workers = [w.proc for w in warm.pools[Dummy.TYPE_STRING].idle]
+        self.queue = self.queue_class([Dummy], [])
+
+    def tearDown(self):
+        self.queue.stop()
+        warm.close_all()
+        warm.pools.pop(Dummy.TYPE_STRING, None)
+        warm.pool_sizes = self.old_pool_sizes
+        shutil.rmtree(self.dir)
+
+class WarmRestoreTest(RestoreTestCase):
+    def test_restore_with_warm_workers(self):
+        @service.coroutine
+        def go():
+            yield self.queue.restored
+            restored = [obj for uid, obj in self.queue.queue]
+            procs = [obj.proc for obj in restored]
+            yield self.queue.close()
+            raise service.Return((restored, procs))
+        restored, procs = run(go, timeout=60)
+        self.assertEqual(len(restored), self.entries)
+        for worker in self.workers:
+            self.assertIn(worker, procs)
+
+        # Every module, and every worker, exits once the queue is done with them
+        workers = [w.proc for w in warm.pools[Dummy.TYPE_STRING].idle]
+        warm.close_all()
+        deadline = time.time() + 10
+        while time.time() < deadline and not all([exited(p) for p in procs + workers]):
+            time.sleep(0.1)
+        self.assertTrue(all([exited(p) for p in procs + workers]))
+
+    def test_modules_exit_when_queue_goes_away(self):
+        @service.coroutine
+        def go():
+            yield self.queue.restored
+            restored = [obj for uid, obj in self.queue.queue]
+            # As if the queue had died; no other process may be holding the connections open
+            for obj in restored:
+                obj.cmd_stream.close()
+                obj.update_stream.close()
+            raise service.Return([obj.proc for obj in restored])
+        procs = run(go, timeout=60)
+        deadline = time.time() + 2
+        while time.time() < deadline and not all([exited(p) for p in procs]):
+            time.sleep(0.1)
+        self.assertTrue(all([exited(p) for p in procs]))
+        run(self.queue.close, timeout=60)
+
+class AddDuringRestoreTest(RestoreTestCase):
+    queue_class = HeldQueue
+
+    def test_module_added_during_restore(self):
+        written = []
+        put = self.queue.snapshot_writer.put
+        def record(saved):
+            written.append(saved)
+            put(saved)
+        self.queue.snapshot_writer.put = record
+        @service.coroutine
+        def go():
+            added = yield self.queue.add(Dummy.TYPE_STRING)
+            self.queue.release.set_result(None)
+            yield self.queue.restored
+            uids = self.queue.queue.uids()
+            deadline = time.time() + 10
+            while time.time() < deadline and not written:
+                yield service.sleep(0.1)
+            yield self.queue.close()
+            raise service.Return((added['uid'], uids))
+        added, uids = run(go, timeout=60)
+        # The restored modules were on the queue first
+        self.assertEqual(uids, [str(i) for i in range(self.entries)] + [added])
+        # Nothing was saved until the whole queue was back
+        self.assertTrue(written)
+        for saved in written:
+            self.assertEqual(len(saved['queue']), self.entries + 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,15 @@
+import socket
+
+import shmooze.lib.service as service
+
+# A TCP port that nothing is listening on
+def free_port():
+    s = socket.socket()
+    s.bind(('localhost', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+# Run a coroutine function to completion on the IOLoop that shmooze services use
+def run(f, timeout=20):
+    return service.ioloop.run_sync(f, timeout=timeout)